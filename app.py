@@ -1,13 +1,752 @@
-from flask import Flask, request, render_template_string, jsonify
-from collections import defaultdict
+from flask import Flask, Response, abort, g, request, jsonify, send_from_directory
+from werkzeug.utils import safe_join
+from collections import deque
 from datetime import datetime, timedelta
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import logging.handlers
+import math
+import mimetypes
+import os
+import queue
+import random
+import socket
+import sys
+import threading
+import time
 import pytz
+from checkpoint import Checkpoint
+from export import FORMATS, stream_export
+from geofence import Fence, Geofences
+from history import HistoryLog, HOUR_MS, point_to_dict
+from metrics import Counter, Gauge, Histogram, LATENCY_BUCKETS, RateMeter, Registry, SIZE_BUCKETS
+from motion import MotionFilter
+from ratelimit import RateLimiter
+from simplify import MAX_ZOOM, TrackSimplifier
+from spatial import BBox
+from store import create_store, iso_time
+from trips import TripStats, create_windows
+import wire
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 
+
+class JsonFormatter(logging.Formatter):
+    # سجل JSON واحد في كل سطر: الوقت والمستوى والرسالة والحقول المرفقة
+    def format(self, record):
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['error'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['error'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # لا ينتظر الطلب أبداً: إذا امتلأت الطابور يسقط السجل ويحسب
+    dropped = 0
+
+    def prepare(self, record):
+        # نص الخطأ يحسب هنا لأن traceback لا ينتقل بين الخيوط
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.message = record.getMessage()
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+def setup_logging():
+    # الكتابة إلى stdout تتم في خيط خلفي واحد؛ مسار الطلب يضع السجل في الطابور فقط
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    records = queue.Queue(maxsize=int(os.environ.get('LOG_QUEUE_SIZE', 10000)))
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    atexit.register(listener.stop)
+    logger = logging.getLogger('tracker')
+    logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+    logger.addHandler(DroppingQueueHandler(records))
+    logger.propagate = False
+    return logger, listener
+
+
+log, log_listener = setup_logging()
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def record_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = (('route', route),)
+    request_latency.observe(labels, time.perf_counter() - g.started)
+    if request.content_length:
+        request_size.observe(labels, request.content_length)
+    if response.content_length is not None:
+        response_size.observe(labels, response.content_length)
+    responses_total.inc((('route', route), ('status', response.status_code)))
+    return response
+
+# نسبة سجلات الإشارات المفردة التي تكتب (1 = كلها، 0.01 = واحد من كل مئة)
+# الأخطاء تسجل كاملة دائماً
+LOG_FIX_SAMPLE = float(os.environ.get('LOG_FIX_SAMPLE', 1.0))
+
+
+def log_fix(device_id, record):
+    if LOG_FIX_SAMPLE >= 1 or random.random() < LOG_FIX_SAMPLE:
+        log.info('تم تحديث بيانات الجهاز', extra={'fields': {
+            'event': 'update', 'device_id': device_id, 'lat': record['lat'], 'lon': record['lon']}})
+
 # تعريف وقت انتهاء صلاحية الإشارة (دقيقة واحدة)
 INACTIVE_THRESHOLD = timedelta(minutes=1)
-devices = defaultdict(lambda: {'custom_name': None, 'last_update': None})
+
+# حتى هذا المستوى من التكبير ترسل الخريطة مجموعات مجمعة بدلاً من علامة لكل جهاز؛ فهرس
+# التجميع في المخزن يحفظ هذه المستويات فقط
+CLUSTER_MAX_ZOOM = int(os.environ.get('CLUSTER_MAX_ZOOM', 13))
+
+# مخزن حالة الأجهزة: memory (داخل العملية) أو sqlite (مشترك بين عمال gunicorn)؛ إحصاءات
+# الرحلات وأحداث المناطق لا تتشارك بين العمال حتى مع sqlite (انظر geofences و trips أدناه)
+# كل كتابة (تحديث، تغيير اسم، حذف) تزيد الرقم التسلسلي العام
+# حتى تطلب لوحات العرض ما تغير فقط منذ آخر مؤشر لديها
+store = create_store(os.environ.get('DEVICE_STORE', 'memory'),
+                     os.environ.get('DEVICE_DB', 'devices.db'),
+                     INACTIVE_THRESHOLD.total_seconds(), CLUSTER_MAX_ZOOM + 1)
+
+# إسقاط الإشارات التي لم تتحرك أبعد من دقتها المعلنة (MOTION_FILTER=0 لتعطيله) مع إشارة
+# منشورة كل نصف مدة عدم النشاط على الأقل، وتنعيم اختياري للمواقع (MOTION_SMOOTHING=1)
+motion = MotionFilter(min_distance=float(os.environ.get('MOTION_MIN_DISTANCE', 5)),
+                      keepalive=INACTIVE_THRESHOLD.total_seconds() / 2,
+                      smoothing=os.environ.get('MOTION_SMOOTHING') == '1'
+                      ) if os.environ.get('MOTION_FILTER', '1') == '1' else None
+
+# خادم البلاطات للخريطة؛ في الشبكات المعزولة يوجه إلى خادم محلي
+TILE_URL = os.environ.get('TILE_URL', 'https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png')
+
+# المناطق الجغرافية وأحداث الدخول والخروج (اترك GEOFENCE_FILE فارغاً لإبقائها في الذاكرة فقط)
+# الملف يشارك المناطق نفسها بين العمال، أما موضع كل جهاز (داخلها أو خارجها) وسجل الأحداث ففي
+# ذاكرة العامل الذي استقبل الإشارة: مع عدة عمال تتكرر أحداث الدخول والخروج أو تضيع حسب العامل
+# الذي يستقبل كل إشارة، وتختلف /geofences/events حسب العامل الذي يجيب؛ الأحداث صحيحة مع عملية
+# واحدة فقط (Procfile الافتراضي)
+geofences = Geofences(os.environ.get('GEOFENCE_FILE', 'geofences.json'))
+
+# إحصاءات الرحلات لكل جهاز في نافذتي اليوم والوردية بالتوقيت المحلي STATS_TIMEZONE
+# تحفظ في ذاكرة العامل الذي استقبل الإشارة: مع DEVICE_STORE=sqlite وعدة عمال يحسب كل عامل
+# مسافة الإشارات التي وصلته فقط، وتختلف /stats حسب العامل الذي يجيب؛ الإحصاءات صحيحة مع عملية
+# واحدة فقط (Procfile الافتراضي: uvicorn بعملية واحدة)
+trips = TripStats(create_windows(os.environ.get('STATS_TIMEZONE', 'UTC'),
+                                 float(os.environ.get('STATS_SHIFT_HOURS', 8)),
+                                 float(os.environ.get('STATS_SHIFT_START', 6))),
+                  idle_speed=float(os.environ.get('STATS_IDLE_SPEED', 1.0)),
+                  max_gap=float(os.environ.get('STATS_MAX_GAP', 300)))
+if store.shared:
+    log.warning('إحصاءات الرحلات (/stats) وأحداث المناطق (/geofences/events) في ذاكرة كل عامل ولا '
+                'تتشارك بين عمال المخزن المشترك',
+                extra={'fields': {'event': 'per_worker_state', 'state': ['trips', 'geofences']}})
+
+# حدود معدل الإشارات: RATE_LIMIT_DEVICE إشارة في الثانية لكل جهاز مع دفعة حتى RATE_LIMIT_DEVICE_BURST،
+# و RATE_LIMIT_GLOBAL طلب في الثانية لكل عامل على كل مسارات الاستقبال؛ القيمة 0 تعطل الحد
+RATE_LIMIT_GLOBAL = float(os.environ.get('RATE_LIMIT_GLOBAL', 0))
+limiter = RateLimiter(float(os.environ.get('RATE_LIMIT_DEVICE', 1)),
+                      float(os.environ.get('RATE_LIMIT_DEVICE_BURST', 10)),
+                      RATE_LIMIT_GLOBAL, float(os.environ.get('RATE_LIMIT_GLOBAL_BURST', RATE_LIMIT_GLOBAL)))
+
+# المقاييس المعروضة على /metrics بصيغة Prometheus
+registry = Registry()
+request_latency = registry.add(Histogram(
+    'tracker_request_duration_seconds', 'زمن معالجة الطلب حسب المسار', LATENCY_BUCKETS))
+request_size = registry.add(Histogram(
+    'tracker_request_body_bytes', 'حجم جسم الطلب حسب المسار', SIZE_BUCKETS))
+response_size = registry.add(Histogram(
+    'tracker_response_body_bytes', 'حجم جسم الرد حسب المسار', SIZE_BUCKETS))
+responses_total = registry.add(Counter(
+    'tracker_responses_total', 'عدد الردود حسب المسار ورمز الحالة'))
+fixes_total = registry.add(Counter(
+    'tracker_fixes_total', 'الإشارات المقبولة حسب مصدرها'))
+fixes_suppressed = registry.add(Counter(
+    'tracker_fixes_suppressed_total', 'الإشارات المقبولة التي لم تنشر لأن الجهاز لم يتحرك'))
+parse_failures = registry.add(Counter(
+    'tracker_parse_failures_total', 'الإشارات المرفوضة لصيغة أو بيانات غير صالحة'))
+throttled_total = registry.add(Counter(
+    'tracker_throttled_total', 'الطلبات المرفوضة بحد المعدل حسب النطاق (device أو global) والمصدر'))
+ingest_rate = RateMeter()
+registry.add(Gauge('tracker_ingest_rate', 'الإشارات في الثانية (متوسط آخر دقيقة)',
+                   lambda: [((), ingest_rate.rate())]))
+
+
+def device_activity():
+    active, total = store.activity()
+    return [((('state', 'active'),), active), ((('state', 'inactive'),), total - active)]
+
+
+registry.add(Gauge('tracker_devices', 'عدد الأجهزة حسب الحالة (حد عدم النشاط INACTIVE_THRESHOLD)',
+                   device_activity))
+registry.add(Gauge('tracker_throttled_device_fixes', 'أكثر الأجهزة تجاوزاً لحد المعدل وعدد إشاراتها المرفوضة',
+                   lambda: [((('device_id', device_id),), count)
+                            for device_id, count in limiter.top_offenders(20)]))
+
+# سجل المواقع الدائم على القرص (اتركه فارغاً لتعطيله)
+HISTORY_DIR = os.environ.get('HISTORY_DIR', 'history')
+history = HistoryLog(HISTORY_DIR) if HISTORY_DIR else None
+# مستويات التفصيل المحسوبة لآخر TRACK_CACHE_SIZE مسار (?zoom= في /history)
+simplifier = TrackSimplifier(int(os.environ.get('TRACK_CACHE_SIZE', '64')))
+
+
+def dropped_records():
+    dropped = [((('sink', 'log'),), DroppingQueueHandler.dropped)]
+    if history:
+        dropped.append(((('sink', 'history'),), history.dropped))
+    return dropped
+
+
+registry.add(Gauge('tracker_dropped_records', 'السجلات المسقطة لامتلاء طوابير الكتابة الخلفية', dropped_records))
+
+
+class ChangeFeed:
+    # سجل دائري مشترك لأحداث التغيير مرمزة مسبقاً بصيغة SSE
+    # كل حدث يرمز مرة واحدة فقط مهما كان عدد المشتركين
+    def __init__(self, size, watchers=None, last=-1):
+        self.cond = threading.Condition()
+        self.events = deque(maxlen=size)  # (المؤشر قبل الحدث، المؤشر بعده، المواقع، الإطار)
+        self.watchers = [] if watchers is None else watchers  # دوال تستدعى بعد كل حدث (إيقاظ حلقة أحداث asgi.py)
+        self.floor = -1                   # المشتركون الأقدم من هذا يحتاجون لقطة كاملة (بعد reset)
+        self.last = last                  # مؤشر آخر حدث
+        self.names = {}                   # آخر اسم نشر لكل جهاز، لتمييز تغيير الاسم عن تحديث الموقع
+
+    def reset(self, cursor):
+        # تغيير لا يمكن تمثيله بأحداث (استعادة نسخة محفوظة): كل مشترك أقدم منه يعيد اللقطة
+        with self.cond:
+            self.events.clear()
+            self.floor = self.last = cursor
+            self.cond.notify_all()
+        for watcher in self.watchers:
+            watcher()
+
+    def publish(self, start, delta):
+        seq = delta['cursor']
+        frame = f"id: {seq}\ndata: {json.dumps(delta, separators=(',', ':'))}\n\n".encode()
+        # مواقع الأجهزة في الحدث حتى يصفي كل مشترك حسب حدود عرضه دون فك الترميز، ومعها هل تغير
+        # الاسم (الحذف None)؛ النشر من خيط واحد في كل مرة (_emit في المخزن أو خيط القراءة الدورية)
+        spots = None
+        if delta['full']:
+            self.names = {device_id: record.get('custom_name') for device_id, record in delta['devices'].items()}
+        else:
+            spots = {}
+            for device_id, record in delta['devices'].items():
+                name = record.get('custom_name')
+                spots[device_id] = (record['lat'], record['lon'], self.names.get(device_id, name) != name)
+                self.names[device_id] = name
+            for device_id in delta['deleted']:
+                spots[device_id] = None
+                self.names.pop(device_id, None)
+        with self.cond:
+            self.events.append((start, seq, spots, frame))
+            self.last = seq
+            self.cond.notify_all()
+        for watcher in self.watchers:
+            watcher()
+
+    def frames_after(self, cursor):
+        # None يعني أن المشترك تأخر أكثر من حجم السجل ويحتاج لقطة كاملة
+        if cursor < self.floor:
+            return None, cursor
+        if not self.events or self.events[-1][1] <= cursor:
+            return [], cursor
+        if self.events[0][0] > cursor:
+            return None, cursor
+        frames = []
+        for _, seq, spots, frame in reversed(self.events):
+            if seq <= cursor:
+                break
+            frames.append((spots, frame))
+        frames.reverse()
+        return frames, self.events[-1][1]
+
+    def wait(self, cursor, timeout):
+        with self.cond:
+            frames, new_cursor = self.frames_after(cursor)
+            if frames == []:
+                self.cond.wait(timeout)
+                frames, new_cursor = self.frames_after(cursor)
+            return frames, new_cursor
+
+
+class GroupFeeds:
+    # سجل أحداث لكل مجموعة أجهزة (ChangeFeed بنفس الصيغة)، ينشأ عند أول مشترك فيها: مشترك
+    # المجموعة لا يقرأ ولا يصفي إلا أحداثها، وكل حدث يرمز مرة واحدة لكل مشتركي المجموعة
+    # ويحذف مع خروج آخر مشترك، فلا تبقى سجلات لمجموعات (أو قيم ?group= عشوائية) لا يتابعها أحد
+    def __init__(self, size, watchers):
+        self.size = size
+        self.watchers = watchers
+        self.lock = threading.Lock()
+        self.feeds = {}
+        self.subscribers = {}   # المجموعة -> عدد المشتركين
+
+    def get(self, group, cursor):
+        with self.lock:
+            ring = self.feeds.get(group)
+            if ring is None:
+                ring = self.feeds[group] = ChangeFeed(self.size, self.watchers, cursor)
+            self.subscribers[group] = self.subscribers.get(group, 0) + 1
+            return ring
+
+    def release(self, group):
+        with self.lock:
+            self.subscribers[group] -= 1
+            if not self.subscribers[group]:
+                del self.subscribers[group]
+                del self.feeds[group]
+
+    def publish(self, delta, partitions):
+        with self.lock:
+            if delta['full']:
+                rings = [(ring, None) for ring in self.feeds.values()]
+            else:
+                rings = [(self.feeds[group], part) for group, part in (partitions or {}).items()
+                         if group in self.feeds]
+        for ring, part in rings:
+            if part is None:
+                ring.reset(delta['cursor'])
+            else:
+                ring.publish(ring.last, part)
+
+    def groups(self):
+        with self.lock:
+            return list(self.feeds.items())
+
+
+def compress(body, encoding, best=False):
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if best else 5)
+    return gzip.compress(body, compresslevel=9 if best else 6)
+
+
+def cached_response(etag, get_body, mimetype, cache_control):
+    # رد بمحتوى معروف الـ ETag: 304 إذا كان لدى المتصفح نفس النسخة، وإلا
+    # النسخة المضغوطة المناسبة لـ Accept-Encoding
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip']) or 'identity'
+        response = Response(get_body(encoding), mimetype=mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+class StaticAsset:
+    # محتوى ثابت (الصفحة أو ملف مكتبة) مع نسخه المضغوطة، يحسب كل منها مرة واحدة
+    def __init__(self, body, mimetype):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+        self.variants = {'identity': body}
+
+    def get(self, encoding):
+        body = self.variants.get(encoding)
+        if body is None:
+            body = self.variants[encoding] = compress(self.body, encoding, best=True)
+        return body
+
+    def response(self, cache_control):
+        return cached_response(self.etag, self.get, self.mimetype, cache_control)
+
+
+class SnapshotCache:
+    # اللقطة الكاملة لـ /get_devices مرمزة مرة واحدة لكل مؤشر تغييرات، وتضغط
+    # عند أول طلب لكل ترميز؛ الاستطلاعات المتكررة بلا تغيير تأخذ 304 فقط
+    # لقطة المجموعة (group) لها نسختها الخاصة ولا تتغير إلا بتغيير أحد أعضائها
+    def __init__(self, group=None):
+        self.group = group
+        self.lock = threading.Lock()
+        self.cursor = None
+        self.etag = None
+        self.bodies = {}
+
+    def get(self, encoding=None):
+        cursor = store.cursor(self.group)
+        with self.lock:
+            if cursor != self.cursor:
+                body = json.dumps(store.all(self.group), separators=(',', ':')).encode()
+                self.cursor = cursor
+                self.etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+                self.bodies = {'identity': body}
+            if encoding is None:
+                return self.etag, None
+            body = self.bodies.get(encoding)
+            if body is None:
+                body = self.bodies[encoding] = compress(self.bodies['identity'], encoding)
+            return self.etag, body
+
+
+snapshots = SnapshotCache()
+group_snapshots = {}          # لقطات /get_devices?group= لكل مجموعة
+MAX_GROUP_SNAPSHOTS = 256     # تفرغ كلها إذا طلبت مجموعات أكثر من هذا
+STREAM_HEARTBEAT = 15  # ثوانٍ بين رسائل الإبقاء على الاتصال
+STREAM_POLL = 0.25     # ثوانٍ بين قراءات التغييرات من المخزن المشترك
+feed = ChangeFeed(size=2048)
+group_feeds = GroupFeeds(256, feed.watchers)
+
+
+def publish_changes(start, delta, partitions=None):
+    feed.publish(start, delta)
+    group_feeds.publish(delta, partitions)
+
+
+store.subscribe(publish_changes)
+
+# نسخة دورية من حالة المخزن داخل العملية تستعاد عند التشغيل (المخزن المشترك دائم أصلاً)
+CHECKPOINT_FILE = os.environ.get('CHECKPOINT_FILE', 'checkpoint.json')
+checkpoint = None
+if CHECKPOINT_FILE and not store.shared:
+    checkpoint = Checkpoint(CHECKPOINT_FILE, float(os.environ.get('CHECKPOINT_INTERVAL', 30)))
+    checkpoint.start(store)
+    atexit.register(checkpoint.save, store)
+
+pump_lock = threading.Lock()
+pump_started = False
+
+
+def pump_changes():
+    # مع المخزن المشترك تأتي التغييرات من عمال آخرين أيضاً، فنقرؤها دورياً
+    # في خيط واحد لكل عملية ونوزعها على كل المشتركين
+    cursor = store.cursor()
+    while True:
+        time.sleep(STREAM_POLL)
+        try:
+            delta = store.changes_since(cursor)
+        except Exception:
+            log.exception('خطأ في قراءة التغييرات', extra={'fields': {'event': 'pump_error'}})
+            continue
+        if delta['cursor'] != cursor:
+            feed.publish(cursor, delta)
+            cursor = delta['cursor']
+            # سجل كل مجموعة لها مشتركون يقرأ من تغييراتها فقط (فهرس المجموعة في المخزن)
+            for group, ring in group_feeds.groups():
+                try:
+                    part = store.changes_since(ring.last, group)
+                except Exception:
+                    log.exception('خطأ في قراءة التغييرات', extra={'fields': {'event': 'pump_error'}})
+                    continue
+                if part['full']:
+                    ring.reset(part['cursor'])
+                elif part['devices'] or part['deleted']:
+                    ring.publish(ring.last, part)
+
+
+def ensure_pump():
+    global pump_started
+    with pump_lock:
+        if not pump_started:
+            threading.Thread(target=pump_changes, daemon=True).start()
+            pump_started = True
+
+
+def build_record(data, updated):
+    # يتحقق من إشارة واحدة ويعيد (معرف الجهاز، السجل) أو يرفع ValueError
+    device_id = data.get('id')
+    lat = data.get('lat')
+    lon = data.get('lon')
+    if not all([device_id, lat, lon]):
+        raise ValueError('يجب إرسال معرف الجهاز والإحداثيات')
+    lat, lon = float(lat), float(lon)
+    # المقارنة ترفض NaN و inf أيضاً؛ لا تصل إلى المخزن (فهو JSON غير صالح للمتصفح)
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError('الإحداثيات خارج النطاق')
+    return device_id, {
+        'lat': lat,
+        'lon': lon,
+        'timestamp': data.get('timestamp'),
+        'battery': data.get('batt'),
+        'speed': data.get('speed'),
+        'accuracy': data.get('accuracy'),
+        'updated': updated
+    }
+
+
+def fix_order(record):
+    # الإشارات ذات الطابع الزمني الرقمي ترتب به، وإلا فالأحدث هو الأخير في الدفعة
+    try:
+        return float(record['timestamp'])
+    except (TypeError, ValueError):
+        return None
+
+
+def view_delta(since, bbox, group=None):
+    # التغييرات منذ المؤشر مقصورة على حدود العرض (وعلى مجموعة واحدة مع group)؛ الأجهزة التي
+    # تغيرت خارج الحدود تعاد في left
+    if bbox is None:
+        return store.changes_since(since, group)
+    if since >= 0:
+        delta = store.changes_since(since, group)
+        if not delta['full']:
+            inside, left = {}, []
+            for device_id, record in delta['devices'].items():
+                if bbox.contains(record['lat'], record['lon']):
+                    inside[device_id] = record
+                else:
+                    left.append(device_id)
+            return {**delta, 'devices': inside, 'left': left}
+    cursor = store.cursor()
+    return {'cursor': cursor, 'full': True, 'devices': store.in_bbox(bbox, group), 'deleted': [], 'left': []}
+
+
+class StreamSession:
+    # مشترك واحد في البث؛ مشترك بين /stream وخادم ASGI (asgi.py)
+    # مع bbox تبدأ الجلسة بلقطة للأجهزة داخل حدود العرض فقط، ولا ترسل من تحديثات المواقع
+    # إلا ما يخص جهازاً داخلها أو جهازاً كان ظاهراً وخرج منها؛ الحذف وتغيير الاسم يرسلان دائماً
+    # حتى تبقى قوائم الأسماء والإدارة في اللوحة (كل الأجهزة وليس المعروضة فقط) صحيحة
+    # مع group تقرأ الجلسة سجل أحداث المجموعة وحده (group_feeds) ولقطتها فقط
+    def __init__(self, since, bbox, group=None):
+        self.cursor = int(since) if since is not None else -1
+        self.bbox = BBox.parse(bbox) if bbox else None
+        self.group = group or None
+        # السجل ينشأ قبل اللقطة حتى لا يضيع حدث بينهما
+        self.feed = group_feeds.get(self.group, store.cursor()) if self.group else feed
+        self.visible = set()
+        self.last_sent = time.monotonic()
+
+    def close(self):
+        if self.group:
+            group_feeds.release(self.group)
+
+    def snapshot(self):
+        delta = view_delta(self.cursor if self.bbox is None else -1, self.bbox, self.group)
+        self.visible.clear()
+        self.visible.update(delta['devices'])
+        self.cursor = delta['cursor']
+        self.last_sent = time.monotonic()
+        data = json.dumps(delta, separators=(',', ':'))
+        return f"id: {delta['cursor']}\ndata: {data}\n\n".encode()
+
+    def relevant(self, spots):
+        if self.bbox is None or spots is None:
+            return True
+        hit = False
+        for device_id, spot in spots.items():
+            if spot is None:
+                self.visible.discard(device_id)
+                hit = True
+            elif self.bbox.contains(spot[0], spot[1]):
+                self.visible.add(device_id)
+                hit = True
+            elif device_id in self.visible:
+                self.visible.discard(device_id)
+                hit = True
+            elif spot[2]:
+                hit = True
+        return hit
+
+    def chunk(self, frames, cursor):
+        # ما يرسل بعد قراءة feed: الأحداث المعنية، أو لقطة كاملة لمشترك متأخر، أو ping
+        if frames is None:
+            self.cursor = -1
+            return self.snapshot()
+        self.cursor = cursor
+        chunk = b''.join(frame for spots, frame in frames if self.relevant(spots))
+        if not chunk and time.monotonic() - self.last_sent >= STREAM_HEARTBEAT:
+            chunk = b': ping\n\n'
+        if chunk:
+            self.last_sent = time.monotonic()
+        return chunk
+
+
+def fix_time_ms(record, now_ms):
+    # وقت الإشارة من الجهاز (بالثواني أو الميلي ثانية) إن كان معقولاً، وإلا وقت الاستقبال
+    ts = fix_order(record)
+    if ts is None:
+        return now_ms
+    ts_ms = int(ts if ts > 1e11 else ts * 1000)
+    if not 1e12 <= ts_ms <= now_ms + HOUR_MS:
+        return now_ms
+    return ts_ms
+
+
+def parse_time_ms(value, default):
+    # يقبل ثوانٍ أو ميلي ثوانٍ منذ 1970 أو تاريخاً بصيغة ISO
+    if not value:
+        return default
+    try:
+        ts = float(value)
+        return int(ts if ts > 1e11 else ts * 1000)
+    except ValueError:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=pytz.utc)
+        return int(parsed.timestamp() * 1000)
+
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/jsonl')
+
+
+def batch_items(payload, text):
+    # مصفوفة JSON أو {"fixes": [...]} أو NDJSON (إشارة في كل سطر)
+    if isinstance(payload, dict):
+        payload = payload.get('fixes')
+    if isinstance(payload, list):
+        return payload
+    items = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            items.append(None)
+    return items
+
+
+THROTTLED_MESSAGE = 'تم تجاوز حد الإرسال، أعد المحاولة لاحقاً'
+THROTTLED_BODY = json.dumps({'status': 'error', 'message': THROTTLED_MESSAGE}, ensure_ascii=False).encode()
+
+
+def throttle(device_id, source):
+    # 0 إذا سمح بالطلب، وإلا ثواني الانتظار لترويسة Retry-After؛ مشترك مع asgi.py
+    # device_id = None يفحص الحد العام فقط (الدفعات والصيغة الثنائية قبل فك الجسم)
+    scope, retry = limiter.check(device_id, time.monotonic())
+    if retry:
+        throttled_total.inc((('scope', scope), ('source', source)))
+    return retry
+
+
+def retry_after(retry):
+    return str(max(1, math.ceil(retry)))
+
+
+def apply_fix(data, source='update'):
+    # تطبيق إشارة واحدة؛ مشترك بين /update وخادم ASGI (asgi.py)
+    # وقت الاستقبال بالثواني منذ 1970؛ صيغة ISO (last_update) تبنى عند العرض فقط
+    now = time.time()
+    device_id, record = build_record(data, now)
+    now_ms = int(now * 1000)
+    ts_ms = fix_time_ms(record, now_ms)
+    still = motion and not motion.accept(device_id, record, now_ms / 1000, ts_ms / 1000)
+    trips.observe(device_id, record, ts_ms / 1000)
+    if still and store.touch(device_id, record['updated']):
+        fixes_suppressed.inc((('source', source),))
+    else:
+        store.update(device_id, record)
+        if history:
+            history.append(device_id, ts_ms, record)
+        geofences.check(device_id, record['lat'], record['lon'], ts_ms)
+    log_fix(device_id, record)
+    fixes_total.inc((('source', source),))
+    ingest_rate.mark()
+
+
+def apply_batch(items, source='batch'):
+    # تطبيق دفعة إشارات وإرجاع حالة كل عنصر؛ الأحدث فقط لكل جهاز يصل إلى المخزن
+    now = time.time()
+    now_ms = int(now * 1000)
+    results = []
+    newest = {}  # معرف الجهاز -> (ترتيب الإشارة، رقم العنصر، السجل)
+    quiet = {}   # معرف الجهاز -> آخر إشارة لم تنشر لأنه لم يتحرك
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('صيغة غير صالحة')
+            device_id, record = build_record(item, now)
+        except (TypeError, ValueError) as e:
+            results.append({'status': 'error', 'message': str(e)})
+            continue
+        results.append({'status': 'applied'})
+        ts_ms = fix_time_ms(record, now_ms)
+        still = motion and not motion.accept(device_id, record, now_ms / 1000, ts_ms / 1000)
+        trips.observe(device_id, record, ts_ms / 1000)
+        if still:
+            results[index]['status'] = 'suppressed'
+            quiet[device_id] = record
+            continue
+        if history:
+            history.append(device_id, ts_ms, record)
+        geofences.check(device_id, record['lat'], record['lon'], ts_ms)
+        order = fix_order(record)
+        best = newest.get(device_id)
+        if best is not None:
+            if best[0] is not None and order is not None and order < best[0]:
+                results[index]['status'] = 'superseded'
+                continue
+            results[best[1]]['status'] = 'superseded'
+        newest[device_id] = (order, index, record)
+
+    store.update_many([(device_id, record) for device_id, (_, _, record) in newest.items()])
+    for device_id, record in quiet.items():
+        if device_id not in newest and not store.touch(device_id, record['updated']):
+            store.update(device_id, record)
+    if quiet:
+        fixes_suppressed.inc((('source', source),), sum(1 for r in results if r['status'] == 'suppressed'))
+    accepted = sum(1 for r in results if r['status'] != 'error')
+    fixes_total.inc((('source', source),), accepted)
+    ingest_rate.mark(accepted)
+    if accepted < len(results):
+        parse_failures.inc((('source', source),), len(results) - accepted)
+    log.info('تم استقبال دفعة إشارات', extra={'fields': {
+        'event': 'batch', 'items': len(items), 'accepted': accepted, 'devices': len(newest)}})
+    return {'accepted': accepted, 'devices': len(newest), 'results': results}
+
+
+def apply_binary(data, source='binary'):
+    # إشارات بالصيغة الثنائية (wire.py)؛ مشترك بين /update_binary و UDP وخادم ASGI
+    # يعيد (رمز الحالة، الرد)، والرد مختصر دون حالة كل عنصر لتوفير البيانات على الشبكة
+    try:
+        fixes = wire.decode(data)
+    except ValueError as e:
+        parse_failures.inc((('source', source),))
+        return 400, {'status': 'error', 'message': str(e)}
+    if not fixes:
+        return 400, {'status': 'error', 'message': 'الدفعة فارغة'}
+    result = apply_batch(fixes, source)
+    return 200, {'status': 'success', 'accepted': result['accepted'], 'devices': result['devices']}
+
+
+def serve_udp(port):
+    # مستقبل UDP اختياري: كل حزمة إطار أو أكثر بالصيغة الثنائية، والرد ACK بعدد المقبول
+    # SO_REUSEPORT يسمح لكل عامل gunicorn بفتح نفس المنفذ ويوزع النظام الحزم بينهم
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('0.0.0.0', port))
+    buffer = bytearray(65535)
+    view = memoryview(buffer)
+    while True:
+        try:
+            size, address = sock.recvfrom_into(buffer)
+            if throttle(None, 'udp'):
+                continue  # الجهاز لا يتلقى ACK فيعيد الإرسال لاحقاً
+            status, result = apply_binary(view[:size], 'udp')
+            if status == 200:
+                sock.sendto(wire.ack(result['accepted']), address)
+        except Exception:
+            log.exception('خطأ في استقبال UDP', extra={'fields': {'event': 'udp_error'}})
+
+
+UDP_PORT = int(os.environ.get('UDP_PORT', 0))
+if UDP_PORT:
+    threading.Thread(target=serve_udp, args=(UDP_PORT,), daemon=True).start()
+
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -59,6 +798,33 @@ HTML_TEMPLATE = """
   .device-label.inactive {
       background-color: #dc3545;
   }
+  .device-cluster {
+      width: 44px;
+      height: 44px;
+      margin: -22px 0 0 -22px;
+      border-radius: 50%;
+      border: 3px solid rgba(255,255,255,0.8);
+      box-shadow: 0 1px 4px rgba(0,0,0,0.3);
+      color: white;
+      font-weight: bold;
+      font-size: 13px;
+      text-align: center;
+      line-height: 1.1;
+      padding-top: 8px;
+      box-sizing: border-box;
+      cursor: pointer;
+  }
+  .device-cluster small {
+      display: block;
+      font-size: 9px;
+      font-weight: normal;
+  }
+  .device-cluster.active {
+      background-color: rgba(40,167,69,0.9);
+  }
+  .device-cluster.inactive {
+      background-color: rgba(220,53,69,0.9);
+  }
   #rename-form {
       margin-top: 15px;
       padding-top: 15px;
@@ -155,8 +921,8 @@ HTML_TEMPLATE = """
       max-width: 80%;
   }
 </style>
-<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css"/>
-<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css"/>
+<link rel="stylesheet" href="/vendor/leaflet-1.9.3/leaflet.css"/>
+<link rel="stylesheet" href="/vendor/fontawesome-6.4.0/css/all.min.css"/>
 </head>
 <body>
 <div id="map"></div>
@@ -221,12 +987,25 @@ HTML_TEMPLATE = """
     </button>
 </div>
 
-<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
-<script src="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/js/all.min.js"></script>
+<script src="/vendor/leaflet-1.9.3/leaflet.js"></script>
 <script>
     let map;
     const deviceMarkers = {};
     const deviceLabels = {};
+    const deviceActivity = {};
+    const devices = {};
+    let deviceCursor = -1;
+    let pollTimer = null;
+    let eventSource = null;
+    let viewBounds = null;
+    let moveTimer = null;
+    let streamFailed = false;
+    let clusterLayer = null;
+    let clusterTimer = null;
+    // /?group=<المجموعة> لوحة فريق واحد: أجهزته فقط، بلا تجميع (بضع مئات من العلامات)
+    const deviceGroup = new URLSearchParams(location.search).get('group');
+    const groupParam = deviceGroup ? '&group=' + encodeURIComponent(deviceGroup) : '';
+    const CLUSTER_MAX_ZOOM = {{ cluster_max_zoom }};
     let userLocationMarker = null;
     let watchId = null;
     let isAndroidApp = false;
@@ -267,8 +1046,15 @@ HTML_TEMPLATE = """
 
     function initMap() {
         map = L.map('map').setView([35.389062, -1.0950887], 15);
-        L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png').addTo(map);
-        updateDevices();
+        L.tileLayer({{ tile_url | tojson }}).addTo(map);
+        clusterLayer = L.layerGroup().addTo(map);
+        map.on('moveend', onViewChanged);
+        setInterval(() => {
+            if (refreshDeviceActivity()) {
+                updateDeviceList(devices);
+                updateDeviceNamesList(devices);
+            }
+        }, 5000);
         
         // اكتشاف إذا كان التطبيق يعمل داخل WebView في Android
         isAndroidApp = detectAndroidApp();
@@ -290,46 +1076,213 @@ HTML_TEMPLATE = """
         });
     }
 
+    function renderDevice(deviceId, deviceData) {
+        if (!(deviceData.lat && deviceData.lon)) return;
+        const isActive = isDeviceActive(deviceData);
+        const displayName = deviceData.custom_name || deviceId;
+        const lastUpdate = formatDateTime(deviceData.last_update);
+
+        if (!deviceMarkers[deviceId]) {
+            deviceMarkers[deviceId] = L.marker([deviceData.lat, deviceData.lon])
+                .addTo(map)
+                .bindPopup(`<b>${displayName}</b><br>آخر تحديث: ${lastUpdate}`);
+        } else {
+            deviceMarkers[deviceId].setLatLng([deviceData.lat, deviceData.lon]);
+            deviceMarkers[deviceId].getPopup().setContent(`<b>${displayName}</b><br>آخر تحديث: ${lastUpdate}`);
+            map.removeLayer(deviceLabels[deviceId]);
+        }
+        deviceLabels[deviceId] = createLabel(deviceId, deviceData, isActive).addTo(map);
+        deviceActivity[deviceId] = isActive;
+    }
+
+    function hideDevice(deviceId) {
+        if (deviceMarkers[deviceId]) {
+            map.removeLayer(deviceMarkers[deviceId]);
+            map.removeLayer(deviceLabels[deviceId]);
+            delete deviceMarkers[deviceId];
+            delete deviceLabels[deviceId];
+        }
+        delete deviceActivity[deviceId];
+    }
+
+    function removeDevice(deviceId) {
+        hideDevice(deviceId);
+        delete devices[deviceId];
+    }
+
+    // حدود العرض مع هامش حتى لا نعيد الطلب عند كل تحريك بسيط للخريطة
+    function paddedBounds() {
+        return map.getBounds().pad(0.25);
+    }
+
+    function bboxParam(bounds) {
+        return [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()]
+            .map(value => value.toFixed(5)).join(',');
+    }
+
+    function isInView(deviceData) {
+        return viewBounds.contains([deviceData.lat, deviceData.lon]);
+    }
+
+    // تطبيق دفعة التغييرات القادمة من الخادم على الخريطة بدلاً من إعادة رسم كل شيء
+    // الخادم يرسل مواقع الأجهزة داخل حدود العرض فقط (left هي الأجهزة التي خرجت منها)، أما
+    // الحذف وتغيير الاسم فيصلان لكل الأجهزة: يطبقان على القوائم والجهاز خارج العرض يبقى مخفياً
+    function applyDeviceDelta(delta) {
+        let changed = false;
+        if (delta.full) {
+            for (const deviceId in deviceMarkers) {
+                if (!delta.devices[deviceId]) hideDevice(deviceId);
+            }
+            changed = true;
+        }
+        for (const deviceId of delta.deleted) {
+            removeDevice(deviceId);
+            changed = true;
+        }
+        for (const deviceId of delta.left || []) {
+            hideDevice(deviceId);
+        }
+        for (const [deviceId, deviceData] of Object.entries(delta.devices)) {
+            devices[deviceId] = deviceData;
+            if (isInView(deviceData)) {
+                renderDevice(deviceId, deviceData);
+            } else {
+                hideDevice(deviceId);
+            }
+            changed = true;
+        }
+        deviceCursor = delta.cursor;
+
+        if (refreshDeviceActivity() || changed) {
+            updateDeviceList(devices);
+            updateDeviceNamesList(devices);
+        }
+    }
+
+    // الأجهزة التي لم تتغير قد تصبح غير نشطة مع مرور الوقت
+    function refreshDeviceActivity() {
+        let changed = false;
+        for (const [deviceId, deviceData] of Object.entries(devices)) {
+            if (deviceLabels[deviceId] && deviceActivity[deviceId] !== isDeviceActive(deviceData)) {
+                renderDevice(deviceId, deviceData);
+                changed = true;
+            }
+        }
+        return changed;
+    }
+
     function updateDevices() {
-        fetch('/get_devices')
+        if (clusterTimer) {
+            loadClusters();
+            return;
+        }
+        fetch('/get_devices?since=' + deviceCursor + '&bbox=' + bboxParam(viewBounds) + groupParam)
             .then(response => response.json())
-            .then(devices => {
-                for (const deviceId in deviceMarkers) {
-                    if (!devices[deviceId]) {
-                        map.removeLayer(deviceMarkers[deviceId]);
-                        map.removeLayer(deviceLabels[deviceId]);
-                        delete deviceMarkers[deviceId];
-                        delete deviceLabels[deviceId];
-                    }
-                }
+            .then(applyDeviceDelta);
+    }
 
+    // قائمة كل الأجهزة (وليس المعروضة فقط) لقوائم الأسماء والإدارة
+    function loadDeviceDirectory() {
+        fetch(deviceGroup ? '/get_devices?group=' + encodeURIComponent(deviceGroup) : '/get_devices')
+            .then(response => response.json())
+            .then(all => {
+                // القائمة تستبدل كاملة: جهاز حذف أو خرج من المجموعة منذ التحميل السابق لا يبقى فيها
+                for (const deviceId in devices) {
+                    if (!all[deviceId]) removeDevice(deviceId);
+                }
+                Object.assign(devices, all);
                 updateDeviceList(devices);
                 updateDeviceNamesList(devices);
+            });
+    }
 
-                for (const [deviceId, deviceData] of Object.entries(devices)) {
-                    if (deviceData.lat && deviceData.lon) {
-                        const isActive = isDeviceActive(deviceData);
-                        const displayName = deviceData.custom_name || deviceId;
-                        const lastUpdate = formatDateTime(deviceData.last_update);
-                        
-                        if (!deviceMarkers[deviceId]) {
-                            deviceMarkers[deviceId] = L.marker([deviceData.lat, deviceData.lon])
-                                .addTo(map)
-                                .bindPopup(`<b>${displayName}</b><br>آخر تحديث: ${lastUpdate}`);
-                            
-                            deviceLabels[deviceId] = createLabel(deviceId, deviceData, isActive).addTo(map);
-                        } else {
-                            deviceMarkers[deviceId].setLatLng([deviceData.lat, deviceData.lon]);
-                            deviceMarkers[deviceId].getPopup().setContent(`<b>${displayName}</b><br>آخر تحديث: ${lastUpdate}`);
-                            
-                            map.removeLayer(deviceLabels[deviceId]);
-                            deviceLabels[deviceId] = createLabel(deviceId, deviceData, isActive).addTo(map);
-                        }
-                    }
+    function showDevice(deviceId) {
+        const deviceData = devices[deviceId];
+        if (!(deviceData && deviceData.lat && deviceData.lon)) return;
+        map.setView([deviceData.lat, deviceData.lon], 18);
+        renderDevice(deviceId, deviceData);
+        deviceMarkers[deviceId].openPopup();
+    }
+
+    // البث المباشر من الخادم، مع الرجوع إلى الاستطلاع كل 3 ثوانٍ إذا تعذر
+    // عند تغيير حدود العرض يعاد الاتصال لاستلام الأجهزة المرئية فقط
+    function startLiveUpdates() {
+        viewBounds = paddedBounds();
+        if (!window.EventSource || streamFailed) {
+            deviceCursor = -1;
+            startPolling();
+            return;
+        }
+        if (eventSource) eventSource.close();
+        const source = eventSource = new EventSource('/stream?bbox=' + bboxParam(viewBounds) + groupParam);
+        source.onmessage = event => applyDeviceDelta(JSON.parse(event.data));
+        source.onerror = () => {
+            // المتصفح يعيد الاتصال تلقائياً ما لم يغلق المصدر نهائياً
+            if (source.readyState === EventSource.CLOSED && source === eventSource) {
+                eventSource = null;
+                streamFailed = true;
+                startPolling();
+            }
+        };
+    }
+
+    function stopLiveUpdates() {
+        if (eventSource) {
+            eventSource.close();
+            eventSource = null;
+        }
+        if (pollTimer) {
+            clearInterval(pollTimer);
+            pollTimer = null;
+        }
+    }
+
+    // عند التصغير يرسل الخادم مجموعات جاهزة بدلاً من علامة لكل جهاز
+    function loadClusters() {
+        fetch(`/clusters?zoom=${map.getZoom()}&bbox=${bboxParam(paddedBounds())}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!clusterTimer) return;
+                clusterLayer.clearLayers();
+                for (const cluster of data.clusters) {
+                    const icon = L.divIcon({
+                        className: '',
+                        html: `<div class="device-cluster ${cluster.active ? 'active' : 'inactive'}">${cluster.count}<small>${cluster.active}/${cluster.count}</small></div>`,
+                        iconSize: [0, 0]
+                    });
+                    L.marker([cluster.lat, cluster.lon], { icon })
+                        .on('click', () => map.setView([cluster.lat, cluster.lon], Math.min(map.getZoom() + 2, CLUSTER_MAX_ZOOM + 1)))
+                        .addTo(clusterLayer);
                 }
             });
     }
 
+    function showView() {
+        if (map.getZoom() <= CLUSTER_MAX_ZOOM && !deviceGroup) {
+            stopLiveUpdates();
+            for (const deviceId in deviceMarkers) hideDevice(deviceId);
+            if (!clusterTimer) clusterTimer = setInterval(loadClusters, 5000);
+            loadClusters();
+        } else if (clusterTimer) {
+            clearInterval(clusterTimer);
+            clusterTimer = null;
+            clusterLayer.clearLayers();
+            startLiveUpdates();
+        } else if (!viewBounds || !viewBounds.contains(map.getBounds())) {
+            startLiveUpdates();
+        }
+    }
+
+    function onViewChanged() {
+        clearTimeout(moveTimer);
+        moveTimer = setTimeout(showView, 300);
+    }
+
+    function startPolling() {
+        if (!pollTimer) pollTimer = setInterval(updateDevices, 3000);
+        updateDevices();
+    }
+
     function updateDeviceList(devices) {
         const deviceList = document.getElementById('device-list');
         const deviceSelect = document.getElementById('device-select');
@@ -348,12 +1301,7 @@ HTML_TEMPLATE = """
                     <i class="fas fa-trash"></i>
                 </button>
             `;
-            item.onclick = () => {
-                if (deviceData.lat && deviceData.lon) {
-                    map.setView([deviceData.lat, deviceData.lon], 18);
-                    if (deviceMarkers[deviceId]) deviceMarkers[deviceId].openPopup();
-                }
-            };
+            item.onclick = () => showDevice(deviceId);
             deviceList.appendChild(item);
             
             const option = document.createElement('option');
@@ -375,14 +1323,7 @@ HTML_TEMPLATE = """
             item.className = 'device-list-item ' + (isActive ? 'active' : 'inactive');
             item.textContent = displayName;
             
-            item.onclick = function() {
-                if (deviceData.lat && deviceData.lon) {
-                    map.setView([deviceData.lat, deviceData.lon], 18);
-                    if (deviceMarkers[deviceId]) {
-                        deviceMarkers[deviceId].openPopup();
-                    }
-                }
-            };
+            item.onclick = () => showDevice(deviceId);
             
             deviceNamesList.appendChild(item);
         }
@@ -446,12 +1387,7 @@ HTML_TEMPLATE = """
         .then(data => {
             if (data.success) {
                 // حذف العلامة من الخريطة فوراً
-                if (deviceMarkers[deviceId]) {
-                    map.removeLayer(deviceMarkers[deviceId]);
-                    map.removeLayer(deviceLabels[deviceId]);
-                    delete deviceMarkers[deviceId];
-                    delete deviceLabels[deviceId];
-                }
+                removeDevice(deviceId);
                 
                 alert('تم حذف الجهاز بنجاح');
                 updateDevices();
@@ -599,7 +1535,7 @@ HTML_TEMPLATE = """
 
     document.addEventListener('DOMContentLoaded', () => {
         initMap();
-        setInterval(updateDevices, 3000);
+        showView();
 
         const adminBtn = document.getElementById('admin-btn');
         const passcodePopup = document.getElementById('passcode-popup');
@@ -622,7 +1558,7 @@ HTML_TEMPLATE = """
                 passcodePopup.style.display = 'none';
                 adminBtn.style.display = 'none';
                 passcodeError.style.display = 'none';
-                updateDevices();
+                loadDeviceDirectory();
             } else {
                 passcodeError.style.display = 'block';
             }
@@ -641,7 +1577,7 @@ HTML_TEMPLATE = """
 
         showNamesBtn.addEventListener('click', () => {
             document.getElementById('device-names-panel').style.display = 'block';
-            updateDevices();
+            loadDeviceDirectory();
         });
 
         locateMeBtn.addEventListener('click', locateUser);
@@ -657,41 +1593,98 @@ HTML_TEMPLATE = """
 </html>
 """
 
+# الصفحة تترجم مرة واحدة عند التشغيل، وتضغط نسخها مسبقاً
+PAGE = StaticAsset(app.jinja_env.from_string(HTML_TEMPLATE).render(
+    cluster_max_zoom=CLUSTER_MAX_ZOOM, tile_url=TILE_URL).encode(), 'text/html')
+for encoding in (['br', 'gzip'] if brotli else ['gzip']):
+    PAGE.get(encoding)
+
+# مكتبات Leaflet وFont Awesome تخدم محلياً؛ المسار يحمل رقم الإصدار لذلك تخزن بلا انتهاء
+VENDOR_DIR = os.path.join(app.root_path, 'static', 'vendor')
+vendor_assets = {}
+vendor_lock = threading.Lock()
+
+
 @app.route('/', methods=['GET', 'POST'])
 def handle_requests():
     if request.method == 'POST':
         return update_device()
-    return render_template_string(HTML_TEMPLATE)
+    return PAGE.response('no-cache')
+
+@app.route('/vendor/<path:filename>', methods=['GET'])
+def vendor_file(filename):
+    if not filename.endswith(('.js', '.css')):
+        # الخطوط والصور مضغوطة أصلاً
+        response = send_from_directory(VENDOR_DIR, filename, max_age=31536000)
+        response.cache_control.immutable = True
+        return response
+    with vendor_lock:
+        asset = vendor_assets.get(filename)
+        if asset is None:
+            path = safe_join(VENDOR_DIR, filename)
+            if path is None or not os.path.isfile(path):
+                abort(404)
+            with open(path, 'rb') as f:
+                asset = vendor_assets[filename] = StaticAsset(f.read(), mimetypes.guess_type(path)[0])
+    return asset.response('public, max-age=31536000, immutable')
+
+def throttled(retry):
+    # رد جاهز دون قراءة الجسم أو فكه
+    response = Response(THROTTLED_BODY, status=429, mimetype='application/json')
+    response.headers['Retry-After'] = retry_after(retry)
+    return response
 
 @app.route('/update', methods=['GET', 'POST'])
 def update_device():
+    # الجهاز الذي يرسل معرفه في الرابط (?id=) أو الترويسة X-Device-Id يرفض قبل قراءة الجسم
+    device_id = request.args.get('id') or request.headers.get('X-Device-Id')
+    if device_id:
+        retry = throttle(device_id, 'update')
+        if retry:
+            return throttled(retry)
     try:
         data = request.get_json(silent=True) or request.form or request.args
-        device_id = data.get('id')
-        lat = data.get('lat')
-        lon = data.get('lon')
-        if not all([device_id, lat, lon]):
+        if not all([data.get('id'), data.get('lat'), data.get('lon')]):
+            parse_failures.inc((('source', 'update'),))
             return jsonify({'status': 'error', 'message': 'يجب إرسال معرف الجهاز والإحداثيات'}), 400
-        if devices[device_id]['custom_name'] is None:
-            devices[device_id]['custom_name'] = device_id
-        
-        # الحصول على الوقت الحالي بتوقيت UTC وإضافة معلومات المنطقة الزمنية
-        now_utc = datetime.utcnow()
-        devices[device_id].update({
-            'lat': float(lat),
-            'lon': float(lon),
-            'timestamp': data.get('timestamp'),
-            'battery': data.get('batt'),
-            'speed': data.get('speed'),
-            'accuracy': data.get('accuracy'),
-            'last_update': now_utc.isoformat() + 'Z'  # ISO format with Z for UTC
-        })
-        print(f"تم تحديث بيانات الجهاز {device_id}: ({lat}, {lon})")
+        if not device_id:
+            retry = throttle(str(data.get('id')), 'update')
+            if retry:
+                return throttled(retry)
+        apply_fix(data)
         return jsonify({'status': 'success'})
     except Exception as e:
-        print(f"خطأ في معالجة البيانات: {str(e)}")
+        parse_failures.inc((('source', 'update'),))
+        log.exception('خطأ في معالجة البيانات', extra={'fields': {'event': 'update_error'}})
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+@app.route('/update_batch', methods=['POST'])
+def update_batch():
+    # استقبال دفعة من الإشارات المخزنة لدى الأجهزة أثناء انقطاع الاتصال
+    # الدفعات تعوض انقطاعاً فلا يطبق عليها حد الجهاز، بل الحد العام فقط
+    retry = throttle(None, 'batch')
+    if retry:
+        return throttled(retry)
+    try:
+        payload = None
+        if request.mimetype not in NDJSON_TYPES:
+            payload = request.get_json(silent=True)
+        items = batch_items(payload, request.get_data(as_text=True))
+        if not items:
+            return jsonify({'status': 'error', 'message': 'الدفعة فارغة'}), 400
+        return jsonify({'status': 'success', **apply_batch(items)})
+    except Exception as e:
+        log.exception('خطأ في معالجة الدفعة', extra={'fields': {'event': 'batch_error'}})
         return jsonify({'status': 'error', 'message': str(e)}), 400
 
+@app.route('/update_binary', methods=['POST'])
+def update_binary():
+    retry = throttle(None, 'binary')
+    if retry:
+        return throttled(retry)
+    status, result = apply_binary(request.get_data())
+    return jsonify(result), status
+
 @app.route('/rename_device', methods=['POST'])
 def rename_device():
     try:
@@ -700,15 +1693,38 @@ def rename_device():
         new_name = data.get('new_name')
         if not device_id or not new_name:
             return jsonify({'success': False, 'message': 'بيانات ناقصة'}), 400
-        if device_id in devices:
-            devices[device_id]['custom_name'] = new_name
-            print(f"تم تغيير اسم الجهاز {device_id} إلى {new_name}")
+        if store.rename(device_id, new_name):
+            log.info('تم تغيير اسم الجهاز', extra={'fields': {
+                'event': 'rename', 'device_id': device_id, 'new_name': new_name}})
             return jsonify({'success': True})
         return jsonify({'success': False, 'message': 'الجهاز غير موجود'}), 404
-    except Exception as e:
-        print(f"خطأ في تغيير الاسم: {str(e)}")
+    except Exception:
+        log.exception('خطأ في تغيير الاسم', extra={'fields': {'event': 'rename_error'}})
+        return jsonify({'success': False, 'message': 'حدث خطأ في الخادم'}), 500
+
+@app.route('/set_group', methods=['POST'])
+def set_device_group():
+    # {"device_id", "group"}؛ مجموعة فارغة أو null تخرج الجهاز من مجموعته
+    try:
+        data = request.get_json()
+        device_id = data.get('device_id')
+        group = data.get('group') or None
+        if not device_id or not (group is None or isinstance(group, str) and len(group) <= 100):
+            return jsonify({'success': False, 'message': 'بيانات ناقصة'}), 400
+        if store.set_group(device_id, group):
+            log.info('تم تغيير مجموعة الجهاز', extra={'fields': {
+                'event': 'set_group', 'device_id': device_id, 'group': group}})
+            return jsonify({'success': True})
+        return jsonify({'success': False, 'message': 'الجهاز غير موجود'}), 404
+    except Exception:
+        log.exception('خطأ في تغيير المجموعة', extra={'fields': {'event': 'set_group_error'}})
         return jsonify({'success': False, 'message': 'حدث خطأ في الخادم'}), 500
 
+@app.route('/groups', methods=['GET'])
+def list_groups():
+    # {المجموعة: عدد أجهزتها}
+    return jsonify({'success': True, 'groups': store.groups()})
+
 @app.route('/delete_device', methods=['POST'])
 def delete_device():
     try:
@@ -717,19 +1733,223 @@ def delete_device():
         if not device_id:
             return jsonify({'success': False, 'message': 'بيانات ناقصة'}), 400
         
-        if device_id in devices:
-            del devices[device_id]
-            print(f"تم حذف الجهاز {device_id} بنجاح")
+        if store.delete(device_id):
+            if motion:
+                motion.forget(device_id)
+            geofences.forget(device_id)
+            trips.forget(device_id)
+            log.info('تم حذف الجهاز', extra={'fields': {'event': 'delete', 'device_id': device_id}})
             return jsonify({'success': True})
         
         return jsonify({'success': False, 'message': 'الجهاز غير موجود'}), 404
-    except Exception as e:
-        print(f"خطأ في حذف الجهاز: {str(e)}")
+    except Exception:
+        log.exception('خطأ في حذف الجهاز', extra={'fields': {'event': 'delete_error'}})
         return jsonify({'success': False, 'message': 'حدث خطأ في الخادم'}), 500
 
+@app.route('/geofences', methods=['GET'])
+def list_geofences():
+    return jsonify({'success': True, 'geofences': geofences.all()})
+
+@app.route('/geofences', methods=['POST'])
+def save_geofence():
+    # إنشاء منطقة أو استبدالها: {"id"?, "name", "polygon": [[lat, lon], ...]} أو
+    # {"id"?, "name", "circle": {"lat", "lon", "radius"}} (نصف القطر بالأمتار)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'message': 'بيانات ناقصة'}), 400
+    try:
+        fence = geofences.put(Fence.from_dict(data))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    log.info('تم حفظ منطقة جغرافية', extra={'fields': {'event': 'geofence_saved', 'fence_id': fence.id}})
+    return jsonify({'success': True, 'geofence': fence.to_dict()})
+
+@app.route('/geofences/<fence_id>', methods=['DELETE'])
+def delete_geofence(fence_id):
+    if geofences.delete(fence_id):
+        log.info('تم حذف منطقة جغرافية', extra={'fields': {'event': 'geofence_deleted', 'fence_id': fence_id}})
+        return jsonify({'success': True})
+    return jsonify({'success': False, 'message': 'المنطقة غير موجودة'}), 404
+
+@app.route('/geofences/events', methods=['GET'])
+def geofence_events():
+    # أحداث الدخول والخروج بعد المؤشر since؛ المؤشر المعاد يرسل في الطلب التالي
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(int(request.args.get('limit', 1000)), 10000)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'معاملات غير صالحة'}), 400
+    return jsonify(geofences.events_since(since, limit))
+
 @app.route('/get_devices', methods=['GET'])
 def get_devices():
-    return jsonify(devices)
+    # ?since=<cursor> يعيد الأجهزة التي تغيرت بعد المؤشر مع المحذوفة والمؤشر الجديد
+    # ?bbox=minLon,minLat,maxLon,maxLat يقصر النتيجة على الأجهزة داخل حدود العرض
+    # ?group= أجهزة مجموعة واحدة فقط (كلفة القراءة بحجم المجموعة لا الأسطول)
+    since = request.args.get('since', type=int)
+    group = request.args.get('group') or None
+    try:
+        bbox = BBox.parse(request.args['bbox']) if request.args.get('bbox') else None
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if since is None and bbox is None:
+        return snapshot_response(group)
+    return jsonify(view_delta(-1 if since is None else since, bbox, group))
+
+def snapshot_response(group=None):
+    cache = snapshots
+    if group is not None:
+        cache = group_snapshots.get(group)
+        if cache is None:
+            if len(group_snapshots) >= MAX_GROUP_SNAPSHOTS:
+                group_snapshots.clear()
+            cache = group_snapshots.setdefault(group, SnapshotCache(group))
+    etag, _ = cache.get()
+    return cached_response(etag, lambda encoding: cache.get(encoding)[1], 'application/json', 'no-cache')
+
+@app.route('/clusters', methods=['GET'])
+def get_clusters():
+    # ?zoom=&bbox= يعيد مجموعات الأجهزة (العدد، المركز، النشطة/غير النشطة) لمستوى التكبير
+    zoom = request.args.get('zoom', type=int)
+    try:
+        bbox = BBox.parse(request.args.get('bbox', ''))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if zoom is None:
+        return jsonify({'status': 'error', 'message': 'يجب إرسال مستوى التكبير'}), 400
+    return jsonify({'zoom': zoom, 'clusters': store.cluster(bbox, min(zoom, CLUSTER_MAX_ZOOM))})
+
+def search_point():
+    # (lat, lon) من معاملات الطلب أو ValueError
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError('يجب إرسال lat و lon صالحين')
+    return lat, lon
+
+
+def search_results(lat, lon, found):
+    return jsonify({'lat': lat, 'lon': lon, 'devices': [
+        {'id': device_id, 'distance_m': round(distance, 1), **record} for device_id, distance, record in found]})
+
+@app.route('/nearest', methods=['GET'])
+def nearest_devices():
+    # ?lat=&lon=&k= أقرب k أجهزة (افتراضياً 10)؛ active_only=1 يستبعد غير النشطة (INACTIVE_THRESHOLD)
+    try:
+        lat, lon = search_point()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    k = request.args.get('k', 10, type=int)
+    if not 1 <= k <= 1000:
+        return jsonify({'status': 'error', 'message': 'k بين 1 و 1000'}), 400
+    active_only = request.args.get('active_only') in ('1', 'true')
+    return search_results(lat, lon, store.nearest(lat, lon, k, active_only))
+
+@app.route('/within', methods=['GET'])
+def devices_within():
+    # ?lat=&lon=&radius_m= كل الأجهزة داخل الدائرة من الأقرب (حتى limit، افتراضياً 1000)
+    try:
+        lat, lon = search_point()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    radius = request.args.get('radius_m', type=float)
+    if radius is None or not 0 < radius <= 20000000:
+        return jsonify({'status': 'error', 'message': 'يجب إرسال radius_m بالأمتار'}), 400
+    limit = max(1, min(request.args.get('limit', 1000, type=int), 10000))
+    active_only = request.args.get('active_only') in ('1', 'true')
+    return search_results(lat, lon, store.within(lat, lon, radius, active_only, limit))
+
+@app.route('/history', methods=['GET'])
+def device_history():
+    # مسار الجهاز خلال مدة زمنية: ?id=&from=&to= (افتراضياً آخر 24 ساعة)
+    device_id = request.args.get('id')
+    if not device_id:
+        return jsonify({'status': 'error', 'message': 'يجب إرسال معرف الجهاز'}), 400
+    if not history:
+        return jsonify({'status': 'error', 'message': 'سجل المواقع غير مفعل'}), 404
+    try:
+        to_ms = parse_time_ms(request.args.get('to'), int(time.time() * 1000))
+        from_ms = parse_time_ms(request.args.get('from'), to_ms - 24 * HOUR_MS)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'صيغة الوقت غير صالحة'}), 400
+    rows = history.query(device_id, from_ms, to_ms)
+    zoom = request.args.get('zoom', type=int)
+    if zoom is None:
+        return jsonify({'id': device_id, 'points': [point_to_dict(row) for row in rows]})
+    # ?zoom= مسار مبسط لمستوى التكبير (انحراف بكسل واحد على الأكثر) لا يزيد عن max_points نقطة
+    max_points = max(10, min(request.args.get('max_points', 5000, type=int), 50000))
+    points, tolerance = simplifier.simplify(device_id, rows, max(0, min(zoom, MAX_ZOOM)), max_points)
+    return jsonify({'id': device_id, 'zoom': zoom, 'tolerance_m': round(tolerance, 2), 'total': len(rows),
+                    'points': [point_to_dict(row) for row in points]})
+
+@app.route('/history/export', methods=['GET'])
+def export_history():
+    # ?format=geojson|gpx|csv&id=&from=&to= مسارات جهاز أو أكثر (id يمكن تكراره) أو كل الأسطول
+    # يبث الرد مقطعاً بعد مقطع ويضغط بـ gzip إذا قبله العميل، فلا تكبر ذاكرة العامل مع المدة
+    fmt = request.args.get('format', 'geojson')
+    if fmt not in FORMATS:
+        return jsonify({'status': 'error', 'message': 'صيغة غير معروفة (geojson أو gpx أو csv)'}), 400
+    if not history:
+        return jsonify({'status': 'error', 'message': 'سجل المواقع غير مفعل'}), 404
+    try:
+        to_ms = parse_time_ms(request.args.get('to'), int(time.time() * 1000))
+        from_ms = parse_time_ms(request.args.get('from'), to_ms - 24 * HOUR_MS)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'صيغة الوقت غير صالحة'}), 400
+    if from_ms > to_ms:
+        return jsonify({'status': 'error', 'message': 'from بعد to'}), 400
+    mimetype, extension = FORMATS[fmt]
+    compress = request.accept_encodings['gzip'] > 0
+    tracks = history.export(request.args.getlist('id'), from_ms, to_ms)
+    # content_type لا mimetype: الأخير يضيف charset ثانياً إلى text/csv; charset=utf-8
+    response = Response(stream_export(tracks, fmt, compress), content_type=mimetype)
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Content-Disposition'] = f'attachment; filename=history-{from_ms // 1000}-{to_ms // 1000}.{extension}'
+    return response
+
+@app.route('/stats', methods=['GET'])
+def trip_stats():
+    # إحصاءات النافذة الحالية: ?window=day|shift (افتراضياً day) و ?id= لجهاز واحد (يمكن تكراره)
+    window = trips.window(request.args.get('window', 'day'))
+    if window is None:
+        return jsonify({'status': 'error', 'message': 'نافذة غير معروفة (day أو shift)'}), 400
+    device_ids = request.args.getlist('id') or None
+    start, end, devices = trips.report(window, time.time(), device_ids)
+    return jsonify({'window': window.name, 'start': iso_time(start), 'end': iso_time(end), 'devices': devices})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # القيم خاصة بعامل gunicorn الحالي؛ Prometheus يجمعها عبر التسمية instance
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stream', methods=['GET'])
+def stream():
+    # بث مباشر (Server-Sent Events) للتغييرات بدلاً من الاستطلاع كل 3 ثوانٍ
+    # عند إعادة الاتصال يرسل المتصفح Last-Event-ID فنستأنف من نفس المؤشر
+    # تحت WSGI يحجز كل مشترك خيطاً طوال اتصاله؛ الخادم الافتراضي asgi.py لا يحجز خيوطاً
+    resume = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        session = StreamSession(resume, request.args.get('bbox'), request.args.get('group'))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'معاملات غير صالحة'}), 400
+
+    if store.shared:
+        ensure_pump()
+
+    def generate():
+        yield b'retry: 3000\n\n'
+        yield session.snapshot()
+        while True:
+            chunk = session.chunk(*session.feed.wait(session.cursor, STREAM_HEARTBEAT))
+            if chunk:
+                yield chunk
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(session.close)
+    return response
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,414 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+import io
+import json
+import os
+import sys
+import time
+
+from app import (NDJSON_TYPES, STREAM_HEARTBEAT, THROTTLED_BODY, THROTTLED_MESSAGE, StreamSession, app,
+                 apply_batch, apply_binary, apply_fix, batch_items, ensure_pump, feed, log, parse_failures,
+                 request_latency, request_size, response_size, responses_total, retry_after, store,
+                 throttle)
+
+# وضع التشغيل الافتراضي (Procfile): خادم غير متزامن (ASGI) بنفس المسارات وصيغ JSON:
+#   uvicorn asgi:application --host 0.0.0.0 --port 8000
+# مع gunicorn (WSGI) يحجز كل اتصال /stream خيطاً طوال مدة بقائه، فعدد اللوحات المتصلة
+# لا يتجاوز --threads لكل عامل وتنتظر /update خلفها؛ هنا لا يحجز المشترك أي خيط
+# /update و /update_batch و /stream تستقبل في حلقة الأحداث نفسها، فالعميل البطيء على شبكة
+# الجوال لا يحجز خيطاً أثناء رفع الطلب أو انتظار الأحداث، و /ws يستقبل إشارات الجهاز عبر
+# اتصال WebSocket واحد طويل؛ الإشارة الواحدة تطبق في الحلقة، والدفعات واللقطات الكاملة في
+# مجموعة الخيوط (offload)؛ بقية المسارات تمرر إلى تطبيق Flask نفسه في مجموعة خيوط محدودة
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get('ASGI_THREADS', 32)))
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'websocket':
+        if scope['path'] == '/ws':
+            await websocket(scope, receive, send)
+        else:
+            await send({'type': 'websocket.close', 'code': 1008})
+    else:
+        handler = ROUTES.get((scope['method'], scope['path']))
+        if handler is None or mimetype(scope).startswith('multipart/'):
+            await wsgi(scope, receive, send)
+        else:
+            await handler(scope, receive, send)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def run(fn, *args):
+    # للأعمال القصيرة (إشارة واحدة): في حلقة الأحداث مباشرة مع MemoryStore؛ المخزن المشترك
+    # (SQLite) قد ينتظر القفل، فلا يستدعى من حلقة الأحداث
+    if store.shared:
+        return await offload(fn, *args)
+    return fn(*args)
+
+
+async def offload(fn, *args):
+    # الأعمال التي تكبر مع حجم الطلب أو الأسطول (الدفعات، اللقطة الكاملة) في مجموعة الخيوط دائماً،
+    # وإلا توقفت كل الاتصالات الأخرى حتى تنتهي
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+def header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def mimetype(scope):
+    return (header(scope, b'content-type') or '').split(';')[0].strip().lower()
+
+
+def is_json(kind):
+    # نفس شرط request.get_json في Flask
+    return kind == 'application/json' or kind.startswith('application/') and kind.endswith('+json')
+
+
+def first_values(text):
+    # مثل request.args.get في Flask: أول قيمة لكل مفتاح
+    values = {}
+    for key, value in parse_qsl(text, keep_blank_values=True):
+        values.setdefault(key, value)
+    return values
+
+
+def dumps(data):
+    # نفس ترميز jsonify حتى تبقى الردود مطابقة لخادم Flask حرفياً
+    return app.json.dumps(data, separators=(',', ':')) + '\n'
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def respond(scope, send, started, status, data, received):
+    body = dumps(data).encode()
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+    observe(scope['path'], started, status, received, len(body))
+
+
+async def reject(scope, send, started, retry, received=0):
+    # 429 بنفس رد Flask؛ الجسم لا يقرأ إذا عرف الجهاز من الرابط أو الترويسة
+    await send({'type': 'http.response.start', 'status': 429, 'headers': [
+        (b'content-type', b'application/json'), (b'content-length', str(len(THROTTLED_BODY)).encode()),
+        (b'retry-after', retry_after(retry).encode())]})
+    await send({'type': 'http.response.body', 'body': THROTTLED_BODY})
+    observe(scope['path'], started, 429, received, len(THROTTLED_BODY))
+
+
+def observe(route, started, status, received, sent):
+    # نفس مقاييس record_metrics في app.py للمسارات التي لا تمر عبر Flask
+    labels = (('route', route),)
+    request_latency.observe(labels, time.perf_counter() - started)
+    if received:
+        request_size.observe(labels, received)
+    if sent is not None:
+        response_size.observe(labels, sent)
+    responses_total.inc((('route', route), ('status', status)))
+
+
+async def update(scope, receive, send):
+    started = time.perf_counter()
+    device_id = first_values(scope['query_string'].decode('latin-1')).get('id') or header(scope, b'x-device-id')
+    if device_id:
+        retry = throttle(device_id, 'update')
+        if retry:
+            await reject(scope, send, started, retry)
+            return
+    body = await read_body(receive)
+    if body is None:
+        return
+    kind = mimetype(scope)
+    data = None
+    if is_json(kind):
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+    if not data and kind == 'application/x-www-form-urlencoded':
+        data = first_values(body.decode('utf-8', 'replace'))
+    if not data:
+        data = first_values(scope['query_string'].decode('latin-1'))
+    try:
+        if not all([data.get('id'), data.get('lat'), data.get('lon')]):
+            parse_failures.inc((('source', 'update'),))
+            await respond(scope, send, started, 400,
+                          {'status': 'error', 'message': 'يجب إرسال معرف الجهاز والإحداثيات'}, len(body))
+            return
+        if not device_id:
+            retry = throttle(str(data.get('id')), 'update')
+            if retry:
+                await reject(scope, send, started, retry, len(body))
+                return
+        await run(apply_fix, data)
+        status, result = 200, {'status': 'success'}
+    except Exception as e:
+        parse_failures.inc((('source', 'update'),))
+        log.exception('خطأ في معالجة البيانات', extra={'fields': {'event': 'update_error'}})
+        status, result = 400, {'status': 'error', 'message': str(e)}
+    await respond(scope, send, started, status, result, len(body))
+
+
+async def update_batch(scope, receive, send):
+    started = time.perf_counter()
+    retry = throttle(None, 'batch')
+    if retry:
+        await reject(scope, send, started, retry)
+        return
+    body = await read_body(receive)
+    if body is None:
+        return
+    try:
+        status, result = await offload(ingest_batch, mimetype(scope), body)
+    except Exception as e:
+        log.exception('خطأ في معالجة الدفعة', extra={'fields': {'event': 'batch_error'}})
+        status, result = 400, {'status': 'error', 'message': str(e)}
+    await respond(scope, send, started, status, result, len(body))
+
+
+async def update_binary(scope, receive, send):
+    started = time.perf_counter()
+    retry = throttle(None, 'binary')
+    if retry:
+        await reject(scope, send, started, retry)
+        return
+    body = await read_body(receive)
+    if body is None:
+        return
+    status, result = await offload(apply_binary, body)
+    await respond(scope, send, started, status, result, len(body))
+
+
+def ingest_batch(kind, body):
+    payload = None
+    if kind not in NDJSON_TYPES and is_json(kind):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = None
+    items = batch_items(payload, body.decode('utf-8', 'replace'))
+    if not items:
+        return 400, {'status': 'error', 'message': 'الدفعة فارغة'}
+    return 200, {'status': 'success', **apply_batch(items)}
+
+
+class FeedWaker:
+    # feed يعمل بالخيوط؛ هذا يوقظ كل مشتركي البث في حلقة الأحداث عند نشر أي حدث
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+        feed.watchers.append(self.notify)
+
+    def notify(self):
+        self.loop.call_soon_threadsafe(self.wake)
+
+    def wake(self):
+        event, self.event = self.event, asyncio.Event()
+        event.set()
+
+
+wakers = {}
+
+
+async def stream(scope, receive, send):
+    started = time.perf_counter()
+    if await read_body(receive) is None:
+        return
+    query = first_values(scope['query_string'].decode('latin-1'))
+    try:
+        session = StreamSession(header(scope, b'last-event-id') or query.get('since'), query.get('bbox'),
+                                query.get('group'))
+    except ValueError:
+        await respond(scope, send, started, 400, {'status': 'error', 'message': 'معاملات غير صالحة'}, 0)
+        return
+    disconnected = None
+    try:
+        if store.shared:
+            ensure_pump()
+        loop = asyncio.get_running_loop()
+        waker = wakers.get(loop) or wakers.setdefault(loop, FeedWaker(loop))
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+        observe(scope['path'], started, 200, 0, None)
+        await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n' + await offload(session.snapshot),
+                    'more_body': True})
+        disconnected = asyncio.ensure_future(receive())
+        while not disconnected.done():
+            event = waker.event
+            with session.feed.cond:
+                frames, cursor = session.feed.frames_after(session.cursor)
+            if frames == []:
+                woken = asyncio.ensure_future(event.wait())
+                await asyncio.wait({woken, disconnected}, timeout=STREAM_HEARTBEAT,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                woken.cancel()
+                with session.feed.cond:
+                    frames, cursor = session.feed.frames_after(session.cursor)
+            chunk = await run(session.chunk, frames, cursor)
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        if disconnected is not None:
+            disconnected.cancel()
+        session.close()
+
+
+async def websocket(scope, receive, send):
+    # اتصال دائم لكل جهاز: كل رسالة نصية إشارة (كائن JSON) أو دفعة (مصفوفة أو {"fixes": [...]}
+    # أو NDJSON)، والرد على كل رسالة بنفس صيغة /update أو /update_batch؛ والرسائل الثنائية
+    # إطارات wire.py بنفس رد /update_binary
+    # /ws?id=<المعرف> يغني الجهاز عن تكرار معرفه في كل رسالة
+    device_id = first_values(scope['query_string'].decode('latin-1')).get('id')
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    await send({'type': 'websocket.accept'})
+    while True:
+        message = await receive()
+        if message['type'] == 'websocket.disconnect':
+            return
+        try:
+            text = message.get('text')
+            if text is not None:
+                # كائن واحد في سطر واحد يقرأ في الحلقة؛ المصفوفة و NDJSON تقرأ في مجموعة الخيوط
+                stripped = text.strip()
+                single = stripped[:1] == '{' and '\n' not in stripped
+                reply, items = await (run if single else offload)(read_message, text, device_id)
+                if items is not None:
+                    reply = {'status': 'success', **await offload(apply_batch, items, 'websocket')}
+            else:
+                reply = (await offload(apply_binary, message.get('bytes') or b'', 'websocket'))[1]
+        except Exception as e:
+            log.exception('خطأ في معالجة البيانات', extra={'fields': {'event': 'websocket_error'}})
+            reply = {'status': 'error', 'message': str(e)}
+        await send({'type': 'websocket.send', 'text': dumps(reply)})
+
+
+def read_message(text, device_id):
+    # (الرد، None) لإشارة واحدة بعد تطبيقها، أو (None، العناصر) لدفعة يطبقها المستدعي
+    try:
+        payload = json.loads(text)
+    except ValueError:
+        payload = None
+    if isinstance(payload, dict) and 'fixes' not in payload:
+        if device_id:
+            payload.setdefault('id', device_id)
+        retry = throttle(str(payload.get('id')), 'websocket')
+        if retry:
+            # لا ترويسات في WebSocket؛ مدة الانتظار في الرد نفسه
+            return {'status': 'error', 'message': THROTTLED_MESSAGE, 'retry_after': int(retry_after(retry))}, None
+        try:
+            apply_fix(payload, 'websocket')
+        except (TypeError, ValueError) as e:
+            parse_failures.inc((('source', 'websocket'),))
+            return {'status': 'error', 'message': str(e)}, None
+        return {'status': 'success'}, None
+    items = batch_items(payload, text)
+    if not items:
+        return {'status': 'error', 'message': 'الدفعة فارغة'}, None
+    if device_id:
+        for item in items:
+            if isinstance(item, dict):
+                item.setdefault('id', device_id)
+    return None, items
+
+
+async def wsgi(scope, receive, send):
+    # بقية المسارات عبر Flask في مجموعة الخيوط بعد استلام جسم الطلب كاملاً
+    body = await read_body(receive)
+    if body is None:
+        return
+    loop = asyncio.get_running_loop()
+    head = []
+
+    def start_response(status, headers, exc_info=None):
+        head[:] = [int(status.split(' ', 1)[0]),
+                   [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]]
+
+    chunks = await loop.run_in_executor(executor, app, wsgi_environ(scope, body), start_response)
+    try:
+        await send({'type': 'http.response.start', 'status': head[0], 'headers': head[1]})
+        # كل مقطع يحسب في مجموعة الخيوط: الردود المتدفقة (التصدير) تقرأ الملفات وتضغط أثناء
+        # التكرار، ولو تم ذلك هنا لتوقفت حلقة الأحداث وكل الاتصالات حتى ينتهي التصدير
+        iterator = iter(chunks)
+        while True:
+            chunk = await loop.run_in_executor(executor, next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        value = value.decode('latin-1')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+ROUTES = {
+    ('GET', '/update'): update,
+    ('POST', '/update'): update,
+    ('POST', '/update_batch'): update_batch,
+    ('POST', '/update_binary'): update_binary,
+    ('GET', '/stream'): stream,
+}
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run('asgi:application', host='0.0.0.0', port=int(os.environ.get('PORT', 8000)))
@@ -0,0 +1,144 @@
+import fcntl
+import gc
+import json
+import logging
+import os
+import threading
+import time
+
+# نسخة دورية من حالة الأجهزة في المخزن داخل العملية (MemoryStore) حتى لا تفرغ الخريطة
+# وتضيع الأسماء المخصصة بعد كل نشر أو انهيار
+#   PATH         لقطة كاملة: سطر {"cursor": N} ثم أسطر {معرف: سجل} بألف جهاز في كل سطر حتى لا يحجز
+#                فك سطر واحد ضخم خيوط الاستقبال؛ تكتب في ملف مؤقت ثم os.replace
+#   PATH.delta   سطر JSON لكل دورة بالتغييرات منذ الدورة السابقة فقط (changes_since)
+# عندما يكبر ملف التغييرات تعاد كتابة اللقطة الكاملة ويفرغ؛ أسطر التغييرات الأقدم من مؤشر
+# اللقطة تتجاهل عند الاستعادة، فالانهيار بين الخطوتين لا يعيد حالة قديمة
+# مع عدة عمال يكتب عامل واحد فقط (من يحصل على قفل PATH.lock) وكلهم يستعيدون
+log = logging.getLogger('tracker')
+
+
+class Checkpoint:
+    def __init__(self, path, interval=30.0, compact_ratio=0.5):
+        self.path = path
+        self.delta_path = path + '.delta'
+        self.interval = interval
+        self.compact_ratio = compact_ratio   # نسبة حجم التغييرات إلى اللقطة قبل إعادة كتابتها
+        self.cursor = None                   # مؤشر المخزن عند آخر حفظ
+        self.lease = None
+        self.restored = False                # لا حفظ قبل انتهاء الاستعادة حتى لا تغطى النسخة بحالة ناقصة
+
+    def load(self):
+        # (الأجهزة، المؤشر) من اللقطة ثم أسطر التغييرات الأحدث منها
+        devices = {}
+        try:
+            with open(self.path, 'rb') as f:
+                cursor = json.loads(f.readline())['cursor']
+                for line in f:
+                    devices.update(json.loads(line))
+        except FileNotFoundError:
+            return {}, 0
+        try:
+            with open(self.delta_path, 'rb') as f:
+                for line in f:
+                    try:
+                        delta = json.loads(line)
+                    except ValueError:
+                        break   # سطر أخير لم يكتمل قبل الانهيار
+                    if delta['cursor'] <= cursor:
+                        continue
+                    devices.update(delta['devices'])
+                    for device_id in delta['deleted']:
+                        devices.pop(device_id, None)
+                    cursor = delta['cursor']
+        except FileNotFoundError:
+            pass
+        return devices, cursor
+
+    def restore(self, store):
+        started = time.perf_counter()
+        # مئات آلاف الكائنات الجديدة تطلق جمع الدورات الكامل مراراً، وكل جمع يوقف الإشارات
+        # الواردة مئات الأجزاء من الثانية؛ يوقف أثناء الاستعادة ثم تجمد الحالة المستعادة
+        # (طويلة العمر) حتى لا يعيد فحصها بعد ذلك
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            try:
+                devices, cursor = self.load()
+            except (OSError, ValueError, KeyError, TypeError):
+                # نسخة تالفة: نبدأ بحالة فارغة وتستبدلها أول دورة حفظ
+                log.exception('تعذرت قراءة النسخة المحفوظة', extra={'fields': {'event': 'checkpoint_error'}})
+                self.restored = True
+                return
+            store.restore(devices, cursor)
+        finally:
+            gc.freeze()
+            if collecting:
+                gc.enable()
+        self.restored = True
+        log.info('تمت استعادة حالة الأجهزة', extra={'fields': {
+            'event': 'checkpoint_restore', 'devices': len(devices),
+            'seconds': round(time.perf_counter() - started, 3)}})
+
+    def acquire(self):
+        # قفل يبقى مفتوحاً طوال عمر العملية؛ يحرره النظام تلقائياً عند خروجها
+        lease = open(self.path + '.lock', 'w')
+        try:
+            fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lease.close()
+            return False
+        self.lease = lease
+        return True
+
+    def save(self, store):
+        if self.lease is None or not self.restored:
+            return
+        if self.cursor is not None and store.cursor() == self.cursor:
+            return
+        delta = store.changes_since(self.cursor if self.cursor is not None else -1)
+        if delta['full'] or self._needs_compaction():
+            # اللقطة تكتب كاملة دائماً، لا التغييرات وحدها، لأن ملف التغييرات يفرغ بعدها
+            if not delta['full']:
+                delta = store.changes_since(-1)
+            self._write_base(delta['cursor'], delta['devices'])
+        elif delta['devices'] or delta['deleted']:
+            line = json.dumps(delta, separators=(',', ':')).encode() + b'\n'
+            with open(self.delta_path, 'ab') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        self.cursor = delta['cursor']
+
+    def _needs_compaction(self):
+        try:
+            return os.path.getsize(self.delta_path) > self.compact_ratio * os.path.getsize(self.path)
+        except FileNotFoundError:
+            return not os.path.exists(self.path)
+
+    def _write_base(self, cursor, devices, chunk=1000):
+        tmp = self.path + '.tmp'
+        items = list(devices.items())
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps({'cursor': cursor}).encode() + b'\n')
+            for start in range(0, len(items), chunk):
+                f.write(json.dumps(dict(items[start:start + chunk]), separators=(',', ':')).encode() + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        with open(self.delta_path, 'wb'):
+            pass
+
+    def run(self, store):
+        self.restore(store)
+        while True:
+            time.sleep(self.interval)
+            try:
+                # إذا توقف العامل الكاتب يتولى الكتابة أول عامل يحصل على القفل بعده
+                if self.lease is not None or self.acquire():
+                    self.save(store)
+            except Exception:
+                log.exception('تعذر حفظ حالة الأجهزة', extra={'fields': {'event': 'checkpoint_error'}})
+
+    def start(self, store):
+        # الاستعادة في الخلفية: /update يعمل فوراً والإشارات الجديدة تتقدم على المحفوظة
+        threading.Thread(target=self.run, args=(store,), daemon=True).start()
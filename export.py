@@ -0,0 +1,93 @@
+import csv
+import io
+import json
+import zlib
+from xml.sax.saxutils import escape
+
+from history import point_to_dict
+
+# تصدير السجل التاريخي (HistoryLog.export) إلى GeoJSON أو GPX أو CSV كسلسلة مولدات: كل
+# مرحلة تستهلك مقطعاً وتخرج مقطعاً، فلا يبنى الملف كاملاً في الذاكرة مهما كبر
+# المسار يقسم بالساعة: معلم (Feature) في GeoJSON ومسار (trk) في GPX لكل جهاز في كل ساعة
+FORMATS = {
+    'geojson': ('application/geo+json', 'geojson'),
+    'gpx': ('application/gpx+xml', 'gpx'),
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+}
+CSV_FIELDS = ('id', 'time', 'lat', 'lon', 'battery', 'speed', 'accuracy')
+
+
+def geojson(tracks):
+    yield '{"type":"FeatureCollection","features":['
+    separator = ''
+    for device_id, rows in tracks:
+        points = [point_to_dict(row) for row in rows]
+        coordinates = [[point['lon'], point['lat']] for point in points]
+        geometry = ({'type': 'LineString', 'coordinates': coordinates} if len(coordinates) > 1
+                    else {'type': 'Point', 'coordinates': coordinates[0]})
+        feature = {'type': 'Feature', 'geometry': geometry, 'properties': {
+            'id': device_id,
+            'times': [point['time'] for point in points],
+            'battery': [point['battery'] for point in points],
+            'speed': [point['speed'] for point in points],
+        }}
+        yield separator + json.dumps(feature, ensure_ascii=False, separators=(',', ':'))
+        separator = ','
+    yield ']}\n'
+
+
+def gpx(tracks):
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<gpx version="1.1" creator="FethiGPS" xmlns="http://www.topografix.com/GPX/1/1">\n')
+    for device_id, rows in tracks:
+        parts = [f'<trk><name>{escape(device_id)}</name><trkseg>']
+        for row in rows:
+            point = point_to_dict(row)
+            parts.append(f'<trkpt lat="{point["lat"]}" lon="{point["lon"]}"><time>{point["time"]}</time></trkpt>')
+        parts.append('</trkseg></trk>\n')
+        yield ''.join(parts)
+    yield '</gpx>\n'
+
+
+def csv_lines(tracks):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS)
+    writer.writeheader()
+    for device_id, rows in tracks:
+        for row in rows:
+            writer.writerow({'id': device_id, **point_to_dict(row)})
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+WRITERS = {'geojson': geojson, 'gpx': gpx, 'csv': csv_lines}
+
+
+def encode(chunks, size=64 * 1024):
+    # يجمع المقاطع الصغيرة (مسار جهاز واحد) في كتل بحجم size قبل إرسالها
+    pending, length = [], 0
+    for chunk in chunks:
+        pending.append(chunk.encode())
+        length += len(pending[-1])
+        if length >= size:
+            yield b''.join(pending)
+            pending, length = [], 0
+    if pending:
+        yield b''.join(pending)
+
+
+def gzipped(blocks, level=6):
+    # ضغط gzip أثناء الإرسال؛ الكتل التي لم تكمل مخرجاً تبقى داخل الضاغط
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(tracks, fmt, compress=False):
+    blocks = encode(WRITERS[fmt](tracks))
+    return gzipped(blocks) if compress else blocks
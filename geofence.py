@@ -0,0 +1,221 @@
+from collections import defaultdict, deque
+from datetime import datetime
+import fcntl
+import json
+import logging
+import math
+import os
+import secrets
+import threading
+import time
+
+from spatial import EARTH_RADIUS, distance_m
+
+# المناطق الجغرافية (مضلعات ودوائر) وأحداث دخول الأجهزة إليها وخروجها منها
+# كل منطقة تسجل في خلايا شبكة (درجات ثابتة) تغطي حدودها، فكل إشارة تقارن فقط بالمناطق
+# المسجلة في خليتها؛ المناطق الواسعة جداً في قائمة منفصلة تفحص بحدودها أولاً
+# المناطق تحفظ في ملف JSON مشترك بين العمال، ويعاد تحميله عند تغيره
+log = logging.getLogger('tracker')
+
+
+class Fence:
+    def __init__(self, fence_id, name=None, polygon=None, circle=None):
+        self.id = str(fence_id)
+        self.name = name or self.id
+        self.polygon = None
+        self.circle = None
+        if polygon is not None:
+            try:
+                points = [(float(lat), float(lon)) for lat, lon in polygon]
+            except (TypeError, ValueError):
+                raise ValueError('المضلع يجب أن يكون قائمة [lat, lon]')
+            if len(points) < 3:
+                raise ValueError('المضلع يحتاج ثلاث نقاط على الأقل')
+            if not all(-90 <= lat <= 90 and -180 <= lon <= 180 for lat, lon in points):
+                raise ValueError('إحداثيات غير صالحة')
+            self.polygon = points
+            lats = [lat for lat, _ in points]
+            lons = [lon for _, lon in points]
+            self.bounds = (min(lats), min(lons), max(lats), max(lons))
+        elif circle is not None:
+            try:
+                lat, lon, radius = float(circle['lat']), float(circle['lon']), float(circle['radius'])
+            except (KeyError, TypeError, ValueError):
+                raise ValueError('الدائرة تحتاج lat و lon و radius (بالأمتار)')
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180 and 0 < radius <= 1e6):
+                raise ValueError('إحداثيات أو نصف قطر غير صالح')
+            self.circle = (lat, lon, radius)
+            dlat = math.degrees(radius / EARTH_RADIUS)
+            dlon = min(dlat / max(math.cos(math.radians(lat)), 1e-6), 180.0)
+            self.bounds = (lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+        else:
+            raise ValueError('يجب إرسال polygon أو circle')
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('id') or secrets.token_hex(6), data.get('name'),
+                   data.get('polygon'), data.get('circle'))
+
+    def to_dict(self):
+        data = {'id': self.id, 'name': self.name}
+        if self.polygon is not None:
+            data['polygon'] = [list(point) for point in self.polygon]
+        else:
+            lat, lon, radius = self.circle
+            data['circle'] = {'lat': lat, 'lon': lon, 'radius': radius}
+        return data
+
+    def contains(self, lat, lon):
+        min_lat, min_lon, max_lat, max_lon = self.bounds
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        if self.circle is not None:
+            return distance_m(self.circle[0], self.circle[1], lat, lon) <= self.circle[2]
+        # ray casting
+        inside = False
+        points = self.polygon
+        lat_j, lon_j = points[-1]
+        for lat_i, lon_i in points:
+            if (lat_i > lat) != (lat_j > lat) and lon < (lon_j - lon_i) * (lat - lat_i) / (lat_j - lat_i) + lon_i:
+                inside = not inside
+            lat_j, lon_j = lat_i, lon_i
+        return inside
+
+
+class Geofences:
+    def __init__(self, path, cell=0.1, max_cells=256, max_events=10000):
+        self.path = path
+        self.cell = cell
+        self.max_cells = max_cells          # المناطق التي تغطي خلايا أكثر تفحص دائماً
+        self.lock = threading.Lock()
+        self.fences = {}
+        self.cells = defaultdict(list)      # (x, y) -> [المناطق]
+        self.large = []
+        self.inside = {}                    # معرف الجهاز -> معرفات المناطق التي بداخلها
+        self.events = deque(maxlen=max_events)
+        self.seq = 0
+        self.mtime = None
+        self.checked = 0.0
+        self._reload()
+
+    def _key(self, lat, lon):
+        return math.floor(lon / self.cell), math.floor(lat / self.cell)
+
+    def _index(self, fences):
+        cells = defaultdict(list)
+        large = []
+        for fence in fences.values():
+            min_lat, min_lon, max_lat, max_lon = fence.bounds
+            x0, y0 = self._key(min_lat, min_lon)
+            x1, y1 = self._key(max_lat, max_lon)
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > self.max_cells:
+                large.append(fence)
+                continue
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    cells[(x, y)].append(fence)
+        self.fences, self.cells, self.large = fences, cells, large
+        for ids in self.inside.values():
+            ids.intersection_update(fences)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                fences = {fence.id: fence for fence in map(Fence.from_dict, json.load(f))}
+                return fences, os.fstat(f.fileno()).st_mtime_ns
+        except FileNotFoundError:
+            return {}, None
+
+    def _reload(self):
+        if not self.path:
+            return
+        fences, self.mtime = self._read()
+        self._index(fences)
+
+    def _refresh(self):
+        # عامل آخر قد يكون عدل الملف؛ فحص واحد في الثانية على الأكثر
+        now = time.monotonic()
+        if not self.path or now - self.checked < 1:
+            return
+        self.checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self.mtime:
+            self._reload()
+
+    def _modify(self, change):
+        # قراءة أحدث نسخة وتعديلها وكتابتها تحت قفل حتى لا يضيع تعديل عامل آخر
+        with self.lock:
+            if not self.path:
+                fences = dict(self.fences)
+                result = change(fences)
+                self._index(fences)
+                return result
+            with open(self.path + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                fences, _ = self._read()
+                result = change(fences)
+                tmp = self.path + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump([fence.to_dict() for fence in fences.values()], f, ensure_ascii=False)
+                os.replace(tmp, self.path)
+                self.mtime = os.stat(self.path).st_mtime_ns
+                self._index(fences)
+                return result
+
+    def put(self, fence):
+        def change(fences):
+            fences[fence.id] = fence
+        self._modify(change)
+        return fence
+
+    def delete(self, fence_id):
+        return self._modify(lambda fences: fences.pop(fence_id, None) is not None)
+
+    def all(self):
+        with self.lock:
+            self._refresh()
+            return [fence.to_dict() for fence in self.fences.values()]
+
+    def check(self, device_id, lat, lon, ts_ms):
+        # يقارن الإشارة بالمناطق المرشحة فقط ويسجل أحداث الدخول والخروج
+        with self.lock:
+            self._refresh()
+            if not self.fences:
+                if self.inside:
+                    self.inside.clear()
+                return []
+            candidates = self.cells.get(self._key(lat, lon), ())
+            now_inside = {fence.id for fence in candidates if fence.contains(lat, lon)}
+            now_inside.update(fence.id for fence in self.large if fence.contains(lat, lon))
+            was_inside = self.inside.get(device_id, set())
+            if now_inside == was_inside:
+                return []
+            if now_inside:
+                self.inside[device_id] = now_inside
+            else:
+                self.inside.pop(device_id, None)
+            time_text = datetime.utcfromtimestamp(ts_ms / 1000).isoformat() + 'Z'
+            emitted = []
+            for kind, ids in (('exit', was_inside - now_inside), ('enter', now_inside - was_inside)):
+                for fence_id in sorted(ids):
+                    self.seq += 1
+                    event = {'id': self.seq, 'type': kind, 'device_id': device_id, 'fence_id': fence_id,
+                             'name': self.fences[fence_id].name, 'lat': lat, 'lon': lon, 'time': time_text}
+                    self.events.append(event)
+                    emitted.append(event)
+        for event in emitted:
+            log.info('حدث منطقة جغرافية', extra={'fields': {'event': 'geofence_' + event['type'], **{
+                key: event[key] for key in ('device_id', 'fence_id', 'lat', 'lon', 'time')}}})
+        return emitted
+
+    def forget(self, device_id):
+        with self.lock:
+            self.inside.pop(device_id, None)
+
+    def events_since(self, since, limit=1000):
+        with self.lock:
+            events = [event for event in self.events if event['id'] > since][:limit]
+            return {'cursor': events[-1]['id'] if events else self.seq, 'events': events}
@@ -0,0 +1,278 @@
+from collections import defaultdict
+from datetime import datetime
+from queue import Queue, Empty, Full
+import fcntl
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+# سجل المواقع على القرص مقسم إلى ملفات بالساعة (UTC):
+#   <hour>.<pid>.raw  ملف إلحاق فقط يكتبه كل عامل بالترتيب الذي تصل به الإشارات
+#   <hour>.seg        ملف مضغوط بعد انتهاء الساعة: سجلات مرتبة حسب الجهاز ثم الوقت
+#                     يليها فهرس JSON {الجهاز: [الإزاحة، العدد]} وطوله (uint32)
+HOUR_MS = 3600 * 1000
+RAW = struct.Struct('<Hqiifff')    # طول المعرف، الوقت (ms)، خط العرض والطول (×1e6)، البطارية، السرعة، الدقة
+POINT = struct.Struct('<qiifff')   # نفس الحقول بدون المعرف داخل الملفات المضغوطة
+TRAILER = struct.Struct('<I')
+
+log = logging.getLogger('tracker')
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def from_float(value):
+    return None if math.isnan(value) else round(value, 3)
+
+
+class HistoryLog:
+    def __init__(self, path, queue_size=100000, compact_every=600):
+        self.path = path
+        self.queue = Queue(maxsize=queue_size)
+        self.compact_every = compact_every
+        self.dropped = 0
+        self.started = False
+        self.start_lock = threading.Lock()
+
+    def append(self, device_id, ts_ms, record):
+        # لا يكتب شيئاً على القرص في مسار الطلب: الترميز والكتابة في خيط خلفي
+        if not self.started:
+            self._start()
+        try:
+            self.queue.put_nowait((device_id, ts_ms, record))
+        except Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self.start_lock:
+            if not self.started:
+                os.makedirs(self.path, exist_ok=True)
+                threading.Thread(target=self._run, daemon=True).start()
+                self.started = True
+
+    def _run(self):
+        pid = os.getpid()
+        files = {}
+        next_compact = time.monotonic() + self.compact_every
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.compact_every)]
+            except Empty:
+                batch = []
+            try:
+                while len(batch) < 5000:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            chunks = defaultdict(list)
+            for device_id, ts_ms, record in batch:
+                key = str(device_id).encode()
+                try:
+                    chunks[ts_ms // HOUR_MS].append(RAW.pack(
+                        len(key), ts_ms,
+                        round(record['lat'] * 1e6), round(record['lon'] * 1e6),
+                        to_float(record.get('battery')), to_float(record.get('speed')),
+                        to_float(record.get('accuracy'))) + key)
+                except (struct.error, ValueError, OverflowError):
+                    self.dropped += 1
+            try:
+                current = int(time.time() * 1000) // HOUR_MS
+                for hour in [h for h in files if h < current - 1]:
+                    files.pop(hour).close()
+                late = {}
+                for hour, parts in chunks.items():
+                    if hour < current - 1:
+                        late[hour] = parts
+                        continue
+                    handle = files.get(hour)
+                    if handle is None:
+                        handle = files[hour] = open(os.path.join(self.path, f'{hour}.{pid}.raw'), 'ab')
+                    handle.write(b''.join(parts))
+                    handle.flush()
+                if late:
+                    self._append_late(pid, late)
+                if time.monotonic() >= next_compact:
+                    next_compact = time.monotonic() + self.compact_every
+                    self.compact(current - 1)
+            except Exception:
+                log.exception('خطأ في كتابة سجل المواقع', extra={'fields': {'event': 'history_error'}})
+
+    def _append_late(self, pid, chunks):
+        # إشارات متأخرة (أعيد إرسالها) لساعات قد يضغطها عامل آخر: تكتب تحت القفل المشترك وفي ملف
+        # يفتح ويغلق معها، وإلا قرأ الضغط الملف ثم حذفه بعد الإلحاق فضاعت النقاط
+        with open(os.path.join(self.path, '.compact.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            for hour, parts in chunks.items():
+                with open(os.path.join(self.path, f'{hour}.{pid}.raw'), 'ab') as f:
+                    f.write(b''.join(parts))
+
+    def _segments(self, first_hour, last_hour):
+        compacted, raw = {}, defaultdict(list)
+        for name in os.listdir(self.path):
+            parts = name.split('.')
+            if not parts[0].isdigit() or not first_hour <= int(parts[0]) <= last_hour:
+                continue
+            if parts[-1] == 'seg':
+                compacted[int(parts[0])] = os.path.join(self.path, name)
+            elif parts[-1] == 'raw':
+                raw[int(parts[0])].append(os.path.join(self.path, name))
+        return compacted, raw
+
+    def compact(self, before_hour):
+        # دمج ملفات الإلحاق لكل ساعة منتهية (مع أي ملف مضغوط سابق لها) في ملف واحد مرتب ومفهرس
+        # القفل يمنع عاملين من ضغط نفس الساعة في الوقت نفسه
+        with open(os.path.join(self.path, '.compact.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            compacted, raw = self._segments(0, before_hour - 1)
+            for hour, raw_files in raw.items():
+                points = defaultdict(list)
+                if hour in compacted:
+                    for device_id, rows in read_segment(compacted[hour]):
+                        points[device_id].extend(rows)
+                for raw_file in raw_files:
+                    for device_id, row in read_raw(raw_file):
+                        points[device_id].append(row)
+                write_segment(os.path.join(self.path, f'{hour}.seg'), points)
+                for raw_file in raw_files:
+                    os.remove(raw_file)
+
+    def query(self, device_id, from_ms, to_ms):
+        # يقرأ الملفات التي تغطي المدة المطلوبة فقط، والملفات المضغوطة عبر الفهرس مباشرة
+        if not os.path.isdir(self.path):
+            return []
+        device_id = str(device_id)
+        compacted, raw = self._segments(from_ms // HOUR_MS, to_ms // HOUR_MS)
+        rows = []
+        for hour in sorted(set(compacted) | set(raw)):
+            # تحت القفل المشترك مثل export، حتى لا يحذف الضغط ملفات الساعة بين قراءة المجلد وفتحها
+            segment, pending = self._open_hour(hour, {device_id})
+            if segment is not None:
+                with segment, mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    index = segment_index(data)
+                    if device_id in index:
+                        offset, count = index[device_id]
+                        rows.extend(POINT.iter_unpack(data[offset:offset + count * POINT.size]))
+            rows.extend(pending.get(device_id, ()))
+        rows = [row for row in rows if from_ms <= row[0] <= to_ms]
+        rows.sort(key=lambda row: row[0])
+        return rows
+
+    def export(self, device_ids, from_ms, to_ms):
+        # (الجهاز، نقاطه مرتبة) ساعة بعد ساعة ثم جهازاً بعد جهاز داخل الساعة، لكل الأجهزة أو
+        # device_ids فقط؛ لا يحمل في الذاكرة أكثر من ساعة واحدة مهما طالت المدة
+        if not os.path.isdir(self.path):
+            return
+        wanted = set(map(str, device_ids)) if device_ids else None
+        compacted, raw = self._segments(from_ms // HOUR_MS, to_ms // HOUR_MS)
+        for hour in sorted(set(compacted) | set(raw)):
+            segment, pending = self._open_hour(hour, wanted)
+            if segment is None:
+                index, data = {}, b''
+            else:
+                with segment:
+                    data = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+                index = segment_index(data)
+            try:
+                for device_id in sorted(set(index if wanted is None else wanted & index.keys()) | set(pending)):
+                    rows = []
+                    if device_id in index:
+                        offset, count = index[device_id]
+                        rows.extend(POINT.iter_unpack(data[offset:offset + count * POINT.size]))
+                    rows.extend(pending.pop(device_id, ()))
+                    rows = sorted(row for row in rows if from_ms <= row[0] <= to_ms)
+                    if rows:
+                        yield device_id, rows
+            finally:
+                if segment is not None:
+                    data.close()
+
+    def _open_hour(self, hour, wanted):
+        # لقطة متسقة لساعة واحدة: الملف المضغوط يفتح وملفات الإلحاق تقرأ تحت قفل مشترك، فلا
+        # يدمجها الضغط بين القراءتين فتتكرر النقاط أو تضيع؛ القراءة بعد ذلك من الملف المفتوح
+        # تبقى صحيحة حتى لو استبدل
+        pending = defaultdict(list)
+        with open(os.path.join(self.path, '.compact.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            compacted, raw = self._segments(hour, hour)
+            segment = None
+            try:
+                if hour in compacted:
+                    segment = open(compacted[hour], 'rb')
+                for raw_file in raw.get(hour, []):
+                    for device_id, row in read_raw(raw_file):
+                        if wanted is None or device_id in wanted:
+                            pending[device_id].append(row)
+            except FileNotFoundError:
+                # حذفه ضغط سابق بعد قراءة المجلد في export؛ محتواه صار في الملف المضغوط
+                pass
+        return segment, pending
+
+
+def read_raw(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset, end = 0, len(data)
+    while offset + RAW.size <= end:
+        key_len, *row = RAW.unpack_from(data, offset)
+        offset += RAW.size
+        if offset + key_len > end:
+            break  # سجل غير مكتمل في نهاية الملف
+        yield data[offset:offset + key_len].decode(), tuple(row)
+        offset += key_len
+
+
+def read_segment(path, device_id=None):
+    # قراءة ملف مضغوط عبر mmap؛ مع تحديد جهاز تقرأ شريحة سجلاته فقط
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        index = segment_index(data)
+        if device_id is not None:
+            if device_id not in index:
+                return []
+            offset, count = index[device_id]
+            return list(POINT.iter_unpack(data[offset:offset + count * POINT.size]))
+        return [(key, list(POINT.iter_unpack(data[offset:offset + count * POINT.size])))
+                for key, (offset, count) in index.items()]
+
+
+def segment_index(data):
+    index_len, = TRAILER.unpack_from(data, len(data) - TRAILER.size)
+    return json.loads(data[len(data) - TRAILER.size - index_len:len(data) - TRAILER.size])
+
+
+def write_segment(path, points):
+    index = {}
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        offset = 0
+        for device_id in sorted(points):
+            rows = sorted(points[device_id])
+            f.write(b''.join(POINT.pack(*row) for row in rows))
+            index[device_id] = [offset, len(rows)]
+            offset += len(rows) * POINT.size
+        encoded = json.dumps(index, separators=(',', ':')).encode()
+        f.write(encoded + TRAILER.pack(len(encoded)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def point_to_dict(row):
+    ts_ms, lat, lon, battery, speed, accuracy = row
+    return {
+        'time': datetime.utcfromtimestamp(ts_ms / 1000).isoformat() + 'Z',
+        'lat': lat / 1e6,
+        'lon': lon / 1e6,
+        'battery': from_float(battery),
+        'speed': from_float(speed),
+        'accuracy': from_float(accuracy),
+    }
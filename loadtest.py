@@ -0,0 +1,402 @@
+import argparse
+import heapq
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import wire
+
+# اختبار حمل على الجهاز المحلي: أسطول من أجهزة التتبع يرسل إلى /update بمعدل محدد
+# ولوحات تحكم تستطلع /get_devices (أو تحمل الصفحة أو تبقى مشتركة في /stream)، ثم تحفظ
+# النتائج بصيغة JSON؛ الخادم الافتراضي هو خادم الإنتاج (uvicorn asgi:application كما في Procfile)
+# مثال:
+#   python loadtest.py --devices 2000 --rate 0.2 --dashboards 20 --duration 60 --workers 2
+#   python loadtest.py --dashboards 200 --dashboard-mode stream
+#   python loadtest.py --url http://127.0.0.1:8000 --devices 500   (خادم قائم مسبقاً)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='اختبار حمل خادم التتبع على localhost')
+    parser.add_argument('--url', help='خادم قائم مسبقاً؛ بدونه يشغل الاختبار خادمه الخاص')
+    parser.add_argument('--server', choices=['uvicorn', 'gunicorn', 'flask'], default='uvicorn')
+    parser.add_argument('--workers', type=int, default=1, help='عدد عمال uvicorn أو gunicorn')
+    parser.add_argument('--threads', type=int,
+                        help='خيوط كل عامل: --threads لـ gunicorn (افتراضياً 128) أو ASGI_THREADS لـ uvicorn')
+    parser.add_argument('--store', choices=['memory', 'sqlite'], default='memory')
+    parser.add_argument('--devices', type=int, default=1000, help='عدد أجهزة التتبع المحاكاة')
+    parser.add_argument('--rate', type=float, default=0.2, help='إشارات في الثانية لكل جهاز')
+    parser.add_argument('--protocol', choices=['json', 'binary'], default='json',
+                        help='json: POST /update  binary: POST /update_binary (wire.py)')
+    parser.add_argument('--senders', type=int, default=16, help='عدد الاتصالات المتوازية للأجهزة')
+    parser.add_argument('--dashboards', type=int, default=10, help='عدد لوحات التحكم المحاكاة')
+    parser.add_argument('--poll', type=float, default=3.0, help='فترة استطلاع كل لوحة بالثواني')
+    parser.add_argument('--dashboard-mode', choices=['delta', 'full', 'page', 'stream'], default='delta',
+                        help='delta: /get_devices?since  full: /get_devices كاملة  page: تحميل /  '
+                             'stream: اتصال /stream دائم (زمن اللقطة وتأخر الأحداث)')
+    parser.add_argument('--duration', type=float, default=30.0, help='مدة القياس بالثواني')
+    parser.add_argument('--warmup', type=float, default=5.0, help='مدة الإحماء قبل القياس')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench-results', help='مجلد ملفات النتائج')
+    return parser.parse_args()
+
+
+class Recorder:
+    # أزمنة الاستجابة لكل نوع طلب؛ ما يصل قبل بداية القياس (الإحماء) لا يحسب
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.lag = []
+        self.recording = False
+
+    def add(self, kind, seconds, ok=True):
+        if not self.recording:
+            return
+        with self.lock:
+            if ok:
+                self.latencies.setdefault(kind, []).append(seconds)
+            else:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def behind(self, seconds):
+        # تأخر الإرسال عن موعده: إذا كبر فالعميل نفسه لا يلحق بالمعدل المطلوب
+        if self.recording:
+            with self.lock:
+                self.lag.append(seconds)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(values, errors, duration):
+    return {
+        'requests': len(values),
+        'errors': errors,
+        'throughput': round(len(values) / duration, 2),
+        'p50_ms': ms(percentile(values, 50)),
+        'p95_ms': ms(percentile(values, 95)),
+        'p99_ms': ms(percentile(values, 99)),
+        'max_ms': ms(max(values) if values else None),
+    }
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class Client:
+    # اتصال HTTP دائم (keep-alive) يعاد فتحه عند انقطاعه
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.conn.request(method, path, body, headers or {})
+                response = self.conn.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+
+class Tracker:
+    # حركة واقعية: اتجاه يتغير تدريجياً وسرعة بين المشي والسيارة، مع توقفات قصيرة
+    def __init__(self, device_id, rng, center):
+        self.id = device_id
+        self.rng = rng
+        self.lat = center[0] + rng.uniform(-0.5, 0.5)
+        self.lon = center[1] + rng.uniform(-0.5, 0.5)
+        self.heading = rng.uniform(0, 2 * math.pi)
+        self.speed = rng.choice([1.4, 8.0, 15.0, 25.0])   # م/ث
+        self.battery = rng.randint(20, 100)
+
+    def step(self, seconds):
+        rng = self.rng
+        self.heading += rng.gauss(0, 0.3)
+        speed = 0.0 if rng.random() < 0.1 else max(0.0, self.speed + rng.gauss(0, 1.0))
+        distance = speed * seconds
+        self.lat += distance * math.cos(self.heading) / 111320
+        self.lon += distance * math.sin(self.heading) / (111320 * max(0.1, math.cos(math.radians(self.lat))))
+        if rng.random() < 0.01:
+            self.battery = max(1, self.battery - 1)
+        return {
+            'id': self.id,
+            'lat': round(self.lat, 6),
+            'lon': round(self.lon, 6),
+            'batt': self.battery,
+            'speed': round(speed * 3.6, 1),
+            'accuracy': round(rng.uniform(3, 25), 1),
+        }
+
+
+def run_sender(client, trackers, rate, protocol, recorder, stop, rng):
+    # جدولة مفتوحة: لكل جهاز موعد إرسال ثابت، فتأخر الخادم لا يخفض الحمل المطلوب
+    interval = 1.0 / rate
+    start = time.perf_counter()
+    due = [(start + rng.uniform(0, interval), i) for i in range(len(trackers))]
+    heapq.heapify(due)
+    if protocol == 'binary':
+        path, headers = '/update_binary', {'Content-Type': 'application/octet-stream'}
+    else:
+        path, headers = '/update', {'Content-Type': 'application/json'}
+    while due and not stop.is_set():
+        when, i = heapq.heappop(due)
+        wait = when - time.perf_counter()
+        if wait > 0:
+            if stop.wait(wait):
+                break
+        else:
+            recorder.behind(-wait)
+        fix = trackers[i].step(interval)
+        body = wire.encode(fix['id'], [fix]) if protocol == 'binary' else json.dumps(fix)
+        began = time.perf_counter()
+        try:
+            status, _ = client.request('POST', path, body, headers)
+            recorder.add('update', time.perf_counter() - began, status == 200)
+        except (http.client.HTTPException, OSError):
+            recorder.add('update', 0, False)
+        heapq.heappush(due, (when + interval, i))
+
+
+def run_dashboard(client, mode, poll, recorder, stop, rng):
+    cursor = -1
+    stop.wait(rng.uniform(0, poll))
+    while not stop.is_set():
+        began = time.perf_counter()
+        try:
+            if mode == 'page':
+                status, body = client.request('GET', '/')
+            elif mode == 'full':
+                status, body = client.request('GET', '/get_devices', headers={'Accept-Encoding': 'gzip'})
+            else:
+                status, body = client.request('GET', f'/get_devices?since={cursor}')
+                if status == 200:
+                    cursor = json.loads(body)['cursor']
+            recorder.add(mode, time.perf_counter() - began, status == 200)
+        except (http.client.HTTPException, OSError, ValueError, KeyError):
+            recorder.add(mode, 0, False)
+        stop.wait(max(0.0, poll - (time.perf_counter() - began)))
+
+
+def run_stream(host, port, recorder, stop, rng, streams):
+    # لوحة مشتركة في /stream طوال القياس: stream زمن اللقطة الأولى عند كل اتصال، و stream_lag
+    # تأخر كل حدث عن تطبيق الإشارة في الخادم (last_update، بنفس ساعة الجهاز)
+    stop.wait(rng.uniform(0, 1))
+    while not stop.is_set():
+        conn = http.client.HTTPConnection(host, port, timeout=60)
+        streams.append(conn)
+        began = time.perf_counter()
+        try:
+            conn.request('GET', '/stream')
+            response = conn.getresponse()
+            if response.status != 200:
+                raise http.client.HTTPException(f'HTTP {response.status}')
+            first = True
+            for line in response:
+                if not line.startswith(b'data: '):
+                    continue
+                delta = json.loads(line[6:])
+                if first:
+                    recorder.add('stream', time.perf_counter() - began)
+                    first = False
+                    continue
+                now = time.time()
+                lags = [now - utc_seconds(device['last_update']) for device in delta['devices'].values()
+                        if device.get('last_update')]
+                if lags:
+                    recorder.add('stream_lag', max(lags))
+        except (http.client.HTTPException, OSError, ValueError, KeyError):
+            if not stop.is_set():
+                recorder.add('stream', 0, False)
+        finally:
+            conn.close()
+
+
+def utc_seconds(value):
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, port, workdir):
+    env = dict(os.environ, DEVICE_STORE=args.store, DEVICE_DB=os.path.join(workdir, 'devices.db'),
+               HISTORY_DIR=os.path.join(workdir, 'history'), LOG_LEVEL='WARNING',
+               # كل ملفات الحالة في مجلد القياس: لا يستعيد الخادم أجهزة التشغيل الحقيقي أو مناطقه
+               # ولا يكتب فوق checkpoint.json و geofences.json في مجلد المشروع
+               CHECKPOINT_FILE=os.path.join(workdir, 'checkpoint.json'),
+               GEOFENCE_FILE=os.path.join(workdir, 'geofences.json'))
+    # القياس يقيس الخادم لا حد المعدل؛ يمكن تفعيله صراحة بتمرير RATE_LIMIT_DEVICE
+    env.setdefault('RATE_LIMIT_DEVICE', '0')
+    here = os.path.dirname(os.path.abspath(__file__))
+    if args.server == 'uvicorn':
+        # نفس أمر Procfile
+        if args.threads:
+            env['ASGI_THREADS'] = str(args.threads)
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1',
+                   '--port', str(port), '--workers', str(args.workers), '--log-level', 'warning',
+                   '--no-access-log']
+    elif args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+                   '--worker-class', 'gthread', '--workers', str(args.workers),
+                   '--threads', str(args.threads or 128), '--log-level', 'warning']
+    else:
+        command = [sys.executable, '-c',
+                   'import logging; logging.getLogger("werkzeug").setLevel(logging.ERROR); '
+                   f'from app import app; app.run(host="127.0.0.1", port={port}, threaded=True)']
+    process = subprocess.Popen(command, cwd=here, env=env, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit('تعذر تشغيل الخادم')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise SystemExit('الخادم لم يستجب خلال 30 ثانية')
+
+
+def server_rss(pid):
+    # الذاكرة المقيمة للخادم وكل عملياته الفرعية (عمال gunicorn) بالكيلوبايت؛ لينكس فقط
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pending.extend(int(child) for child in f.read().split())
+        except (OSError, StopIteration):
+            continue
+    return total or None
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    process = None
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    if args.url:
+        target = args.url.split('://', 1)[-1].rstrip('/')
+        host, _, port = target.partition(':')
+        port = int(port or 80)
+    else:
+        host, port = '127.0.0.1', free_port()
+        process = start_server(args, port, workdir)
+
+    try:
+        rss_before = server_rss(process.pid) if process else None
+        recorder = Recorder()
+        stop = threading.Event()
+        center = (36.75, 3.06)
+        trackers = [Tracker(f'bench-{i:06d}', random.Random(rng.random()), center) for i in range(args.devices)]
+        threads = []
+        senders = max(1, min(args.senders, args.devices))
+        for n in range(senders):
+            threads.append(threading.Thread(target=run_sender, daemon=True, args=(
+                Client(host, port), trackers[n::senders], args.rate, args.protocol, recorder, stop,
+                random.Random(rng.random()))))
+        streams = []
+        for n in range(args.dashboards):
+            if args.dashboard_mode == 'stream':
+                threads.append(threading.Thread(target=run_stream, daemon=True, args=(
+                    host, port, recorder, stop, random.Random(rng.random()), streams)))
+                continue
+            threads.append(threading.Thread(target=run_dashboard, daemon=True, args=(
+                Client(host, port), args.dashboard_mode, args.poll, recorder, stop, random.Random(rng.random()))))
+        for thread in threads:
+            thread.start()
+
+        time.sleep(args.warmup)
+        recorder.recording = True
+        began = time.perf_counter()
+        time.sleep(args.duration)
+        recorder.recording = False
+        elapsed = time.perf_counter() - began
+        stop.set()
+        for conn in list(streams):
+            # الاتصالات المفتوحة لا تنتهي وحدها؛ إغلاقها يوقف قراءتها
+            if conn.sock is not None:
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        for thread in threads:
+            thread.join(timeout=30)
+
+        rss_after = server_rss(process.pid) if process else None
+        results = {
+            'time': datetime.utcnow().isoformat() + 'Z',
+            'git': git_revision(),
+            'host': {'python': platform.python_version(), 'platform': platform.platform(),
+                     'cpus': os.cpu_count()},
+            'config': vars(args),
+            'offered_fixes_per_second': round(args.devices * args.rate, 2),
+            'duration': round(elapsed, 3),
+            'operations': {kind: summarize(values, recorder.errors.get(kind, 0), elapsed)
+                           for kind, values in sorted(recorder.latencies.items())},
+            'sender_lag_p99_ms': ms(percentile(recorder.lag, 99)),
+            'server_rss_kb': {'before': rss_before, 'after': rss_after},
+            'rss_per_device_bytes': (round((rss_after - rss_before) * 1024 / args.devices, 1)
+                                     if rss_before and rss_after and args.devices else None),
+        }
+        for kind in recorder.errors:
+            results['operations'].setdefault(kind, summarize([], recorder.errors[kind], elapsed))
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, datetime.utcnow().strftime('%Y%m%dT%H%M%SZ') + '.json')
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(json.dumps(results['operations'], indent=2))
+    print(f'rss/device: {results["rss_per_device_bytes"]} bytes, sender lag p99: {results["sender_lag_p99_ms"]} ms')
+    print(f'results: {path}')
+    # رمز خروج غير صفري عند وجود أخطاء ليفشل فحص التراجع في CI
+    return 1 if any(op['errors'] for op in results['operations'].values()) else 0
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import time
+import tracemalloc
+from datetime import datetime
+
+from loadtest import git_revision
+from spatial import CLUSTER_LEVELS, ClusterIndex, GridIndex
+from store import DeviceRecord, MemoryStore, iso_time
+
+# قياس ذاكرة حالة الأجهزة لكل جهاز: المخزن كاملاً (memory_store) هو الرقم الذي يهم، ومعه
+# أجزاؤه: السجلات المضغوطة (store.DeviceRecord، مقابل القاموس الذي كان يحفظ لكل جهاز)
+# والفهرس الشبكي وفهرس التجميع (مستوى لكل تكبير حتى CLUSTER_MAX_ZOOM)
+# مثال:
+#   python memtest.py --devices 100000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='قياس ذاكرة حالة الأجهزة في MemoryStore')
+    parser.add_argument('--devices', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench-results', help='مجلد ملفات النتائج')
+    return parser.parse_args()
+
+
+def fixes(count, seed):
+    # نفس حقول app.build_record لإشارة كاملة (بطارية وسرعة ودقة)
+    rng = random.Random(seed)
+    now = time.time()
+    return [(f'tracker-{n:06d}', {
+        'lat': rng.uniform(-60, 60), 'lon': rng.uniform(-180, 180), 'timestamp': None,
+        'battery': rng.randrange(101), 'speed': round(rng.uniform(0, 120), 1),
+        'accuracy': round(rng.uniform(3, 30), 1), 'updated': now - rng.uniform(0, 3600),
+    }) for n in range(count)]
+
+
+def as_dict(device_id, record):
+    # الصيغة السابقة: قاموس لكل جهاز بوقت ISO نصي
+    return {'custom_name': device_id, 'last_update': iso_time(record['updated']),
+            **{key: record[key] for key in ('lat', 'lon', 'timestamp', 'battery', 'speed', 'accuracy')}}
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        kept = build()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del kept
+    return size
+
+
+def main():
+    args = parse_args()
+    # المعرفات والإشارات تبنى قبل القياس فلا تحسب في أي من الصيغتين
+    items = fixes(args.devices, args.seed)
+
+    def build_store():
+        store = MemoryStore()
+        store.update_many(items)
+        return store
+
+    def build_grid():
+        index = GridIndex()
+        for device_id, record in items:
+            index.update(device_id, record['lat'], record['lon'])
+        return index
+
+    def build_clusters():
+        clusters = ClusterIndex(60, CLUSTER_LEVELS)
+        for device_id, record in items:
+            clusters.update(device_id, record['lat'], record['lon'], record['updated'])
+        return clusters
+
+    sizes = {
+        'dict_records': measure(lambda: {device_id: as_dict(device_id, record) for device_id, record in items}),
+        'compact_records': measure(lambda: {device_id: DeviceRecord.build(device_id, record)
+                                            for device_id, record in items}),
+        'grid_index': measure(build_grid),
+        'cluster_index': measure(build_clusters),
+        'memory_store': measure(build_store),
+    }
+    per_device = {name: round(size / args.devices, 1) for name, size in sizes.items()}
+    results = {
+        'time': datetime.utcnow().isoformat() + 'Z',
+        'git': git_revision(),
+        'host': {'python': platform.python_version(), 'platform': platform.platform()},
+        'config': vars(args),
+        'bytes_per_device': per_device,
+        'record_reduction': round(sizes['dict_records'] / sizes['compact_records'], 2),
+        'cluster_levels': CLUSTER_LEVELS,
+    }
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, 'memory-' + datetime.utcnow().strftime('%Y%m%dT%H%M%SZ') + '.json')
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(json.dumps(per_device, indent=2))
+    print(f'store: {per_device["memory_store"]} bytes/device '
+          f'(records {per_device["compact_records"]}, grid {per_device["grid_index"]}, '
+          f'clusters {per_device["cluster_index"]} at {CLUSTER_LEVELS} levels)')
+    print(f'records alone: {results["record_reduction"]}x smaller than dicts')
+    print(f'results: {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+from bisect import bisect_left
+import threading
+import time
+
+# مقاييس بصيغة Prometheus النصية بأقل كلفة ممكنة لكل طلب:
+# كل تسجيل هو قفل قصير وعملية bisect وزيادة عدد؛ التجميع يحدث عند القراءة فقط
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(labels)} {format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}  # labels -> [عدد كل فئة (غير تراكمي)، المجموع]
+
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in sorted(self.series.items())]
+        for labels, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else format_value(bound)
+                lines.append(f'{self.name}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(labels)} {cumulative}')
+        return lines
+
+
+class Gauge:
+    # قيمة تحسب عند القراءة فقط عبر دالة تعيد [(labels, value)]
+    def __init__(self, name, help_text, collect):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge']
+        for labels, value in self.collect():
+            lines.append(f'{self.name}{format_labels(labels)} {format_value(value)}')
+        return lines
+
+
+class RateMeter:
+    # معدل الأحداث في الثانية خلال آخر دقيقة بخانات من ثانية واحدة
+    def __init__(self, window=60):
+        self.window = window
+        self.lock = threading.Lock()
+        self.slots = [[0, 0] for _ in range(window)]  # [الثانية، العدد]
+
+    def mark(self, count=1):
+        second = int(time.time())
+        slot = self.slots[second % self.window]
+        with self.lock:
+            if slot[0] != second:
+                slot[0], slot[1] = second, 0
+            slot[1] += count
+
+    def rate(self):
+        now = int(time.time())
+        with self.lock:
+            total = sum(count for second, count in self.slots if now - second < self.window)
+        return total / self.window
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,75 @@
+import math
+import threading
+
+from spatial import distance_m
+
+# ترشيح الإشارات عند الاستقبال: جهاز متوقف يرسل نفس الموقع تقريباً كل بضع ثوانٍ، وكل إشارة
+# منها كانت تعيد كتابة السجل وترسل إلى كل اللوحات وتحفظ في السجل التاريخي
+# الإشارة التي لم تتحرك أبعد من دقتها المعلنة (accuracy) لا تنشر، ويحدث فيها last_update فقط؛
+# وتنشر إشارة واحدة على الأقل كل keepalive ثانية حتى تبقى اللوحات ترى الجهاز نشطاً
+
+
+class DeviceMotion:
+    __slots__ = ('lat', 'lon', 'published_at', 'smooth_lat', 'smooth_lon', 'variance', 'seen_at')
+
+    def __init__(self):
+        self.lat = None
+        self.lon = None
+        self.published_at = None
+        self.variance = -1.0
+        self.smooth_lat = self.smooth_lon = self.seen_at = None
+
+
+class MotionFilter:
+    def __init__(self, min_distance=5.0, keepalive=30.0, smoothing=False, process_noise=3.0):
+        self.min_distance = min_distance    # أمتار؛ أقل حركة تنشر إذا لم يرسل الجهاز دقته
+        self.keepalive = keepalive          # ثوانٍ
+        self.smoothing = smoothing
+        self.process_noise = process_noise  # م/ث: سرعة تغير الموقع الحقيقي المتوقعة
+        self.lock = threading.Lock()
+        self.devices = {}
+
+    def accept(self, device_id, record, now, fix_time):
+        # True: حركة حقيقية تنشر وتسجل؛ False: نفس المكان ضمن دقة القياس
+        # مع التنعيم تستبدل lat/lon في السجل بالقيمة المنعمة (fix_time وقت الإشارة من الجهاز
+        # حتى تنعم دفعات الإشارات المخزنة حسب توقيتها الحقيقي لا وقت وصولها)
+        accuracy = to_float(record.get('accuracy'))
+        with self.lock:
+            state = self.devices.get(device_id)
+            if state is None:
+                state = self.devices[device_id] = DeviceMotion()
+            if self.smoothing:
+                record['lat'], record['lon'] = self._smooth(state, record['lat'], record['lon'], accuracy, fix_time)
+            if state.published_at is not None and now - state.published_at < self.keepalive:
+                radius = max(self.min_distance, accuracy or 0.0)
+                if distance_m(state.lat, state.lon, record['lat'], record['lon']) <= radius:
+                    return False
+            state.lat, state.lon, state.published_at = record['lat'], record['lon'], now
+            return True
+
+    def _smooth(self, state, lat, lon, accuracy, now):
+        # مرشح كالمان بسيط بمتغير واحد للموقع: وزن كل إشارة حسب دقتها والوقت منذ السابقة
+        accuracy = max(accuracy or self.min_distance, 1.0)
+        if state.variance < 0:
+            state.smooth_lat, state.smooth_lon, state.variance = lat, lon, accuracy * accuracy
+        else:
+            elapsed = max(now - state.seen_at, 0.0)
+            state.variance += elapsed * self.process_noise * self.process_noise
+            gain = state.variance / (state.variance + accuracy * accuracy)
+            state.smooth_lat += gain * (lat - state.smooth_lat)
+            state.smooth_lon += gain * (lon - state.smooth_lon)
+            state.variance *= 1 - gain
+        state.seen_at = now
+        return round(state.smooth_lat, 7), round(state.smooth_lon, 7)
+
+    def forget(self, device_id):
+        with self.lock:
+            self.devices.pop(device_id, None)
+
+
+def to_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) and value >= 0 else None
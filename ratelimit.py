@@ -0,0 +1,66 @@
+from collections import Counter
+import threading
+
+# حدود معدل الإشارات بدلو رموز (token bucket): rate رمز في الثانية ويتجمع حتى burst
+# حد لكل جهاز يمنع جهازاً واحداً معطوباً من إغراق العمال، وحد عام لكل عملية يحمي الخادم كله
+
+
+class TokenBuckets:
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.buckets = {}   # المفتاح -> [الرموز المتبقية، وقت آخر حساب]
+
+    def take(self, key, now):
+        # 0 إذا سمح بالطلب، وإلا الثواني حتى يتوفر رمز
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_keys:
+                    self._prune(now)
+                bucket = self.buckets[key] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+            bucket[0] = tokens
+            return (1 - tokens) / self.rate
+
+    def _prune(self, now):
+        # الدلاء الممتلئة لا تختلف عن دلو جديد، فحذفها لا يغير شيئاً
+        full = [key for key, (tokens, last) in self.buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+        for key in full:
+            del self.buckets[key]
+
+
+class RateLimiter:
+    def __init__(self, device_rate, device_burst, global_rate=0, global_burst=0, max_offenders=10000):
+        self.devices = TokenBuckets(device_rate, device_burst) if device_rate > 0 else None
+        self.total = TokenBuckets(global_rate, global_burst) if global_rate > 0 else None
+        self.max_offenders = max_offenders
+        self.lock = threading.Lock()
+        self.offenders = Counter()   # معرف الجهاز -> عدد الإشارات المرفوضة
+
+    def check(self, device_id, now):
+        # (النطاق، ثواني الانتظار)؛ الانتظار 0 يعني أن الإشارة مقبولة
+        if self.total:
+            retry = self.total.take(None, now)
+            if retry:
+                return 'global', retry
+        if self.devices and device_id is not None:
+            retry = self.devices.take(device_id, now)
+            if retry:
+                with self.lock:
+                    self.offenders[device_id] += 1
+                    if len(self.offenders) > self.max_offenders:
+                        self.offenders = Counter(dict(self.offenders.most_common(self.max_offenders // 2)))
+                return 'device', retry
+        return None, 0
+
+    def top_offenders(self, count):
+        with self.lock:
+            return self.offenders.most_common(count)
@@ -0,0 +1,130 @@
+from collections import OrderedDict
+import heapq
+import math
+import threading
+
+from spatial import EARTH_RADIUS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# تبسيط المسار للعرض (Douglas-Peucker): بدلاً من تشغيل الخوارزمية لكل مستوى تكبير تحسب مرة
+# واحدة لكل مسار "أهمية" كل نقطة، وهي أكبر انحراف (بالأمتار) كانت النقطة ستحذف عند تجاوزه؛
+# مستوى التفصيل لأي تكبير بعد ذلك مجرد مقارنة الأهمية بالتسامح، والأهمية تحفظ في ذاكرة مؤقتة
+# مع NumPy تحسب مسافات كل مقطع دفعة واحدة، وبدونه حلقة بايثون بنفس النتيجة
+METERS_PER_PIXEL = 156543.03392   # متر لكل بكسل عند التكبير 0 على خط الاستواء (Web Mercator)
+PIXEL_TOLERANCE = 1.0             # أقصى انحراف مرئي بالبكسل
+MAX_ZOOM = 18                     # لا تقسم المقاطع تحت تسامح هذا المستوى
+VECTOR_SPAN = 64                  # المقاطع الأقصر تحسب بحلقة بايثون (كلفة استدعاء NumPy أكبر منها)
+
+
+def tolerance_m(zoom, lat):
+    return PIXEL_TOLERANCE * METERS_PER_PIXEL * math.cos(math.radians(lat)) / 2 ** zoom
+
+
+def project(rows):
+    # (x, y) بالأمتار حول خط العرض المتوسط؛ الصفوف بصيغة السجل (الوقت، lat×1e6، lon×1e6، ...)
+    lat0 = sum(row[1] for row in rows) / len(rows) / 1e6
+    lon0 = rows[0][2] / 1e6
+    scale = math.radians(1) * EARTH_RADIUS
+    x_scale = scale * math.cos(math.radians(lat0))
+    xs = [((row[2] / 1e6 - lon0 + 180) % 360 - 180) * x_scale for row in rows]
+    ys = [row[1] / 1e6 * scale for row in rows]
+    return lat0, xs, ys
+
+
+def importance(xs, ys, floor):
+    # أهمية كل نقطة؛ الطرفان لا نهائيان، وأهمية النقطة لا تتجاوز أهمية المقطع الذي قسمها حتى
+    # تبقى المستويات متداخلة (كل نقطة في تكبير منخفض موجودة في كل تكبير أعلى)
+    n = len(xs)
+    weights = [0.0] * n
+    weights[0] = weights[-1] = math.inf
+    if numpy is not None:
+        x_array, y_array = numpy.array(xs), numpy.array(ys)
+    stack = [(0, n - 1, math.inf)]
+    while stack:
+        first, last, limit = stack.pop()
+        if last - first < 2:
+            continue
+        if numpy is not None and last - first > VECTOR_SPAN:
+            middle, deviation = farthest_numpy(x_array, y_array, first, last)
+        else:
+            middle, deviation = farthest(xs, ys, first, last)
+        if deviation < floor:
+            continue
+        weight = min(deviation, limit)
+        weights[middle] = weight
+        stack.append((first, middle, weight))
+        stack.append((middle, last, weight))
+    return weights
+
+
+def farthest(xs, ys, first, last):
+    # (موضع أبعد نقطة عن القطعة first-last، بعدها)
+    x0, y0 = xs[first], ys[first]
+    dx, dy = xs[last] - x0, ys[last] - y0
+    length2 = dx * dx + dy * dy
+    best, best_distance = first + 1, -1.0
+    for i in range(first + 1, last):
+        px, py = xs[i] - x0, ys[i] - y0
+        if length2:
+            t = min(max((px * dx + py * dy) / length2, 0.0), 1.0)
+            px, py = px - t * dx, py - t * dy
+        distance = px * px + py * py
+        if distance > best_distance:
+            best, best_distance = i, distance
+    return best, math.sqrt(best_distance)
+
+
+def farthest_numpy(xs, ys, first, last):
+    x0, y0 = xs[first], ys[first]
+    dx, dy = xs[last] - x0, ys[last] - y0
+    px, py = xs[first + 1:last] - x0, ys[first + 1:last] - y0
+    length2 = dx * dx + dy * dy
+    if length2:
+        t = numpy.clip((px * dx + py * dy) / length2, 0.0, 1.0)
+        px, py = px - t * dx, py - t * dy
+    distances = px * px + py * py
+    i = int(distances.argmax())
+    return first + 1 + i, math.sqrt(distances[i])
+
+
+class TrackSimplifier:
+    def __init__(self, max_tracks=64):
+        self.max_tracks = max_tracks
+        self.lock = threading.Lock()
+        self.tracks = OrderedDict()   # (الجهاز، العدد، أول وقت، آخر وقت) -> (lat0، الأهمية)
+
+    def simplify(self, device_id, rows, zoom, max_points):
+        # الصفوف التي تظهر عند التكبير zoom، ولا تزيد عن max_points (يرفع التسامح إذا لزم)
+        if len(rows) <= 2:
+            return rows, 0.0
+        key = (device_id, len(rows), rows[0][0], rows[-1][0])
+        with self.lock:
+            cached = self.tracks.get(key)
+            if cached is not None:
+                self.tracks.move_to_end(key)
+        if cached is None:
+            lat0, xs, ys = project(rows)
+            weights = importance(xs, ys, tolerance_m(MAX_ZOOM, lat0))
+            if numpy is not None:
+                weights = numpy.array(weights)
+            cached = (lat0, weights)
+            with self.lock:
+                self.tracks[key] = cached
+                while len(self.tracks) > self.max_tracks:
+                    self.tracks.popitem(last=False)
+        lat0, weights = cached
+        tolerance = tolerance_m(zoom, lat0)
+        if max_points < len(rows):
+            # أهمية النقطة رقم max_points من الأعلى تصبح حداً أدنى للتسامح
+            if numpy is not None:
+                cutoff = float(numpy.partition(weights, len(rows) - max_points)[len(rows) - max_points])
+            else:
+                cutoff = heapq.nlargest(max_points, weights)[-1]
+            tolerance = max(tolerance, cutoff)
+        if numpy is not None:
+            return [rows[i] for i in numpy.flatnonzero(weights > tolerance)], tolerance
+        return [row for row, weight in zip(rows, weights) if weight > tolerance], tolerance
@@ -0,0 +1,294 @@
+from collections import defaultdict
+import heapq
+import math
+import struct
+
+# مستويات التكبير التي تحفظ لها مجموعات الأجهزة مسبقاً (0..CLUSTER_LEVELS-1)؛ app.py يمرر
+# CLUSTER_MAX_ZOOM + 1 لأن المستويات الأعلى لا تعرض أبداً وتكلف كل إشارة وذاكرة كل جهاز
+CLUSTER_LEVELS = 14
+EARTH_RADIUS = 6371000.0
+DEGREE_M = math.pi * EARTH_RADIUS / 180   # طول درجة عرض واحدة بالأمتار
+# حالة الجهاز في فهرس التجميع: lat، lon، نشط، آخر ظهور (58 بايت بدلاً من قائمة وثلاثة float)
+CLUSTER_DEVICE = struct.Struct('<dd?d')
+
+
+def cell_key(x, y):
+    # مفتاح الخلية (x, y) كعدد صحيح واحد (32 بايت بدلاً من 112 للـ tuple وعدديه)
+    return x << 32 | y & 0xFFFFFFFF
+
+
+def key_xy(key):
+    return key >> 32, (key & 0xFFFFFFFF ^ 0x80000000) - 0x80000000
+
+
+class BBox:
+    # مستطيل عرض الخريطة بصيغة minLon,minLat,maxLon,maxLat
+    # مع دعم المستطيلات التي تعبر خط الطول 180 عند تحريك الخريطة حول العالم
+    def __init__(self, min_lon, min_lat, max_lon, max_lat):
+        if not (min_lat <= max_lat and min_lon <= max_lon):
+            raise ValueError('حدود غير صالحة')
+        self.min_lat = max(min_lat, -90.0)
+        self.max_lat = min(max_lat, 90.0)
+        if max_lon - min_lon >= 360:
+            self.lon_ranges = [(-180.0, 180.0)]
+        else:
+            west = (min_lon + 180) % 360 - 180
+            east = (max_lon + 180) % 360 - 180
+            if west <= east:
+                self.lon_ranges = [(west, east)]
+            else:
+                self.lon_ranges = [(west, 180.0), (-180.0, east)]
+
+    @classmethod
+    def parse(cls, value):
+        try:
+            parts = [float(part) for part in value.split(',')]
+        except ValueError:
+            parts = []
+        if len(parts) != 4 or not all(map(math.isfinite, parts)):
+            raise ValueError('يجب إرسال أربع قيم: minLon,minLat,maxLon,maxLat')
+        return cls(*parts)
+
+    def contains(self, lat, lon):
+        if not self.min_lat <= lat <= self.max_lat:
+            return False
+        return any(west <= lon <= east for west, east in self.lon_ranges)
+
+
+class GridIndex:
+    # فهرس شبكي للمواقع الحالية: كل خلية (درجات ثابتة) تحمل أجهزتها
+    # التحديث O(1) لكل إشارة، والاستعلام يمر على الخلايا داخل المستطيل فقط
+    # الموقع يحفظ كعدد مركب lat+lon·j: كائن واحد بدلاً من tuple وعددين
+    def __init__(self, cell=0.05):
+        self.cell = cell
+        self.cells = defaultdict(dict)  # cell_key -> {معرف الجهاز: complex(lat, lon)}
+        self.where = {}                 # معرف الجهاز -> الخلية الحالية
+
+    def _key(self, lat, lon):
+        return cell_key(math.floor(lon / self.cell), math.floor(lat / self.cell))
+
+    def update(self, device_id, lat, lon):
+        key = self._key(lat, lon)
+        old = self.where.get(device_id)
+        if old is not None and old != key:
+            self._discard(old, device_id)
+        self.cells[key][device_id] = complex(lat, lon)
+        self.where[device_id] = key
+
+    def remove(self, device_id):
+        old = self.where.pop(device_id, None)
+        if old is not None:
+            self._discard(old, device_id)
+
+    def _discard(self, key, device_id):
+        cell = self.cells[key]
+        cell.pop(device_id, None)
+        if not cell:
+            del self.cells[key]
+
+    def query(self, bbox):
+        for key in cells_in(bbox, self.cell, self.cells):
+            for device_id, spot in self.cells[key].items():
+                if bbox.contains(spot.real, spot.imag):
+                    yield device_id
+
+    def nearest(self, lat, lon, k, accept=None):
+        # أقرب k أجهزة [(المسافة، المعرف)] بحلقات خلايا متسعة حول النقطة: بعد فحص الحلقة r كل
+        # جهاز لم يفحص أبعد من r خلية، فيتوقف البحث حين يكون أبعد المرشحين أقرب من ذلك؛
+        # accept(معرف) يستبعد أجهزة (غير النشطة مثلاً) دون أن تحسب ضمن k
+        cx, cy = math.floor(lon / self.cell), math.floor(lat / self.cell)
+        columns = round(360 / self.cell)
+        best = []   # كومة عظمى (-المسافة، المعرف) بحجم k
+
+        def scan(cell):
+            for device_id, spot in cell.items():
+                distance = distance_m(lat, lon, spot.real, spot.imag)
+                if len(best) == k:
+                    if distance >= -best[0][0] or accept is not None and not accept(device_id):
+                        continue
+                    heapq.heapreplace(best, (-distance, device_id))
+                elif accept is None or accept(device_id):
+                    heapq.heappush(best, (-distance, device_id))
+
+        def done(ring):
+            # أقرب ما يمكن أن يكون عليه جهاز خارج الحلقات 0..ring (الطول يقصر نحو القطبين)
+            reach = ring * self.cell * DEGREE_M * math.cos(math.radians(min(abs(lat) + (ring + 1) * self.cell, 90)))
+            return len(best) == k and -best[0][0] <= reach
+
+        ring = 0
+        while (2 * ring + 1) ** 2 <= len(self.cells) and 2 * ring < columns:
+            for key in ring_keys(cx, cy, ring, columns):
+                cell = self.cells.get(key)
+                if cell:
+                    scan(cell)
+            if done(ring):
+                return sorted((-distance, device_id) for distance, device_id in best)
+            ring += 1
+        # نقطة بعيدة عن الأجهزة (أو قرب القطب حيث تضيق الحلقات): بقية الخلايا المشغولة مرتبة
+        # حسب أقل مسافة ممكنة إليها بدلاً من حلقات فارغة
+        for gap, key in sorted((cell_gap(key, lat, lon, self.cell), key) for key in self.cells
+                               if ring_of(key, cx, cy, columns) >= ring):
+            if len(best) == k and -best[0][0] <= gap:
+                break
+            scan(self.cells[key])
+        return sorted((-distance, device_id) for distance, device_id in best)
+
+    def within(self, lat, lon, radius, accept=None):
+        # كل الأجهزة على بعد radius متر على الأكثر [(المسافة، المعرف)] مرتبة من الأقرب
+        dlat = radius / DEGREE_M
+        dlon = min(dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 90))), 1e-9), 360)
+        bbox = BBox(lon - dlon, lat - dlat, lon + dlon, lat + dlat)
+        found = []
+        for key in cells_in(bbox, self.cell, self.cells):
+            for device_id, spot in self.cells[key].items():
+                distance = distance_m(lat, lon, spot.real, spot.imag)
+                if distance <= radius and (accept is None or accept(device_id)):
+                    found.append((distance, device_id))
+        found.sort()
+        return found
+
+
+def ring_keys(cx, cy, ring, columns):
+    # الخلايا على بعد ring بالضبط (مسافة شيبيشيف) من الخلية (cx, cy) مع الالتفاف حول خط الطول 180
+    if ring == 0:
+        return [cell_key(cx, cy)]
+    keys = []
+    for x in range(cx - ring, cx + ring + 1):
+        keys.append(cell_key(wrap(x, columns), cy - ring))
+        keys.append(cell_key(wrap(x, columns), cy + ring))
+    for y in range(cy - ring + 1, cy + ring):
+        keys.append(cell_key(wrap(cx - ring, columns), y))
+        keys.append(cell_key(wrap(cx + ring, columns), y))
+    return keys
+
+
+def wrap(x, columns):
+    return (x + columns // 2) % columns - columns // 2
+
+
+def ring_of(key, cx, cy, columns):
+    x, y = key_xy(key)
+    dx = abs(x - cx) % columns
+    return max(min(dx, columns - dx), abs(y - cy))
+
+
+def cell_gap(key, lat, lon, cell):
+    # حد أدنى لـ distance_m من النقطة إلى أي موقع داخل الخلية
+    x, y = key_xy(key)
+    y0 = y * cell
+    dlat = max(y0 - lat, lat - y0 - cell, 0)
+    offset = (lon - x * cell) % 360
+    dlon = 0 if offset <= cell else min(offset - cell, 360 - offset)
+    mean = min((abs(lat) + max(abs(y0), abs(y0 + cell))) / 2, 90)
+    return math.hypot(math.radians(dlon) * math.cos(math.radians(mean)), math.radians(dlat)) * EARTH_RADIUS
+
+
+def cells_in(bbox, cell, occupied):
+    # مفاتيح الخلايا المشغولة التي تتقاطع مع المستطيل
+    y0, y1 = math.floor(bbox.min_lat / cell), math.floor(bbox.max_lat / cell)
+    keys = []
+    for west, east in bbox.lon_ranges:
+        x0, x1 = math.floor(west / cell), math.floor(east / cell)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(occupied):
+            # مستطيل واسع (تصغير كبير): المرور على الخلايا المشغولة أسرع
+            keys.extend(key for key in occupied if x0 <= key >> 32 <= x1 and y0 <= key_xy(key)[1] <= y1)
+        else:
+            keys.extend(key for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+                        for key in (x << 32 | y & 0xFFFFFFFF,) if key in occupied)
+    return keys
+
+
+def distance_m(lat1, lon1, lat2, lon2):
+    # المسافة بالأمتار (تقريب equirectangular، دقيق بما يكفي للمسافات القصيرة بين الإشارات)
+    x = math.radians((lon2 - lon1 + 180) % 360 - 180) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * EARTH_RADIUS
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    # المسافة على الكرة بالأمتار (haversine)، دقيقة لأي مسافة وقرب القطبين؛ أبطأ قليلاً من
+    # distance_m، لذلك تستعمل حيث تتراكم المسافات (مسافة الرحلة) لا في البحث عن الأقرب
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def cluster_cell(zoom, cell_px=64):
+    # حجم خلية التجميع بالدرجات: نحو 64 بكسل عند مستوى التكبير المطلوب
+    return 360.0 / (2 ** zoom) * cell_px / 256
+
+
+class ClusterIndex:
+    # مجموعات الأجهزة لكل مستوى تكبير: العدد ومجموع الإحداثيات (للمركز) وعدد النشطة
+    # تحدث تدريجياً مع كل إشارة، والتحول إلى غير نشط يعالج بكومة مواعيد الانتهاء
+    def __init__(self, inactive_after, levels=CLUSTER_LEVELS):
+        self.inactive_after = inactive_after
+        self.sizes = [cluster_cell(zoom) for zoom in range(levels)]
+        self.levels = [{} for _ in range(levels)]  # cell_key -> [العدد، النشطة، مجموع lat، مجموع lon]
+        self.devices = {}                            # معرف الجهاز -> CLUSTER_DEVICE مرصوصة
+        self.expiry = []                             # (موعد الانتهاء، معرف الجهاز)
+
+    def _apply(self, lat, lon, count, active):
+        for size, cells in zip(self.sizes, self.levels):
+            key = math.floor(lon / size) << 32 | math.floor(lat / size) & 0xFFFFFFFF
+            cell = cells.get(key)
+            if cell is None:
+                cell = cells[key] = [0, 0, 0.0, 0.0]
+            cell[0] += count
+            cell[1] += active
+            cell[2] += lat * count
+            cell[3] += lon * count
+            if cell[0] == 0:
+                del cells[key]
+
+    def update(self, device_id, lat, lon, now):
+        self.expire(now)
+        old = self.devices.get(device_id)
+        if old is not None:
+            old_lat, old_lon, active, _ = CLUSTER_DEVICE.unpack(old)
+            self._apply(old_lat, old_lon, -1, -active)
+        self._apply(lat, lon, 1, 1)
+        self.devices[device_id] = CLUSTER_DEVICE.pack(lat, lon, True, now)
+        if old is None or not active:
+            # موعد واحد فقط لكل جهاز نشط؛ يؤجل عند الانتهاء إذا وصلت إشارات جديدة
+            heapq.heappush(self.expiry, (now + self.inactive_after, device_id))
+
+    def add_inactive(self, device_id, lat, lon, seen):
+        # جهاز لم يظهر منذ مدة (حالة مستعادة): يعد غير نشط مباشرة دون موعد انتهاء في الكومة
+        self.remove(device_id)
+        self._apply(lat, lon, 1, 0)
+        self.devices[device_id] = CLUSTER_DEVICE.pack(lat, lon, False, seen)
+
+    def remove(self, device_id):
+        old = self.devices.pop(device_id, None)
+        if old is not None:
+            lat, lon, active, _ = CLUSTER_DEVICE.unpack(old)
+            self._apply(lat, lon, -1, -active)
+
+    def expire(self, now):
+        while self.expiry and self.expiry[0][0] <= now:
+            _, device_id = heapq.heappop(self.expiry)
+            device = self.devices.get(device_id)
+            if device is None:
+                continue
+            lat, lon, active, seen = CLUSTER_DEVICE.unpack(device)
+            if not active:
+                continue
+            deadline = seen + self.inactive_after
+            if deadline > now:
+                heapq.heappush(self.expiry, (deadline, device_id))
+            else:
+                self.devices[device_id] = CLUSTER_DEVICE.pack(lat, lon, False, seen)
+                self._apply(lat, lon, 0, -1)
+
+    def query(self, bbox, zoom, now):
+        self.expire(now)
+        zoom = max(0, min(zoom, len(self.levels) - 1))
+        cells = self.levels[zoom]
+        clusters = []
+        for key in cells_in(bbox, self.sizes[zoom], cells):
+            count, active, sum_lat, sum_lon = cells[key]
+            clusters.append({'lat': sum_lat / count, 'lon': sum_lon / count, 'count': count,
+                             'active': active, 'inactive': count - active})
+        return clusters
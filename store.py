@@ -0,0 +1,768 @@
+from collections import OrderedDict, deque
+import json
+import math
+import sqlite3
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+from spatial import CLUSTER_LEVELS, DEGREE_M, EARTH_RADIUS, BBox, ClusterIndex, GridIndex, cluster_cell, distance_m
+
+# الحد الأقصى لعدد الأجهزة المحذوفة التي نحتفظ بها لمزامنة التغييرات
+MAX_TOMBSTONES = 10000
+
+
+def new_record(device_id):
+    return {'custom_name': device_id, 'last_update': None}
+
+
+def iso_time(epoch):
+    return datetime.utcfromtimestamp(epoch).isoformat() + 'Z'
+
+
+def parse_iso(text):
+    if not text:
+        return None
+    return datetime.fromisoformat(text.rstrip('Z')).replace(tzinfo=timezone.utc).timestamp()
+
+
+def stored_record(record):
+    # الإشارة كما تبنيها app.build_record (وقت الاستقبال 'updated' بالثواني) بصيغة JSON المخزنة
+    # الحقول الاختيارية تطبع كما في DeviceRecord.to_dict (أعداد أو null) حتى لا يختلف شكل
+    # الرد حسب DEVICE_STORE
+    record = dict(record)
+    updated = record.pop('updated', None)
+    if updated is not None:
+        record['last_update'] = iso_time(updated)
+    for key in ('battery', 'speed', 'accuracy'):
+        if key in record:
+            record[key] = optional(number(record[key]))
+    return record
+
+
+NUMBERS = struct.Struct('<6d')   # آخر ظهور (ثوانٍ منذ 1970)، lat، lon، البطارية، السرعة، الدقة
+POSITION = struct.Struct('<8x2d')
+UPDATED = struct.Struct('<d')
+NAN = float('nan')
+
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return NAN
+
+
+def optional(value):
+    # NaN = غير معروف (وكذلك inf)؛ الأعداد الصحيحة تعود كما أرسلها الجهاز (85 لا 85.0)
+    if not math.isfinite(value):
+        return None
+    return int(value) if value.is_integer() else value
+
+
+class DeviceRecord:
+    # سجل جهاز مضغوط في MemoryStore: القيم الرقمية مرصوصة في bytes واحدة (48 بايت) بدلاً من
+    # قاموس بمفاتيح نصية وكائن float لكل قيمة ونص ISO لوقت آخر ظهور؛ القاموس بصيغة JSON
+    # المعتادة يبنى فقط عند العرض (to_dict)، والقيم غير الرقمية في الحقول الاختيارية تعد غير معروفة
+    __slots__ = ('custom_name', 'timestamp', 'numbers', 'group')
+
+    def __init__(self, custom_name, timestamp, numbers, group=None):
+        self.custom_name = custom_name
+        self.timestamp = timestamp    # كما أرسله الجهاز (رقم أو نص ISO)
+        self.numbers = numbers
+        self.group = group            # مجموعة الجهاز (فريق التوزيع) أو None
+
+    @classmethod
+    def build(cls, custom_name, record, group=None):
+        updated = record.get('updated')
+        return cls(custom_name, record.get('timestamp'), NUMBERS.pack(
+            NAN if updated is None else updated, record['lat'], record['lon'],
+            number(record.get('battery')), number(record.get('speed')), number(record.get('accuracy'))), group)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls.build(data.get('custom_name'), {**data, 'updated': parse_iso(data.get('last_update'))},
+                         data.get('group'))
+
+    def position(self):
+        return POSITION.unpack_from(self.numbers)
+
+    def updated(self):
+        return UPDATED.unpack_from(self.numbers)[0]
+
+    def touched(self, updated):
+        return DeviceRecord(self.custom_name, self.timestamp, UPDATED.pack(updated) + self.numbers[8:], self.group)
+
+    def renamed(self, custom_name):
+        return DeviceRecord(custom_name, self.timestamp, self.numbers, self.group)
+
+    def regrouped(self, group):
+        return DeviceRecord(self.custom_name, self.timestamp, self.numbers, group)
+
+    def to_dict(self):
+        updated, lat, lon, battery, speed, accuracy = NUMBERS.unpack(self.numbers)
+        data = {'custom_name': self.custom_name,
+                'last_update': None if math.isnan(updated) else iso_time(updated),
+                'lat': lat, 'lon': lon, 'timestamp': self.timestamp,
+                'battery': optional(battery), 'speed': optional(speed), 'accuracy': optional(accuracy)}
+        if self.group is not None:
+            data['group'] = self.group
+        return data
+
+
+class Partition:
+    # أجهزة مجموعة واحدة وتغييراتها بنفس أرقام التغيير العامة، حتى تكون قراءة المجموعة
+    # (لقطتها أو تغييراتها منذ مؤشر) بحجمها هي لا بحجم الأسطول كله
+    __slots__ = ('changed', 'departed', 'floor', 'last')
+
+    def __init__(self):
+        self.changed = OrderedDict()    # العضو -> رقم آخر تغيير (الأقدم أولاً)
+        self.departed = OrderedDict()   # من خرج منها (نقل إلى مجموعة أخرى أو حذف) -> رقم خروجه
+        self.floor = 0                  # المؤشرات الأقدم تحتاج إلى لقطة المجموعة كاملة
+        self.last = 0                   # رقم آخر تغيير يخص المجموعة
+
+
+class MemoryStore:
+    # حالة الأجهزة داخل العملية نفسها (عامل gunicorn واحد)
+    # السجلات لا تعدل في مكانها بل تستبدل، لذلك نسخة القاموس تكفي كلقطة متسقة
+    # الكتابات تدمج سجل الجهاز تحت قفل شريحته (حسب معرفه)، ثم تحجز القفل العام لحظة قصيرة
+    # لتثبيت السجل ورقم التغيير والفهارس فقط؛ بناء التغيير وإرساله للمشتركين (وترميزه JSON في
+    # app.py) بعد تحرير الأقفال كلها (_emit)؛ قراءة الكل لا تحجز أي قفل
+    shared = False
+    STRIPES = 16
+
+    def __init__(self, inactive_after=60, cluster_levels=CLUSTER_LEVELS):
+        self.lock = threading.Lock()
+        self.stripes = [threading.Lock() for _ in range(self.STRIPES)]
+        self.devices = {}
+        self.seq = 0
+        self.device_seq = {}              # معرف الجهاز -> رقم آخر تغيير (الأقدم أولاً: يحذف ثم يضاف)
+        self.tombstones = OrderedDict()   # معرف الجهاز المحذوف -> رقم تغيير الحذف
+        self.tombstone_floor = 0          # المؤشرات الأقدم من هذا تحتاج إلى لقطة كاملة
+        self.partitions = {}              # المجموعة -> Partition
+        self.edited = {}                  # حتى الاستعادة: معرف الجهاز -> ما غيره المستخدم ('name'، 'group'، 'deleted')
+        self.index = GridIndex()
+        self.clusters = ClusterIndex(inactive_after, cluster_levels)
+        self.listeners = []
+        self.pending = deque()            # (رقم التغيير، المعرف، السجل، المجموعة التي خرج منها) بالترتيب
+        self.emitting = threading.Lock()
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def _stripe(self, device_id):
+        return hash(device_id) % self.STRIPES
+
+    def _emit(self):
+        # يستدعى بعد تحرير الأقفال: خيط واحد يفرغ الطابور بترتيب أرقام التغيير، ومن يجده مشغولاً
+        # يترك له ما أضافه (الحلقة الخارجية تلتقط ما أضيف لحظة تحرير القفل)
+        while self.pending:
+            if not self.emitting.acquire(blocking=False):
+                return
+            try:
+                while self.pending:
+                    self._notify(*self.pending.popleft())
+            finally:
+                self.emitting.release()
+
+    def _notify(self, seq, device_id, record, left):
+        # record: سجل الجهاز، أو None للحذف، أو نسخة كل السجلات (device_id None) بعد الاستعادة
+        # partitions: {المجموعة: التغيير كما يراه مشتركو المجموعة} (الخروج منها يرسل حذفاً)
+        partitions = {}
+        if device_id is None:
+            delta = {'cursor': seq, 'full': True, 'deleted': [],
+                     'devices': {device_id: record.to_dict() for device_id, record in record.items()}}
+            partitions = None
+        elif record is None:
+            delta = {'cursor': seq, 'full': False, 'devices': {}, 'deleted': [device_id]}
+        else:
+            delta = {'cursor': seq, 'full': False, 'devices': {device_id: record.to_dict()}, 'deleted': []}
+            if record.group is not None:
+                partitions[record.group] = delta
+        if left is not None:
+            partitions[left] = {'cursor': seq, 'full': False, 'devices': {}, 'deleted': [device_id]}
+        for listener in self.listeners:
+            listener(seq - 1, delta, partitions)
+
+    def _join(self, group, device_id):
+        partition = self.partitions.get(group)
+        if partition is None:
+            partition = self.partitions[group] = Partition()
+        partition.changed[device_id] = partition.last = self.seq
+        partition.changed.move_to_end(device_id)
+        partition.departed.pop(device_id, None)
+
+    def _leave(self, group, device_id):
+        partition = self.partitions[group]
+        partition.changed.pop(device_id, None)
+        partition.departed[device_id] = partition.last = self.seq
+        partition.departed.move_to_end(device_id)
+        while len(partition.departed) > MAX_TOMBSTONES:
+            _, partition.floor = partition.departed.popitem(last=False)
+
+    def _edit(self, device_id, what):
+        # تغيير يدوي قبل انتهاء الاستعادة أحدث من النسخة المحفوظة فلا تغطيه
+        if self.edited is not None:
+            self.edited.setdefault(device_id, set()).add(what)
+
+    def _mark_changed(self, device_id, previous=None):
+        # previous: مجموعة الجهاز قبل هذا التغيير إذا نقل منها
+        self.seq += 1
+        # قاموس عادي لا OrderedDict: نحو 40 بايت للجهاز بدلاً من أكثر من 100
+        self.device_seq.pop(device_id, None)
+        self.device_seq[device_id] = self.seq
+        self.tombstones.pop(device_id, None)
+        record = self.devices[device_id]
+        left = None
+        if previous is not None and previous != record.group:
+            self._leave(previous, device_id)
+            left = previous
+        if record.group is not None:
+            self._join(record.group, device_id)
+        self.pending.append((self.seq, device_id, record, left))
+
+    def _mark_deleted(self, device_id, group=None):
+        self.seq += 1
+        self.device_seq.pop(device_id, None)
+        self.tombstones[device_id] = self.seq
+        self.tombstones.move_to_end(device_id)
+        while len(self.tombstones) > MAX_TOMBSTONES:
+            _, self.tombstone_floor = self.tombstones.popitem(last=False)
+        if group is not None:
+            self._leave(group, device_id)
+        self.pending.append((self.seq, device_id, None, group))
+
+    def update(self, device_id, record):
+        self.update_many([(device_id, record)])
+
+    def update_many(self, items):
+        # الدفعة تقسم حسب الشرائح حتى يحجز كل قفل مرة واحدة لكل شريحة
+        groups = {}
+        for device_id, record in items:
+            groups.setdefault(self._stripe(device_id), []).append((device_id, record))
+        try:
+            for stripe, group in groups.items():
+                with self.stripes[stripe]:
+                    merged = []
+                    for device_id, record in group:
+                        current = self.devices.get(device_id)
+                        if current is None:
+                            merged.append((device_id, DeviceRecord.build(device_id, record)))
+                        else:
+                            merged.append((device_id, DeviceRecord.build(current.custom_name, record, current.group)))
+                    now = time.time()
+                    with self.lock:
+                        for device_id, current in merged:
+                            # الفهرس أولاً: موقع لا يمكن فهرسته يرفع الخطأ قبل نشر السجل
+                            lat, lon = current.position()
+                            self.index.update(device_id, lat, lon)
+                            self.clusters.update(device_id, lat, lon, now)
+                            self.devices[device_id] = current
+                            self._mark_changed(device_id)
+        finally:
+            self._emit()
+
+    def touch(self, device_id, updated):
+        # تحديث وقت آخر ظهور فقط دون رقم تغيير جديد: لا يرسل للوحات ولا يبطل اللقطة
+        with self.stripes[self._stripe(device_id)]:
+            current = self.devices.get(device_id)
+            if current is None:
+                return False
+            touched = current.touched(updated)
+            with self.lock:
+                self.devices[device_id] = touched
+                self.clusters.update(device_id, *current.position(), time.time())
+            return True
+
+    def rename(self, device_id, new_name):
+        with self.stripes[self._stripe(device_id)]:
+            current = self.devices.get(device_id)
+            if current is None:
+                return False
+            renamed = current.renamed(new_name)
+            with self.lock:
+                self._edit(device_id, 'name')
+                self.devices[device_id] = renamed
+                self._mark_changed(device_id)
+        self._emit()
+        return True
+
+    def set_group(self, device_id, group):
+        # group=None يخرج الجهاز من مجموعته
+        with self.stripes[self._stripe(device_id)]:
+            current = self.devices.get(device_id)
+            if current is None:
+                return False
+            regrouped = current.regrouped(group)
+            with self.lock:
+                self._edit(device_id, 'group')
+                self.devices[device_id] = regrouped
+                self._mark_changed(device_id, current.group)
+        self._emit()
+        return True
+
+    def groups(self):
+        # {المجموعة: عدد أجهزتها}
+        with self.lock:
+            return {group: len(partition.changed) for group, partition in self.partitions.items()
+                    if partition.changed}
+
+    def delete(self, device_id):
+        with self.stripes[self._stripe(device_id)], self.lock:
+            record = self.devices.pop(device_id, None)
+            if record is None:
+                return False
+            self.index.remove(device_id)
+            self.clusters.remove(device_id)
+            self._edit(device_id, 'deleted')
+            self._mark_deleted(device_id, record.group)
+        self._emit()
+        return True
+
+    def restore(self, devices, cursor, chunk=5000):
+        # إعادة حالة محفوظة (checkpoint.py) على دفعات حتى لا تتوقف الإشارات الواردة أثناءها؛
+        # الجهاز الذي أرسل بعد بدء التشغيل يبقى موقعه الأحدث ويعود إليه اسمه ومجموعته ما لم يغيرهما
+        # المستخدم منذ ذلك، والجهاز المحذوف بعد بدء التشغيل لا يعود
+        # الأجهزة المستعادة تعد غير نشطة حتى تصل إشارتها التالية
+        items = list(devices.items())
+        edited = self.edited or {}
+        for start in range(0, len(items), chunk):
+            with self._all_stripes(), self.lock:
+                for device_id, record in items[start:start + chunk]:
+                    edits = edited.get(device_id, ())
+                    if 'deleted' in edits or device_id in self.tombstones:
+                        continue
+                    record = DeviceRecord.from_dict(record)
+                    current = self.devices.get(device_id)
+                    if current is not None:
+                        if 'name' not in edits:
+                            current = current.renamed(record.custom_name)
+                        if 'group' not in edits and record.group is not None:
+                            current = current.regrouped(record.group)
+                        record = current
+                    else:
+                        self.index.update(device_id, *record.position())
+                    self.devices[device_id] = record
+                    if record.group is not None:
+                        # العضوية تسجل فوراً: نقل الجهاز قبل نهاية الاستعادة يخرجه من مجموعة موجودة
+                        self._join(record.group, device_id)
+        with self.lock:
+            # المؤشرات السابقة (ومنها مؤشرات العملية القديمة) تحتاج إلى لقطة كاملة
+            self.seq = max(self.seq, cursor) + 1
+            self.tombstone_floor = self.seq
+            self.edited = None
+            for partition in self.partitions.values():
+                partition.floor = partition.last = self.seq
+            self.pending.append((self.seq, None, self.devices.copy(), None))
+        self._emit()
+        # الخريطة تعرض الأجهزة الآن؛ فهرس التجميع أبطأ بكثير (مستوى لكل تكبير) فيبنى بعدها
+        # على دفعات صغيرة، ويتخطى كل جهاز أضافته إشارة وصلت منذ الاستعادة
+        seen = time.time()
+        for start in range(0, len(items), chunk // 20):
+            with self.lock:
+                for device_id, record in items[start:start + chunk // 20]:
+                    current = self.devices.get(device_id)
+                    if current is not None and device_id not in self.clusters.devices:
+                        self.clusters.add_inactive(device_id, *current.position(), seen)
+
+    def _all_stripes(self):
+        return _Locks(self.stripes)
+
+    def get(self, device_id):
+        record = self.devices.get(device_id)
+        return None if record is None else record.to_dict()
+
+    def all(self, group=None):
+        # نسخ القاموس عملية واحدة في CPython لا يقطعها خيط آخر، والسجلات لا تعدل بعد نشرها،
+        # فالنسخة لقطة متسقة دون انتظار أي كتابة، وتحول إلى صيغة JSON خارج أي قفل
+        if group is None:
+            return {device_id: record.to_dict() for device_id, record in self.devices.copy().items()}
+        return {device_id: record.to_dict() for device_id, record in self._members(group)}
+
+    def _members(self, group):
+        with self.lock:
+            partition = self.partitions.get(group)
+            if partition is None:
+                return []
+            return [(device_id, self.devices[device_id]) for device_id in partition.changed]
+
+    def in_bbox(self, bbox, group=None):
+        if group is not None:
+            # المجموعة أصغر من الأسطول: المرور على أعضائها أرخص من الفهرس الشبكي
+            return {device_id: record.to_dict() for device_id, record in self._members(group)
+                    if bbox.contains(*record.position())}
+        with self.lock:
+            records = [(device_id, self.devices[device_id]) for device_id in self.index.query(bbox)]
+        return {device_id: record.to_dict() for device_id, record in records}
+
+    def _active(self):
+        # حد عدم النشاط نفسه (INACTIVE_THRESHOLD)؛ NaN (لم يظهر بعد) لا يعد نشطاً
+        threshold = time.time() - self.clusters.inactive_after
+        return lambda device_id: self.devices[device_id].updated() >= threshold
+
+    def nearest(self, lat, lon, k, active_only=False):
+        # [(المعرف، المسافة بالأمتار، السجل)] لأقرب k أجهزة
+        with self.lock:
+            found = self.index.nearest(lat, lon, k, self._active() if active_only else None)
+            records = [(device_id, distance, self.devices[device_id]) for distance, device_id in found]
+        return [(device_id, distance, record.to_dict()) for device_id, distance, record in records]
+
+    def within(self, lat, lon, radius, active_only=False, limit=1000):
+        with self.lock:
+            found = self.index.within(lat, lon, radius, self._active() if active_only else None)[:limit]
+            records = [(device_id, distance, self.devices[device_id]) for distance, device_id in found]
+        return [(device_id, distance, record.to_dict()) for device_id, distance, record in records]
+
+    def cluster(self, bbox, zoom):
+        with self.lock:
+            return self.clusters.query(bbox, zoom, time.time())
+
+    def activity(self):
+        # (النشطة، الكل) من المستوى الأول لفهرس التجميع دون المرور على الأجهزة
+        with self.lock:
+            self.clusters.expire(time.time())
+            return sum(cell[1] for cell in self.clusters.levels[0].values()), len(self.devices)
+
+    def cursor(self, group=None):
+        if group is None:
+            return self.seq
+        partition = self.partitions.get(group)
+        return 0 if partition is None else partition.last
+
+    def changes_since(self, since, group=None):
+        if group is not None:
+            return self._group_changes(since, group)
+        cursor = self.seq
+        if since < self.tombstone_floor or since > cursor:
+            # الرقم يقرأ قبل النسخ: النسخة قد تحمل تغييرات أحدث منه فتصل مرة ثانية، ولا يضيع شيء
+            return {'cursor': cursor, 'full': True, 'devices': self.all(), 'deleted': []}
+        with self.lock:
+            changed = {}
+            for device_id in reversed(self.device_seq):
+                if self.device_seq[device_id] <= since:
+                    break
+                changed[device_id] = self.devices[device_id]
+            deleted = []
+            for device_id in reversed(self.tombstones):
+                if self.tombstones[device_id] <= since:
+                    break
+                deleted.append(device_id)
+            cursor = self.seq
+        changed = {device_id: record.to_dict() for device_id, record in changed.items()}
+        return {'cursor': cursor, 'full': False, 'devices': changed, 'deleted': deleted}
+
+    def _group_changes(self, since, group):
+        # مثل changes_since لكن بالمرور على سجل المجموعة فقط؛ المؤشر نفسه عام
+        with self.lock:
+            cursor = self.seq
+            partition = self.partitions.get(group) or Partition()
+            if since < max(self.tombstone_floor, partition.floor) or since > cursor:
+                records = [(device_id, self.devices[device_id]) for device_id in partition.changed]
+                full = True
+                deleted = []
+            else:
+                records = []
+                for device_id in reversed(partition.changed):
+                    if partition.changed[device_id] <= since:
+                        break
+                    records.append((device_id, self.devices[device_id]))
+                deleted = []
+                for device_id in reversed(partition.departed):
+                    if partition.departed[device_id] <= since:
+                        break
+                    deleted.append(device_id)
+                full = False
+        return {'cursor': cursor, 'full': full,
+                'devices': {device_id: record.to_dict() for device_id, record in records}, 'deleted': deleted}
+
+
+class SQLiteStore:
+    # حالة مشتركة بين كل عمال gunicorn على نفس الخادم عبر SQLite بوضع WAL:
+    # القراءات لا تنتظر الكتابات، والرقم التسلسلي مشترك بين العمليات
+    shared = True
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS devices (id TEXT PRIMARY KEY, data TEXT NOT NULL, seq INTEGER NOT NULL,
+                                        lat REAL, lon REAL, grp TEXT);
+    CREATE INDEX IF NOT EXISTS devices_seq ON devices (seq);
+    CREATE INDEX IF NOT EXISTS devices_position ON devices (lat, lon);
+    CREATE INDEX IF NOT EXISTS devices_group ON devices (grp, seq);
+    CREATE TABLE IF NOT EXISTS tombstones (id TEXT PRIMARY KEY, seq INTEGER NOT NULL);
+    CREATE INDEX IF NOT EXISTS tombstones_seq ON tombstones (seq);
+    CREATE TABLE IF NOT EXISTS departures (grp TEXT NOT NULL, id TEXT NOT NULL, seq INTEGER NOT NULL,
+                                           PRIMARY KEY (grp, id));
+    CREATE INDEX IF NOT EXISTS departures_seq ON departures (grp, seq);
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    INSERT OR IGNORE INTO meta VALUES ('seq', 0), ('tombstone_floor', 0);
+    """
+
+    def __init__(self, path, inactive_after=60):
+        self.path = path
+        self.inactive_after = inactive_after
+        self.local = threading.local()
+        db = self._db()
+        columns = [row[1] for row in db.execute('PRAGMA table_info(devices)')]
+        if columns and 'lat' not in columns:
+            # قاعدة بيانات أنشئت قبل إضافة عمودي الموقع
+            db.executescript("""
+            ALTER TABLE devices ADD COLUMN lat REAL;
+            ALTER TABLE devices ADD COLUMN lon REAL;
+            UPDATE devices SET lat = json_extract(data, '$.lat'), lon = json_extract(data, '$.lon');
+            """)
+        if columns and 'grp' not in columns:
+            # قاعدة بيانات أنشئت قبل إضافة المجموعات
+            db.execute('ALTER TABLE devices ADD COLUMN grp TEXT')
+        db.executescript(self.SCHEMA)
+
+    def subscribe(self, listener):
+        # التغييرات قد تأتي من عمليات أخرى، لذلك يقرؤها البث عبر changes_since
+        pass
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def _write(self):
+        return _Transaction(self._db(), 'BEGIN IMMEDIATE')
+
+    def _read(self):
+        return _Transaction(self._db(), 'BEGIN')
+
+    @staticmethod
+    def _next_seq(db):
+        return db.execute("UPDATE meta SET value = value + 1 WHERE key = 'seq' RETURNING value").fetchone()[0]
+
+    @staticmethod
+    def _put(db, device_id, data, seq):
+        group = data.get('group')
+        db.execute('INSERT OR REPLACE INTO devices (id, data, seq, lat, lon, grp) VALUES (?, ?, ?, ?, ?, ?)',
+                   (device_id, json.dumps(data), seq, data.get('lat'), data.get('lon'), group))
+        db.execute('DELETE FROM tombstones WHERE id = ?', (device_id,))
+        if group is not None:
+            db.execute('DELETE FROM departures WHERE grp = ? AND id = ?', (group, device_id))
+
+    @staticmethod
+    def _depart(db, group, device_id, seq):
+        # خروج الجهاز من مجموعته يصل لمشتركيها حذفاً؛ يحتفظ بآخر MAX_TOMBSTONES لكل مجموعة
+        db.execute('INSERT OR REPLACE INTO departures (grp, id, seq) VALUES (?, ?, ?)', (group, device_id, seq))
+        oldest = db.execute('SELECT seq FROM departures WHERE grp = ? ORDER BY seq DESC LIMIT 1 OFFSET ?',
+                            (group, MAX_TOMBSTONES)).fetchone()
+        if oldest:
+            db.execute('DELETE FROM departures WHERE grp = ? AND seq <= ?', (group, oldest[0]))
+            db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('floor:' + group, oldest[0]))
+
+    def update(self, device_id, record):
+        self.update_many([(device_id, record)])
+
+    def update_many(self, items):
+        with self._write() as db:
+            for device_id, record in items:
+                row = db.execute('SELECT data FROM devices WHERE id = ?', (device_id,)).fetchone()
+                current = json.loads(row[0]) if row else new_record(device_id)
+                current.update(stored_record(record))
+                self._put(db, device_id, current, self._next_seq(db))
+
+    def touch(self, device_id, updated):
+        db = self._db()
+        return db.execute("UPDATE devices SET data = json_set(data, '$.last_update', ?) WHERE id = ?",
+                          (iso_time(updated), device_id)).rowcount > 0
+
+    def rename(self, device_id, new_name):
+        with self._write() as db:
+            row = db.execute('SELECT data FROM devices WHERE id = ?', (device_id,)).fetchone()
+            if row is None:
+                return False
+            current = json.loads(row[0])
+            current['custom_name'] = new_name
+            self._put(db, device_id, current, self._next_seq(db))
+            return True
+
+    def set_group(self, device_id, group):
+        with self._write() as db:
+            row = db.execute('SELECT data FROM devices WHERE id = ?', (device_id,)).fetchone()
+            if row is None:
+                return False
+            current = json.loads(row[0])
+            previous = current.pop('group', None)
+            if group is not None:
+                current['group'] = group
+            seq = self._next_seq(db)
+            if previous is not None and previous != group:
+                self._depart(db, previous, device_id, seq)
+            self._put(db, device_id, current, seq)
+            return True
+
+    def groups(self):
+        return dict(self._db().execute('SELECT grp, COUNT(*) FROM devices WHERE grp IS NOT NULL GROUP BY grp'))
+
+    def delete(self, device_id):
+        with self._write() as db:
+            row = db.execute('DELETE FROM devices WHERE id = ? RETURNING grp', (device_id,)).fetchone()
+            if row is None:
+                return False
+            seq = self._next_seq(db)
+            db.execute('INSERT OR REPLACE INTO tombstones (id, seq) VALUES (?, ?)', (device_id, seq))
+            if row[0] is not None:
+                self._depart(db, row[0], device_id, seq)
+            oldest = db.execute('SELECT seq FROM tombstones ORDER BY seq DESC LIMIT 1 OFFSET ?',
+                                (MAX_TOMBSTONES,)).fetchone()
+            if oldest:
+                db.execute('DELETE FROM tombstones WHERE seq <= ?', oldest)
+                db.execute("UPDATE meta SET value = ? WHERE key = 'tombstone_floor'", oldest)
+            return True
+
+    def get(self, device_id):
+        row = self._db().execute('SELECT data FROM devices WHERE id = ?', (device_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def all(self, group=None):
+        if group is not None:
+            return {device_id: json.loads(data) for device_id, data in
+                    self._db().execute('SELECT id, data FROM devices WHERE grp = ?', (group,))}
+        return {device_id: json.loads(data)
+                for device_id, data in self._db().execute('SELECT id, data FROM devices')}
+
+    def in_bbox(self, bbox, group=None):
+        sql = 'SELECT id, data FROM devices WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?'
+        if group is not None:
+            sql += ' AND grp = ?'
+        found = {}
+        for west, east in bbox.lon_ranges:
+            found.update((device_id, json.loads(data)) for device_id, data in self._db().execute(
+                sql, (bbox.min_lat, bbox.max_lat, west, east) + ((group,) if group is not None else ())))
+        return found
+
+    def _around(self, lat, lon, radius, active_only):
+        # [(المسافة، المعرف، السجل)] داخل المستطيل المحيط بالدائرة ثم داخل الدائرة نفسها
+        dlat = radius / DEGREE_M
+        dlon = min(dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 90))), 1e-9), 360)
+        bbox = BBox(lon - dlon, lat - dlat, lon + dlon, lat + dlat)
+        sql = 'SELECT id, data, lat, lon FROM devices WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?'
+        extra = ()
+        if active_only:
+            sql += " AND json_extract(data, '$.last_update') >= ?"
+            extra = (datetime.utcfromtimestamp(time.time() - self.inactive_after).isoformat(timespec='microseconds'),)
+        found = []
+        for west, east in bbox.lon_ranges:
+            for device_id, data, lat2, lon2 in self._db().execute(
+                    sql, (bbox.min_lat, bbox.max_lat, west, east) + extra):
+                distance = distance_m(lat, lon, lat2, lon2)
+                if distance <= radius:
+                    found.append((distance, device_id, data))
+        found.sort()
+        return found
+
+    def nearest(self, lat, lon, k, active_only=False):
+        # دوائر متسعة حتى تحوي k أجهزة (فهرس devices_position يحصر كل استعلام في مستطيله)
+        radius = 1000.0
+        while True:
+            found = self._around(lat, lon, radius, active_only)
+            if len(found) >= k or radius >= math.pi * EARTH_RADIUS:
+                return [(device_id, distance, json.loads(data)) for distance, device_id, data in found[:k]]
+            radius *= 4
+
+    def within(self, lat, lon, radius, active_only=False, limit=1000):
+        return [(device_id, distance, json.loads(data))
+                for distance, device_id, data in self._around(lat, lon, radius, active_only)[:limit]]
+
+    def cluster(self, bbox, zoom):
+        # التجميع داخل الاستعلام نفسه؛ الإزاحة تجعل تحويل العدد الصحيح يعمل كـ floor
+        size = cluster_cell(zoom)
+        threshold = datetime.utcfromtimestamp(time.time() - self.inactive_after).isoformat(timespec='microseconds')
+        clusters = []
+        for west, east in bbox.lon_ranges:
+            for count, lat, lon, active in self._db().execute(
+                    """SELECT COUNT(*), AVG(lat), AVG(lon), SUM(json_extract(data, '$.last_update') >= ?)
+                       FROM devices WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?
+                       GROUP BY CAST(lon / ? + 10000000 AS INTEGER), CAST(lat / ? + 10000000 AS INTEGER)""",
+                    (threshold, bbox.min_lat, bbox.max_lat, west, east, size, size)):
+                clusters.append({'lat': lat, 'lon': lon, 'count': count,
+                                 'active': active, 'inactive': count - active})
+        return clusters
+
+    def activity(self):
+        threshold = datetime.utcfromtimestamp(time.time() - self.inactive_after).isoformat(timespec='microseconds')
+        total, active = self._db().execute(
+            "SELECT COUNT(*), SUM(json_extract(data, '$.last_update') >= ?) FROM devices", (threshold,)).fetchone()
+        return active or 0, total
+
+    def cursor(self, group=None):
+        if group is not None:
+            return self._db().execute(
+                'SELECT MAX(IFNULL((SELECT MAX(seq) FROM devices WHERE grp = ?), 0),'
+                ' IFNULL((SELECT MAX(seq) FROM departures WHERE grp = ?), 0))', (group, group)).fetchone()[0]
+        return self._db().execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()[0]
+
+    def changes_since(self, since, group=None):
+        if group is not None:
+            return self._group_changes(since, group)
+        with self._read() as db:
+            meta = dict(db.execute("SELECT key, value FROM meta WHERE key IN ('seq', 'tombstone_floor')"))
+            seq = meta['seq']
+            if since < meta['tombstone_floor'] or since > seq:
+                devices = {device_id: json.loads(data)
+                           for device_id, data in db.execute('SELECT id, data FROM devices')}
+                return {'cursor': seq, 'full': True, 'devices': devices, 'deleted': []}
+            changed = {device_id: json.loads(data) for device_id, data in
+                       db.execute('SELECT id, data FROM devices WHERE seq > ?', (since,))}
+            deleted = [device_id for device_id, in
+                       db.execute('SELECT id FROM tombstones WHERE seq > ?', (since,))]
+            return {'cursor': seq, 'full': False, 'devices': changed, 'deleted': deleted}
+
+    def _group_changes(self, since, group):
+        # الفهرسان (grp, seq) يحصران القراءة في المجموعة
+        with self._read() as db:
+            meta = dict(db.execute("SELECT key, value FROM meta WHERE key IN ('seq', 'tombstone_floor', ?)",
+                                   ('floor:' + group,)))
+            seq = meta['seq']
+            if since < max(meta['tombstone_floor'], meta.get('floor:' + group, 0)) or since > seq:
+                devices = {device_id: json.loads(data) for device_id, data in
+                           db.execute('SELECT id, data FROM devices WHERE grp = ?', (group,))}
+                return {'cursor': seq, 'full': True, 'devices': devices, 'deleted': []}
+            changed = {device_id: json.loads(data) for device_id, data in
+                       db.execute('SELECT id, data FROM devices WHERE grp = ? AND seq > ?', (group, since))}
+            deleted = [device_id for device_id, in
+                       db.execute('SELECT id FROM departures WHERE grp = ? AND seq > ?', (group, since))]
+            return {'cursor': seq, 'full': False, 'devices': changed, 'deleted': deleted}
+
+
+class _Locks:
+    def __init__(self, locks):
+        self.locks = locks
+
+    def __enter__(self):
+        for lock in self.locks:
+            lock.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        for lock in reversed(self.locks):
+            lock.release()
+        return False
+
+
+class _Transaction:
+    def __init__(self, db, begin):
+        self.db = db
+        self.begin = begin
+
+    def __enter__(self):
+        self.db.execute(self.begin)
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+
+def create_store(kind, path='devices.db', inactive_after=60, cluster_levels=CLUSTER_LEVELS):
+    # cluster_levels: مستويات التكبير التي يحفظ لها MemoryStore مجموعات (0..cluster_levels-1)
+    if kind == 'memory':
+        return MemoryStore(inactive_after, cluster_levels)
+    if kind == 'sqlite':
+        return SQLiteStore(path, inactive_after)
+    raise ValueError(f'نوع مخزن غير معروف: {kind}')
@@ -0,0 +1,9 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.py يقرأ إعداداته عند الاستيراد: لا ملفات حالة ولا سجل على القرص أثناء الاختبارات
+for name in ('HISTORY_DIR', 'CHECKPOINT_FILE', 'GEOFENCE_FILE'):
+    os.environ.setdefault(name, '')
+os.environ.setdefault('RATE_LIMIT_DEVICE', '0')
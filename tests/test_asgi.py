@@ -0,0 +1,59 @@
+import asyncio
+import json
+import threading
+
+import asgi
+from app import store
+
+
+def call(path, body=b'', content_type=b'application/json', method='POST'):
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'root_path': '',
+             'http_version': '1.1', 'headers': [(b'content-type', content_type)]}
+    asyncio.run(asgi.application(scope, receive, send))
+    return sent[0]['status'], json.loads(b''.join(message.get('body', b'') for message in sent[1:]))
+
+
+def test_batch_is_applied_off_the_event_loop(monkeypatch):
+    threads = []
+    apply_batch = asgi.apply_batch
+
+    def spy(*args):
+        threads.append(threading.current_thread())
+        return apply_batch(*args)
+
+    monkeypatch.setattr(asgi, 'apply_batch', spy)
+    body = b'\n'.join(json.dumps({'id': f'asgi-{n}', 'lat': 1, 'lon': n + 1}).encode() for n in range(3))
+    status, result = call('/update_batch', body, b'application/x-ndjson')
+    assert status == 200 and result['accepted'] == 3
+    assert threads and threads[0] is not threading.main_thread()
+    assert store.get('asgi-2')['lon'] == 3
+
+
+def test_websocket_batch_and_single_fix():
+    messages = [{'type': 'websocket.connect'},
+                {'type': 'websocket.receive', 'text': '{"lat": 1, "lon": 1}'},
+                {'type': 'websocket.receive', 'text': '[{"lat": 1, "lon": 2}, {"lat": 1, "lon": 3}]'},
+                {'type': 'websocket.disconnect'}]
+    replies = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        if message['type'] == 'websocket.send':
+            replies.append(json.loads(message['text']))
+
+    scope = {'type': 'websocket', 'path': '/ws', 'query_string': b'id=ws-device', 'headers': []}
+    asyncio.run(asgi.application(scope, receive, send))
+    assert replies[0] == {'status': 'success'}
+    assert replies[1]['status'] == 'success' and replies[1]['accepted'] == 2
+    assert store.get('ws-device')['lon'] == 3
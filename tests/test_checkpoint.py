@@ -0,0 +1,100 @@
+import time
+
+from checkpoint import Checkpoint
+from store import MemoryStore
+
+
+def fix(lat):
+    return {'lat': lat, 'lon': 3.0, 'timestamp': None, 'updated': time.time()}
+
+
+def restored(path):
+    store = MemoryStore()
+    checkpoint = Checkpoint(path)
+    checkpoint.restore(store)
+    return store
+
+
+def test_compaction_keeps_every_device(tmp_path):
+    store = MemoryStore()
+    store.update_many([(f'd{n}', fix(36 + n * 0.01)) for n in range(20)])
+    store.rename('d5', 'Truck 5')
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'), compact_ratio=0.01)
+    checkpoint.lease = object()
+    checkpoint.restored = True
+    checkpoint.save(store)
+    for n in range(5):
+        # التغييرات الصغيرة تتجاوز نسبة الضغط فتعاد كتابة اللقطة
+        store.update('d0', fix(37 + n))
+        checkpoint.save(store)
+
+    store = restored(checkpoint.path)
+    assert sorted(store.all()) == sorted(f'd{n}' for n in range(20))
+    assert store.get('d5')['custom_name'] == 'Truck 5'
+    assert store.get('d0')['lat'] == 41
+
+
+def test_restore_applies_deltas_and_deletions(tmp_path):
+    store = MemoryStore()
+    store.update_many([(f'd{n}', fix(36)) for n in range(3)])
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    checkpoint.lease = object()
+    checkpoint.restored = True
+    checkpoint.save(store)
+    store.delete('d1')
+    store.rename('d2', 'Van')
+    checkpoint.save(store)
+
+    store = restored(checkpoint.path)
+    assert sorted(store.all()) == ['d0', 'd2']
+    assert store.get('d2')['custom_name'] == 'Van'
+
+
+def test_restore_keeps_saved_names_of_devices_that_reported_first(tmp_path):
+    store = MemoryStore()
+    store.update_many([(f'd{n}', fix(36)) for n in range(4)])
+    for n in range(4):
+        store.rename(f'd{n}', f'Truck {n}')
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    checkpoint.lease = object()
+    checkpoint.restored = True
+    checkpoint.save(store)
+
+    # الاستعادة في الخلفية: إشارات وتعديلات تصل قبل أن تنتهي
+    store = MemoryStore()
+    for n in range(4):
+        store.update(f'd{n}', fix(40))
+    store.rename('d1', 'Van')
+    store.delete('d2')
+    store.update('d3', fix(41))
+    store.delete('d3')
+    store.update('d3', fix(42))
+    Checkpoint(checkpoint.path).restore(store)
+
+    assert store.get('d0')['custom_name'] == 'Truck 0' and store.get('d0')['lat'] == 40
+    assert store.get('d1')['custom_name'] == 'Van'
+    assert store.get('d2') is None
+    assert store.get('d3')['custom_name'] == 'd3'
+
+
+def test_restore_rejoins_saved_groups_of_devices_that_reported_first(tmp_path):
+    store = MemoryStore()
+    store.update_many([(f'd{n}', fix(36)) for n in range(3)])
+    for n in range(3):
+        store.set_group(f'd{n}', 'north')
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    checkpoint.lease = object()
+    checkpoint.restored = True
+    checkpoint.save(store)
+
+    store = MemoryStore()
+    for n in range(3):
+        store.update(f'd{n}', fix(40))
+    store.set_group('d1', 'south')
+    Checkpoint(checkpoint.path).restore(store)
+    store.set_group('d2', None)
+
+    assert store.get('d0')['group'] == 'north'
+    assert store.groups() == {'north': 1, 'south': 1}
+    assert list(store.all('north')) == ['d0']
+    assert list(store.changes_since(store.cursor() - 1, 'north')['deleted']) == ['d2']
@@ -0,0 +1,49 @@
+import fcntl
+import os
+import time
+
+import app
+from history import HOUR_MS, RAW, HistoryLog
+
+
+def write_raw(path, device_id, ts_ms, lat=1.0, lon=2.0):
+    key = device_id.encode()
+    with open(os.path.join(path, f'{ts_ms // HOUR_MS}.1.raw'), 'ab') as f:
+        f.write(RAW.pack(len(key), ts_ms, round(lat * 1e6), round(lon * 1e6), 80.0, 1.0, 5.0) + key)
+
+
+def test_query_reads_compacted_and_raw_files(tmp_path):
+    log = HistoryLog(str(tmp_path))
+    write_raw(log.path, 'a', 1000)
+    write_raw(log.path, 'b', 2000)
+    log.compact(1)
+    write_raw(log.path, 'a', 3000)
+    assert [row[0] for row in log.query('a', 0, HOUR_MS)] == [1000, 3000]
+    assert [row[0] for row in log.query('b', 0, HOUR_MS)] == [2000]
+    assert log.query('c', 0, HOUR_MS) == []
+
+
+def test_csv_export_has_a_single_charset(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'history', HistoryLog(str(tmp_path)))
+    write_raw(str(tmp_path), 'a', 1000)
+    response = app.app.test_client().get('/history/export?format=csv&from=0&to=3600')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'text/csv; charset=utf-8'
+    assert response.data.decode().splitlines()[1].startswith('a,')
+
+
+def test_late_fixes_wait_for_a_running_compaction(tmp_path):
+    log = HistoryLog(str(tmp_path))
+    os.makedirs(log.path, exist_ok=True)
+    old = (int(time.time() * 1000) // HOUR_MS - 5) * HOUR_MS
+    with open(os.path.join(log.path, '.compact.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        log.append('late', old + 1000, {'lat': 1.0, 'lon': 2.0})
+        time.sleep(0.3)
+        # عامل آخر يضغط الآن: لا يلحق شيء بملفات الساعة حتى ينتهي
+        assert not [name for name in os.listdir(log.path) if name.endswith('.raw')]
+    deadline = time.monotonic() + 5
+    while not log.query('late', old, old + HOUR_MS) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    log.compact(old // HOUR_MS + 1)
+    assert [row[0] for row in log.query('late', old, old + HOUR_MS)] == [old + 1000]
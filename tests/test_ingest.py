@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+import app as app_module
+from app import app
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+@pytest.mark.parametrize('query', ['lat=nan&lon=1', 'lat=inf&lon=1', 'lat=91&lon=1', 'lat=1&lon=500'])
+def test_update_rejects_invalid_coordinates(client, query):
+    response = client.get('/update?id=invalid&' + query)
+    assert response.status_code == 400
+    assert 'invalid' not in json.loads(client.get('/get_devices').data)
+
+
+def test_batch_reports_invalid_fix_per_item(client):
+    response = client.post('/update_batch', json=[
+        {'id': 'batch-a', 'lat': 1, 'lon': 1},
+        {'id': 'batch-b', 'lat': 'nan', 'lon': 1},
+        {'id': 'batch-c', 'lat': 2, 'lon': 2},
+    ])
+    assert response.status_code == 200
+    assert [result['status'] for result in response.get_json()['results']] == ['applied', 'error', 'applied']
+    devices = json.loads(client.get('/get_devices').data)
+    assert 'batch-a' in devices and 'batch-c' in devices and 'batch-b' not in devices
+
+
+def test_group_stream_feed_is_dropped_with_its_last_subscriber(client):
+    first = client.get('/stream?group=feed-test', buffered=False)
+    second = client.get('/stream?group=feed-test', buffered=False)
+    assert next(first.response).startswith(b'retry:')
+    assert 'feed-test' in app_module.group_feeds.feeds
+    first.close()
+    assert 'feed-test' in app_module.group_feeds.feeds
+    second.close()
+    assert 'feed-test' not in app_module.group_feeds.feeds
+
+
+def test_bbox_stream_forwards_deletions_and_renames_outside_the_view():
+    feed = app_module.ChangeFeed(16)
+    session = app_module.StreamSession(None, '0,0,1,1')
+    outside = {'custom_name': 'far', 'lat': 50.0, 'lon': 50.0}
+    feed.publish(0, {'cursor': 1, 'full': False, 'devices': {'far': outside}, 'deleted': []})
+    feed.publish(1, {'cursor': 2, 'full': False, 'devices': {'far': {**outside, 'lat': 51.0}}, 'deleted': []})
+    feed.publish(2, {'cursor': 3, 'full': False, 'devices': {'far': {**outside, 'custom_name': 'Van'}},
+                     'deleted': []})
+    feed.publish(3, {'cursor': 4, 'full': False, 'devices': {}, 'deleted': ['gone']})
+    frames, _ = feed.frames_after(0)
+    assert [session.relevant(spots) for spots, frame in frames] == [False, False, True, True]
@@ -0,0 +1,37 @@
+import time
+
+import pytest
+
+from store import MemoryStore, SQLiteStore
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryStore()
+    return SQLiteStore(str(tmp_path / 'devices.db'))
+
+
+def test_optional_fields_have_the_same_shape_in_both_stores(store):
+    store.update('a', {'lat': 1.0, 'lon': 2.0, 'timestamp': '5', 'updated': time.time(),
+                       'battery': '80', 'speed': 'x', 'accuracy': '12.5'})
+    store.update('b', {'lat': 1.0, 'lon': 2.0, 'timestamp': None, 'updated': time.time(),
+                       'battery': None, 'speed': 'inf', 'accuracy': 7})
+    a, b = store.get('a'), store.get('b')
+    assert (a['battery'], a['speed'], a['accuracy'], a['timestamp']) == (80, None, 12.5, '5')
+    assert (b['battery'], b['speed'], b['accuracy']) == (None, None, 7)
+
+
+def test_groups_partition_reads(store):
+    store.update_many([(f'd{n}', {'lat': 1.0, 'lon': 2.0, 'timestamp': None, 'updated': time.time()})
+                       for n in range(4)])
+    store.set_group('d1', 'A')
+    store.set_group('d2', 'A')
+    cursor = store.cursor()
+    store.set_group('d2', 'B')
+    store.delete('d1')
+    assert store.groups() == {'B': 1}
+    delta = store.changes_since(cursor, 'A')
+    assert not delta['full'] and delta['devices'] == {} and sorted(delta['deleted']) == ['d1', 'd2']
+    assert list(store.changes_since(cursor, 'B')['devices']) == ['d2']
+    assert list(store.all('B')) == ['d2']
@@ -0,0 +1,51 @@
+import pytest
+
+from spatial import haversine_m
+from trips import TripStats, create_windows
+
+DAY = 1_700_000_000 - 1_700_000_000 % 86400   # منتصف ليل UTC
+
+
+@pytest.fixture
+def trips():
+    return TripStats(create_windows('UTC'), idle_speed=1.0, max_gap=300)
+
+
+def report(trips, device_id, now):
+    return trips.report(trips.window('day'), now, [device_id])[2][device_id]
+
+
+def test_distance_is_the_sum_of_moving_steps(trips):
+    points = [(36.0, 3.0), (36.01, 3.0), (36.01, 3.01)]
+    for n, (lat, lon) in enumerate(points):
+        trips.observe('truck', {'lat': lat, 'lon': lon}, DAY + 3600 + n * 60)
+    stats = report(trips, 'truck', DAY + 4000)
+    steps = [haversine_m(*points[0], *points[1]), haversine_m(*points[1], *points[2])]
+    assert stats['distance_m'] == pytest.approx(sum(steps), abs=0.1)
+    assert stats['moving_s'] == 120 and stats['idle_s'] == 0
+    # بلا سرعة من الجهاز تقدر من المسافة والزمن
+    assert stats['max_speed'] == pytest.approx(max(steps) / 60 * 3.6, abs=0.1)
+
+
+def test_gps_jitter_while_parked_counts_as_a_stop(trips):
+    for n in range(6):
+        # تذبذب متر أو اثنين كل 30 ثانية: أبطأ بكثير من idle_speed
+        trips.observe('van', {'lat': 36.0 + (n % 2) * 0.00002, 'lon': 3.0, 'speed': 0}, DAY + 3600 + n * 30)
+    stats = report(trips, 'van', DAY + 4000)
+    assert stats['distance_m'] == 0 and stats['moving_s'] == 0 and stats['idle_s'] == 150
+
+
+def test_gaps_and_out_of_order_fixes_are_not_counted(trips):
+    trips.observe('car', {'lat': 36.0, 'lon': 3.0}, DAY + 3600)
+    trips.observe('car', {'lat': 36.1, 'lon': 3.0}, DAY + 3600 + 1000)   # أطول من max_gap
+    trips.observe('car', {'lat': 36.0, 'lon': 3.0}, DAY + 3600 + 500)    # أقدم من آخر إشارة
+    stats = report(trips, 'car', DAY + 5000)
+    assert stats['distance_m'] == 0 and stats['moving_s'] == 0 and stats['idle_s'] == 0
+
+
+def test_step_across_midnight_is_split_between_days(trips):
+    trips.observe('bus', {'lat': 36.0, 'lon': 3.0}, DAY + 86400 - 60)
+    trips.observe('bus', {'lat': 36.01, 'lon': 3.0}, DAY + 86400 + 60)
+    stats = report(trips, 'bus', DAY + 86400 + 120)
+    assert stats['moving_s'] == 60
+    assert stats['distance_m'] == pytest.approx(haversine_m(36.0, 3.0, 36.01, 3.0) / 2, abs=0.1)
@@ -0,0 +1,152 @@
+from datetime import datetime, timedelta
+import math
+import threading
+
+import pytz
+
+from motion import to_float
+from spatial import haversine_m
+
+# إحصاءات رحلة كل جهاز (المسافة، زمن الحركة والتوقف، أقصى سرعة، معدل استهلاك البطارية)
+# تحدث مع كل إشارة بعمل ثابت O(1) لكل نافذة زمنية (اليوم والوردية)، فتقرأ فوراً دون إعادة
+# المرور على السجل التاريخي؛ كل فترة بين إشارتين متتاليتين تحسب حركة أو توقفاً حسب سرعتها،
+# والفترات الأطول من max_gap (جهاز مطفأ أو بلا تغطية) لا تحسب في أي منهما
+
+
+class Window:
+    # نافذة متكررة بطول hours تبدأ عند start_hour بالتوقيت المحلي (اليوم: 24 ساعة من منتصف الليل)
+    def __init__(self, name, hours, start_hour, tz):
+        self.name = name
+        self.length = hours * 3600
+        self.start_hour = start_hour
+        self.tz = tz
+        self.current = (0.0, 0.0)   # آخر حدود محسوبة؛ تتغير مرة واحدة كل نافذة
+
+    def bounds(self, t):
+        start, end = self.current
+        if start <= t < end:
+            return self.current
+        local = datetime.fromtimestamp(t, self.tz)
+        anchor = self.tz.localize(datetime(local.year, local.month, local.day)
+                                  + timedelta(hours=self.start_hour)).timestamp()
+        if anchor > t:
+            anchor -= 86400
+        start = anchor + math.floor((t - anchor) / self.length) * self.length
+        bounds = (start, start + self.length)
+        if t >= self.current[1]:
+            self.current = bounds
+        return bounds
+
+
+class Totals:
+    __slots__ = ('start', 'distance', 'moving', 'idle', 'max_speed',
+                 'battery_at', 'battery', 'battery_drop', 'battery_since')
+
+    def __init__(self, start):
+        self.start = start
+        self.distance = 0.0
+        self.moving = 0.0
+        self.idle = 0.0
+        self.max_speed = None
+        self.battery_at = self.battery = self.battery_since = None
+        self.battery_drop = 0.0
+
+    def to_dict(self):
+        hours = (self.battery_at - self.battery_since) / 3600 if self.battery_since is not None else 0
+        return {'distance_m': round(self.distance, 1), 'moving_s': round(self.moving),
+                'idle_s': round(self.idle), 'max_speed': self.max_speed,
+                'battery': self.battery,
+                'battery_drain_per_hour': round(self.battery_drop / hours, 2) if hours >= 0.25 else None}
+
+
+class DeviceTrip:
+    __slots__ = ('lat', 'lon', 'at', 'totals')
+
+    def __init__(self, windows):
+        self.lat = self.lon = self.at = None
+        self.totals = [None] * len(windows)
+
+
+class TripStats:
+    def __init__(self, windows, idle_speed=1.0, max_gap=300.0):
+        self.windows = windows
+        self.idle_speed = idle_speed    # م/ث؛ أبطأ من هذا يعد توقفاً (يشمل تذبذب GPS للجهاز الواقف)
+        self.max_gap = max_gap          # ثوانٍ
+        self.lock = threading.Lock()
+        self.devices = {}
+
+    def observe(self, device_id, record, t):
+        # t وقت الإشارة بالثواني؛ الإشارات الأقدم من آخر إشارة (دفعات مخزنة غير مرتبة) تتجاهل
+        speed = to_float(record.get('speed'))
+        battery = to_float(record.get('battery'))
+        lat, lon = record['lat'], record['lon']
+        with self.lock:
+            trip = self.devices.get(device_id)
+            if trip is None:
+                trip = self.devices[device_id] = DeviceTrip(self.windows)
+            elif t <= trip.at:
+                return
+            step = elapsed = 0.0
+            if trip.at is not None and t - trip.at <= self.max_gap:
+                elapsed = t - trip.at
+                step = haversine_m(trip.lat, trip.lon, lat, lon)
+            moving = elapsed > 0 and (step / elapsed >= self.idle_speed
+                                      or speed is not None and speed / 3.6 >= self.idle_speed)
+            if speed is None and moving and elapsed >= 10:
+                speed = round(step / elapsed * 3.6, 1)
+            for n, window in enumerate(self.windows):
+                start = window.bounds(t)[0]
+                totals = trip.totals[n]
+                if totals is None or totals.start != start:
+                    totals = trip.totals[n] = Totals(start)
+                if elapsed:
+                    # الفترة التي تعبر بداية النافذة يحسب منها ما بعد البداية فقط
+                    span = min(elapsed, t - start)
+                    if moving:
+                        totals.moving += span
+                        totals.distance += step * span / elapsed
+                    else:
+                        totals.idle += span
+                if speed is not None and (totals.max_speed is None or speed > totals.max_speed):
+                    totals.max_speed = speed
+                if battery is not None:
+                    # الشحن لا يطرح من الاستهلاك؛ المعدل = مجموع الانخفاض / مدة القراءات
+                    if totals.battery is not None and battery < totals.battery:
+                        totals.battery_drop += totals.battery - battery
+                    if totals.battery_since is None:
+                        totals.battery_since = t
+                    totals.battery, totals.battery_at = battery, t
+            trip.lat, trip.lon, trip.at = lat, lon, t
+
+    def window(self, name):
+        for window in self.windows:
+            if window.name == name:
+                return window
+        return None
+
+    def report(self, window, now, device_ids=None):
+        # {معرف الجهاز: الإحصاءات} للنافذة الحالية؛ الجهاز الذي لم يرسل فيها يعاد بأصفار
+        start, end = window.bounds(now)
+        n = self.windows.index(window)
+        with self.lock:
+            if device_ids is None:
+                device_ids = list(self.devices)
+            result = {}
+            for device_id in device_ids:
+                trip = self.devices.get(device_id)
+                if trip is None:
+                    continue
+                totals = trip.totals[n]
+                if totals is None or totals.start != start:
+                    totals = Totals(start)
+                result[device_id] = totals.to_dict()
+        return start, end, result
+
+    def forget(self, device_id):
+        with self.lock:
+            self.devices.pop(device_id, None)
+
+
+def create_windows(tz_name='UTC', shift_hours=8, shift_start=6):
+    tz = pytz.timezone(tz_name)
+    return [Window('day', 24, 0, tz), Window('shift', shift_hours, shift_start, tz)]
@@ -0,0 +1,74 @@
+import struct
+
+# صيغة ثنائية ثابتة لإشارات أجهزة التتبع (جسم POST إلى /update_binary أو حزمة UDP)
+#   الإطار   = الرأس + معرف الجهاز (UTF-8) + count × إشارة، ويمكن وضع عدة إطارات
+#              (عدة أجهزة) متتالية في نفس الجسم أو الحزمة؛ كل القيم little-endian
+#   الرأس    = 'FT'، الإصدار (uint8)، طول المعرف (uint8)، عدد الإشارات (uint16)      6 بايت
+#   الإشارة  = الوقت (uint32 ثوانٍ منذ 1970)، خط العرض والطول (int32 ×1e6)،
+#              البطارية (uint8 %)، السرعة (uint16 ×0.1 كم/س)، الدقة (uint16 ×0.1 م)  17 بايت
+#   القيم غير المعروفة: الوقت 0، البطارية 0xFF، السرعة والدقة 0xFFFF
+MAGIC = b'FT'
+VERSION = 1
+HEADER = struct.Struct('<2sBBH')
+FIX = struct.Struct('<IiiBHH')
+ACK = struct.Struct('<2sH')   # رد UDP: 'FA' وعدد الإشارات المقبولة
+UNKNOWN_BATTERY = 0xFF
+UNKNOWN_WORD = 0xFFFF
+
+
+def decode(data):
+    # يفك الإشارات مباشرة من الذاكرة المستلمة (bytes أو memoryview) دون نسخها
+    # ويعيدها بنفس مفاتيح JSON حتى تمر عبر نفس مسار الدفعات (build_record)
+    view = memoryview(data)
+    end = len(view)
+    offset = 0
+    fixes = []
+    while offset < end:
+        if end - offset < HEADER.size:
+            raise ValueError('حزمة ثنائية غير مكتملة')
+        magic, version, id_len, count = HEADER.unpack_from(view, offset)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('حزمة ثنائية غير معروفة')
+        offset += HEADER.size
+        stop = offset + id_len + count * FIX.size
+        if stop > end:
+            raise ValueError('حزمة ثنائية غير مكتملة')
+        try:
+            device_id = str(view[offset:offset + id_len], 'utf-8')
+        except UnicodeDecodeError:
+            raise ValueError('معرف جهاز غير صالح')
+        for ts, lat, lon, battery, speed, accuracy in FIX.iter_unpack(view[offset + id_len:stop]):
+            fixes.append({
+                'id': device_id,
+                'lat': lat / 1e6,
+                'lon': lon / 1e6,
+                'timestamp': ts or None,
+                'batt': None if battery == UNKNOWN_BATTERY else battery,
+                'speed': None if speed == UNKNOWN_WORD else speed / 10,
+                'accuracy': None if accuracy == UNKNOWN_WORD else accuracy / 10,
+            })
+        offset = stop
+    return fixes
+
+
+def encode(device_id, fixes):
+    # إطار لجهاز واحد؛ fixes قواميس بمفاتيح lat, lon وبشكل اختياري timestamp, batt, speed, accuracy
+    key = str(device_id).encode()
+    parts = [HEADER.pack(MAGIC, VERSION, len(key), len(fixes)), key]
+    for fix in fixes:
+        parts.append(FIX.pack(
+            int(fix.get('timestamp') or 0),
+            round(float(fix['lat']) * 1e6), round(float(fix['lon']) * 1e6),
+            UNKNOWN_BATTERY if fix.get('batt') is None else min(int(fix['batt']), 100),
+            scaled(fix.get('speed')), scaled(fix.get('accuracy'))))
+    return b''.join(parts)
+
+
+def scaled(value):
+    if value is None:
+        return UNKNOWN_WORD
+    return max(0, min(round(float(value) * 10), UNKNOWN_WORD - 1))
+
+
+def ack(accepted):
+    return ACK.pack(b'FA', min(accepted, UNKNOWN_WORD))